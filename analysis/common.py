@@ -16,7 +16,9 @@ import numpy as np
 import scipy.stats
 import seaborn as sns
 
+import pirl.envs
 from pirl.envs import jungle_topology
+from pirl.results import GROUND_TRUTH, VALUE_COLUMNS
 
 logger = logging.getLogger('analysis.common')
 THIS_DIR = osp.join(os.path.dirname(os.path.realpath(__file__)))
@@ -76,11 +78,92 @@ def extract_value(data):
 
     return values
 
-def load_value(experiment_dir, algo_pattern='(.*)', env_pattern='(.*)', algos=['.*'], dps=2):
-    fname = osp.join(experiment_dir, 'results.pkl')
-    data = pd.read_pickle(fname)
+def _match(values, cond):
+    '''Boolean mask of values satisfying cond: a predicate, a list of
+       allowed values or a single allowed value.'''
+    if callable(cond):
+        return np.asarray(cond(values), dtype=bool)
+    elif isinstance(cond, (list, tuple, set)):
+        return np.isin(values, list(cond))
+    else:
+        return values == cond
+
+def load_values(experiment_dir, columns=None, filters=None):
+    '''Loads values.npz from experiment_dir as a flat DataFrame, with columns
+       pirl.results.VALUE_COLUMNS (string columns are categorical).
+
+       Only columns (default: all present, since older files may lack
+       some) are loaded. filters maps column names to
+       conditions (see _match): only rows satisfying all are returned. String
+       columns are filtered on their categories, before decoding.'''
+    filters = filters or {}
+    with np.load(osp.join(experiment_dir, 'values.npz')) as data:
+        def is_str(col):
+            return col + '.codes' in data.files
+
+        if columns is None:
+            columns = [col for col in VALUE_COLUMNS
+                       if col in data.files or is_str(col)]
+
+        mask = None
+        for col, cond in filters.items():
+            if is_str(col):
+                matches = np.flatnonzero(_match(data[col + '.categories'], cond))
+                m = np.isin(data[col + '.codes'], matches)
+            else:
+                m = _match(data[col], cond)
+            mask = m if mask is None else mask & m
+
+        res = collections.OrderedDict()
+        for col in columns:
+            if is_str(col):
+                codes = data[col + '.codes']
+                codes = codes if mask is None else codes[mask]
+                res[col] = pd.Categorical.from_codes(codes,
+                                                     data[col + '.categories'])
+            else:
+                arr = data[col]
+                res[col] = arr if mask is None else arr[mask]
+    return pd.DataFrame(res, columns=columns)
+
+def values_to_frame(flat):
+    '''Converts the output of load_values (with all columns) to the
+       format returned by extract_value.'''
+    flat = flat.copy()
+    for col in ['eval', 'irl', 'env']:
+        flat[col] = flat[col].astype(str)
+    long = flat.melt(id_vars=['seed', 'eval', 'irl', 'env', 'n', 'm'],
+                     value_vars=['mean', 'se'], var_name='type')
+    is_gt = long['irl'] == GROUND_TRUTH
+
+    sorted_idx = ['env', 'n', 'm', 'eval', 'seed', 'type']
+    values = long[~is_gt].set_index(sorted_idx + ['irl'])['value']
+    values = values.unstack('irl')
+    ground_truth = long[is_gt].set_index(['env', 'seed', 'type', 'eval'])
+    ground_truth = ground_truth['value'].unstack('eval')
+    ground_truth.columns.name = None
+
+    if not values.empty:
+        idx = values.index
+    else:
+        idx = [(env, 0, 0, 'gt', seed, kind)
+               for env, seed, kind in tuple(ground_truth.index)]
+        idx = pd.MultiIndex.from_tuples(idx, names=sorted_idx)
+        values = pd.DataFrame(index=idx)
 
-    value = extract_value(data)
+    gt_idx = pd.MultiIndex.from_arrays([idx.get_level_values(k)
+                                        for k in ['env', 'seed', 'type']])
+    values_gt = ground_truth.reindex(gt_idx)
+    values_gt.index = idx
+    return pd.concat([values, values_gt], axis=1)
+
+def load_value(experiment_dir, algo_pattern='(.*)', env_pattern='(.*)', algos=['.*'], dps=2):
+    if osp.exists(osp.join(experiment_dir, 'values.npz')):
+        value = values_to_frame(load_values(experiment_dir))
+    else:  # experiments predating values.npz
+        fname = osp.join(experiment_dir, 'results.pkl')
+        data = pd.read_pickle(fname)
+        value = extract_value(data)
     value.columns = value.columns.str.extract(algo_pattern, expand=False)
     envs = value.index.levels[0].str.extract(env_pattern, expand=False)
     value.index = value.index.set_levels(envs, level=0)
@@ -147,6 +230,7 @@ def _gridworld_heatmap(reward, shape, walls=None, **kwargs):
 
 def _gridworld_heatmaps(reward, shape, env_name, get_axis,
                         prefix=None, share_scale=True, **kwargs):
+    pirl.envs.import_env_module(env_name)
     env = gym.make(env_name)
     try:
         walls = env.unwrapped.walls
@@ -235,6 +319,7 @@ def gridworld_ground_truth(envs, shape):
     rmin = 1e10
     rmax = -1e10
     for nickname, env_name in envs.items():
+        pirl.envs.import_env_module(env_name)
         env = gym.make(env_name)
         reward = env.unwrapped.reward
         walls = env.unwrapped.walls
@@ -1 +1,3 @@
-from pirl.agents import sample, tabular, ppo
\ No newline at end of file
+# ppo is not imported here, since it depends on TensorFlow.
+# Import it explicitly: from pirl.agents import ppo
+from pirl.agents import sample, tabular
@@ -1,6 +1,8 @@
 '''Based on OpenAI Baselines PPO2 (GPU optimized).'''
 
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import logging
 import joblib
 import math
@@ -16,11 +18,13 @@ import tensorflow as tf
 from baselines import logger as blogger
 from baselines.common import explained_variance
 from baselines.common.runners import AbstractEnvRunner
+from baselines.common.running_mean_std import RunningMeanStd
 from baselines.common.vec_env import VecEnvWrapper
 from baselines.common.vec_env.vec_normalize import VecNormalize
 from baselines.ppo2.policies import MlpPolicy
 
-from pirl.agents.sample import SampleVecMonitor
+from pirl.agents.sample import SampleVecMonitor, VecEvaluator
+from pirl.inference import InferenceClient
 
 logger = logging.getLogger('pirl.agents.ppo')
 
@@ -28,6 +32,8 @@ logger = logging.getLogger('pirl.agents.ppo')
 # Main changes: in Model, add {get,restore}_params.
 # In Runner:
 # * Report original and reward after normalization
+# * Write rollouts in place into preallocated RolloutStorage
+# * Optionally relabel rewards after each rollout
 # * Yield intermediate parameters during optimization
 
 class Model(object):
@@ -115,59 +121,114 @@ class Model(object):
         tf.global_variables_initializer().run(session=sess) #pylint: disable=E1101
 
 
+class RolloutStorage(object):
+    '''Buffers for a rollout of nsteps in each of nenvs environments,
+       allocated once and written in place by Runner. Arrays have shape
+       (nsteps, nenvs, ...). The flattened views returned by flat are
+       indexed by t * nenvs + env.'''
+    FIELDS = ['obs', 'returns', 'dones', 'actions', 'values', 'neglogpacs']
+
+    def __init__(self, nsteps, nenvs, ob_shape, ob_dtype):
+        self.nsteps = nsteps
+        self.nenvs = nenvs
+        shape = (nsteps, nenvs)
+        self.obs = np.zeros(shape + ob_shape, dtype=ob_dtype)
+        self.rewards = np.zeros(shape, dtype=np.float32)
+        self.values = np.zeros(shape, dtype=np.float32)
+        self.neglogpacs = np.zeros(shape, dtype=np.float32)
+        self.dones = np.zeros(shape, dtype=np.bool)
+        self.advs = np.zeros(shape, dtype=np.float32)
+        self.returns = np.zeros(shape, dtype=np.float32)
+        # Shape and dtype of actions are only known after the first step
+        self.actions = None
+        self._nonterminal = np.zeros(shape, dtype=np.float32)
+        self._minibatches = {}
+
+    def set_actions(self, t, actions):
+        if self.actions is None:
+            actions = np.asarray(actions)
+            self.actions = np.zeros((self.nsteps, ) + actions.shape,
+                                    dtype=actions.dtype)
+        self.actions[t] = actions
+
+    def compute_gae(self, last_values, last_dones, gamma, lam):
+        '''Computes advantages and returns in place by generalized
+           advantage estimation, bootstrapping off last_values.'''
+        nonterminal = self._nonterminal
+        np.subtract(1.0, self.dones[1:], out=nonterminal[:-1])
+        np.subtract(1.0, last_dones, out=nonterminal[-1])
+        # TD residuals for all steps at once, accumulated in self.advs
+        deltas = self.advs
+        deltas[:-1] = self.values[1:]
+        deltas[-1] = last_values
+        deltas *= nonterminal
+        deltas *= gamma
+        deltas += self.rewards
+        deltas -= self.values
+        # Only the discounted sum over time remains sequential
+        decay = nonterminal
+        decay *= gamma * lam
+        for t in reversed(range(self.nsteps - 1)):
+            self.advs[t] += decay[t] * self.advs[t + 1]
+        np.add(self.advs, self.values, out=self.returns)
+
+    def flat(self):
+        '''Returns views of FIELDS, flattened to (nsteps * nenvs, ...).'''
+        arrays = [getattr(self, k) for k in self.FIELDS]
+        return tuple(x.reshape((-1, ) + x.shape[2:]) for x in arrays)
+
+    def minibatch(self, inds):
+        '''Gathers FIELDS at flat indices inds into buffers that are reused
+           across calls. Results are only valid until the next call.'''
+        bufs = self._minibatches.get(len(inds))
+        flat = self.flat()
+        if bufs is None:
+            bufs = tuple(np.empty((len(inds), ) + x.shape[1:], dtype=x.dtype)
+                         for x in flat)
+            self._minibatches[len(inds)] = bufs
+        for x, buf in zip(flat, bufs):
+            np.take(x, inds, axis=0, out=buf, mode='clip')
+        return bufs
+
+
 class Runner(AbstractEnvRunner):
-    def __init__(self, *, env, model, nsteps, gamma, lam):
+    def __init__(self, *, env, model, nsteps, gamma, lam, relabel=None):
+        '''relabel: optional callable, passed the RolloutStorage after each
+           rollout and before computing advantages, that may overwrite its
+           rewards (see RewardRelabeler).'''
         super().__init__(env=env, model=model, nsteps=nsteps)
         self.lam = lam
         self.gamma = gamma
+        self.relabel = relabel
+        self.storage = RolloutStorage(nsteps, env.num_envs,
+                                      self.obs.shape[1:], self.obs.dtype)
 
     def run(self):
-        mb_obs, mb_rewards, mb_actions, mb_values, mb_dones, mb_neglogpacs = [],[],[],[],[],[]
+        '''Returns flat views of self.storage (see RolloutStorage.FIELDS),
+           the initial states and episode infos. The views are overwritten
+           by the next call.'''
+        storage = self.storage
         mb_states = self.states
         epinfos = []
-        for _ in range(self.nsteps):
+        for t in range(self.nsteps):
             actions, values, self.states, neglogpacs = self.model.step(self.obs, self.states, self.dones)
-            mb_obs.append(self.obs.copy())
-            mb_actions.append(actions)
-            mb_values.append(values)
-            mb_neglogpacs.append(neglogpacs)
-            mb_dones.append(self.dones)
+            storage.obs[t] = self.obs
+            storage.set_actions(t, actions)
+            storage.values[t] = values
+            storage.neglogpacs[t] = neglogpacs
+            storage.dones[t] = self.dones
             self.obs[:], rewards, self.dones, infos = self.env.step(actions)
             for info in infos:
                 maybeepinfo = info.get('episode')
                 if maybeepinfo: epinfos.append(maybeepinfo)
-            mb_rewards.append(rewards)
-        #batch of steps to batch of rollouts
-        mb_obs = np.asarray(mb_obs, dtype=self.obs.dtype)
-        mb_rewards = np.asarray(mb_rewards, dtype=np.float32)
-        mb_actions = np.asarray(mb_actions)
-        mb_values = np.asarray(mb_values, dtype=np.float32)
-        mb_neglogpacs = np.asarray(mb_neglogpacs, dtype=np.float32)
-        mb_dones = np.asarray(mb_dones, dtype=np.bool)
+            storage.rewards[t] = rewards
+        if self.relabel is not None:
+            self.relabel(storage)
         last_values = self.model.value(self.obs, self.states, self.dones)
         #discount/bootstrap off value fn
-        mb_returns = np.zeros_like(mb_rewards)
-        mb_advs = np.zeros_like(mb_rewards)
-        lastgaelam = 0
-        for t in reversed(range(self.nsteps)):
-            if t == self.nsteps - 1:
-                nextnonterminal = 1.0 - self.dones
-                nextvalues = last_values
-            else:
-                nextnonterminal = 1.0 - mb_dones[t+1]
-                nextvalues = mb_values[t+1]
-            delta = mb_rewards[t] + self.gamma * nextvalues * nextnonterminal - mb_values[t]
-            mb_advs[t] = lastgaelam = delta + self.gamma * self.lam * nextnonterminal * lastgaelam
-        mb_returns = mb_advs + mb_values
-        return (*map(sf01, (mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs)),
-            mb_states, epinfos)
+        storage.compute_gae(last_values, self.dones, self.gamma, self.lam)
+        return (*storage.flat(), mb_states, epinfos)
 # obs, returns, masks, actions, values, neglogpacs, states = runner.run()
-def sf01(arr):
-    """
-    swap and then flatten axes 0 and 1
-    """
-    s = arr.shape
-    return arr.swapaxes(0, 1).reshape(s[0] * s[1], *s[2:])
 
 def constfn(val):
     def f(_):
@@ -178,7 +239,7 @@ def learn(*, policy, env, epinfobuf, trajectorybuf,
              nsteps, total_timesteps, ent_coef, lr,
              vf_coef=0.5,  max_grad_norm=0.5, gamma=0.99, lam=0.95,
              log_interval=10, nminibatches=4, noptepochs=4, cliprange=0.2,
-             save_interval=0, load_path=None):
+             save_interval=0, load_path=None, relabel=None):
 
     if isinstance(lr, float): lr = constfn(lr)
     else: assert callable(lr)
@@ -200,7 +261,8 @@ def learn(*, policy, env, epinfobuf, trajectorybuf,
     model = make_model(nenvs)
     if load_path is not None:
         model.load(load_path)
-    runner = Runner(env=env, model=model, nsteps=nsteps, gamma=gamma, lam=lam)
+    runner = Runner(env=env, model=model, nsteps=nsteps, gamma=gamma, lam=lam,
+                    relabel=relabel)
 
     tfirststart = time.time()
 
@@ -222,13 +284,14 @@ def learn(*, policy, env, epinfobuf, trajectorybuf,
                 for start in range(0, nbatch, nbatch_train):
                     end = start + nbatch_train
                     mbinds = inds[start:end]
-                    slices = (arr[mbinds] for arr in (obs, returns, masks, actions, values, neglogpacs))
+                    slices = runner.storage.minibatch(mbinds)
                     mblossvals.append(model.train(lrnow, cliprangenow, *slices))
         else: # recurrent version
             assert nenvs % nminibatches == 0
             envsperbatch = nenvs // nminibatches
             envinds = np.arange(nenvs)
-            flatinds = np.arange(nenvs * nsteps).reshape(nenvs, nsteps)
+            # Flat indices of each environment's steps, in time order
+            flatinds = np.arange(nenvs * nsteps).reshape(nsteps, nenvs).T
             envsperbatch = nbatch_train // nsteps
             for _ in range(noptepochs):
                 np.random.shuffle(envinds)
@@ -236,7 +299,7 @@ def learn(*, policy, env, epinfobuf, trajectorybuf,
                     end = start + envsperbatch
                     mbenvinds = envinds[start:end]
                     mbflatinds = flatinds[mbenvinds].ravel()
-                    slices = (arr[mbflatinds] for arr in (obs, returns, masks, actions, values, neglogpacs))
+                    slices = runner.storage.minibatch(mbflatinds)
                     mbstates = states[mbenvinds]
                     mblossvals.append(model.train(lrnow, cliprangenow, *slices, mbstates))
 
@@ -333,10 +396,129 @@ def _make_const(norm):
             setattr(norm, k, ConstantStatistics(v))
 
 
+def _find_deferred(venv):
+    '''Returns the wrapper of venv in deferred reward mode, if any.'''
+    while venv is not None:
+        if getattr(venv, 'deferred', False):
+            return venv
+        venv = getattr(venv, 'venv', None)
+    return None
+
+
+class RewardRelabeler(object):
+    '''Runner hook for reward wrappers in deferred mode (e.g.
+       airl.AIRLVecRewardWrapper). After each rollout, fetches the rewards
+       of the rollout in one batch, fills them in for monitor, and writes
+       them to the rollout storage, normalized as VecNormalize would have.
+       The VecNormalize wrapper must then be created with ret=False.'''
+    def __init__(self, reward_wrapper, monitor, normalize,
+                 gamma=0.99, cliprew=10., epsilon=1e-8):
+        self.reward_wrapper = reward_wrapper
+        self.monitor = monitor
+        self.ret_rms = RunningMeanStd(shape=()) if normalize else None
+        self.ret = np.zeros(monitor.num_envs)
+        self.gamma = gamma
+        self.cliprew = cliprew
+        self.epsilon = epsilon
+
+    def __call__(self, storage):
+        rewards = self.reward_wrapper.relabel()
+        self.monitor.relabel(rewards)
+        if self.ret_rms is None:
+            storage.rewards[:] = rewards
+            return
+        # Running statistics are updated step by step, as in VecNormalize
+        for t, rews in enumerate(rewards):
+            self.ret = self.ret * self.gamma + rews
+            self.ret_rms.update(self.ret)
+            scale = np.sqrt(self.ret_rms.var + self.epsilon)
+            storage.rewards[t] = np.clip(rews / scale,
+                                         -self.cliprew, self.cliprew)
+
+
+class PlateauStopping(object):
+    '''Early stopping criterion: signals to stop once the mean reward has not
+       improved on its best value by more than min_improvement * |best| for
+       patience timesteps. Non-finite mean rewards (no completed episodes)
+       are ignored, and training never stops before the first finite one.'''
+    def __init__(self, patience, min_improvement=0.01):
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.best = None
+        self.best_timesteps = 0
+
+    def __call__(self, timesteps, mean_reward):
+        '''Records mean_reward after timesteps, returning True to stop.'''
+        if math.isfinite(mean_reward):
+            if self.best is None:
+                improved = True
+            else:
+                threshold = self.min_improvement * abs(self.best)
+                improved = mean_reward - self.best > threshold
+            if improved:
+                self.best = mean_reward
+                self.best_timesteps = timesteps
+        if self.best is None:
+            return False
+        return timesteps - self.best_timesteps >= self.patience
+
+
+class CheckpointWriter(object):
+    '''Writes checkpoints to directory on a background thread, retaining
+       only the keep with the highest score on disk. Use as a context
+       manager: on exit, waits for pending writes and raises any error.'''
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        # A single worker, so writes and deletions happen in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+        self._retained = []  # min-heap of (score, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save(self, name, score, checkpoint):
+        '''Schedules checkpoint to be written under name. Non-finite scores
+           rank below all others. checkpoint must not be mutated after.'''
+        if not math.isfinite(score):
+            score = -math.inf
+        path = osp.join(self.directory, name)
+        heapq.heappush(self._retained, (score, path))
+        evicted = []
+        while len(self._retained) > self.keep:
+            evicted.append(heapq.heappop(self._retained)[1])
+        self._futures.append(self._executor.submit(
+            self._write, path, checkpoint, evicted))
+
+    @staticmethod
+    def _write(path, checkpoint, evicted):
+        if path not in evicted:  # otherwise, it is worse than those kept
+            joblib.dump(checkpoint, path)
+        for old_path in evicted:
+            try:
+                os.unlink(old_path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+
 def train_continuous(venv, discount, seed, log_dir, tf_config,
-                     num_timesteps, norm=True):
+                     num_timesteps, norm=True,
+                     patience=None, min_improvement=0.01, keep_checkpoints=3):
     '''Policy with hyperparameters optimized for continuous control environments
-       (e.g. MuJoCo). Returns log_dir, where the trained policy is saved.'''
+       (e.g. MuJoCo). Returns the policy with the highest mean reward. The
+       best keep_checkpoints are also saved under log_dir. If patience is not
+       None, stops before num_timesteps once the mean reward plateaus (see
+       PlateauStopping).'''
     blogger.configure(dir=log_dir)
     checkpoint_dir = osp.join(blogger.get_dir(), 'checkpoints')
     os.makedirs(checkpoint_dir)
@@ -350,9 +532,17 @@ def train_continuous(venv, discount, seed, log_dir, tf_config,
     #   reoptimizing from IRL). This is the reward used to choose the best model.
     epinfobuf = deque(maxlen=100)
     trajectorybuf = deque(maxlen=100)
-    venv = SampleVecMonitor(venv, trajectorybuf)
-    make_vec_normalize = VecNormalize if norm else DummyVecNormalize
-    norm_venv = make_vec_normalize(venv)
+    # Reward wrappers in deferred mode compute rewards after each rollout
+    reward_wrapper = _find_deferred(venv)
+    deferred = reward_wrapper is not None
+    venv = SampleVecMonitor(venv, trajectorybuf, deferred=deferred)
+    relabel = None
+    if deferred:
+        relabel = RewardRelabeler(reward_wrapper, venv, normalize=norm)
+        norm_venv = VecNormalize(venv, ret=False) if norm else DummyVecNormalize(venv)
+    else:
+        make_vec_normalize = VecNormalize if norm else DummyVecNormalize
+        norm_venv = make_vec_normalize(venv)
 
     train_graph = tf.Graph()
     with train_graph.as_default():
@@ -369,33 +559,110 @@ def train_continuous(venv, discount, seed, log_dir, tf_config,
                 lr=3e-4,
                 cliprange=0.2,
                 total_timesteps=num_timesteps,
-                save_interval=4)
+                save_interval=4,
+                relabel=relabel)
+            nbatch = nsteps * venv.num_envs
+            stop = None
+            if patience is not None:
+                stop = PlateauStopping(patience, min_improvement)
             best_mean_reward = None
-            best_checkpoint = None
-            for update, mean_reward, make_model, params in learner:
-                # joblib cannot pickle closures, so use cloudpickle first
-                make_model_pkl = cloudpickle.dumps(make_model)
-                model = make_model_pkl, params
-                policy = model, _save_stats(norm_venv)
-
-                checkpoint_fname = osp.join(checkpoint_dir, '{:05}'.format(update))
-                joblib.dump(policy, checkpoint_fname)
+            best_policy = None
+            make_model_pkl = None
+            update = 0
+            with CheckpointWriter(checkpoint_dir, keep_checkpoints) as writer:
+                for update, mean_reward, make_model, params in learner:
+                    # joblib cannot pickle closures, so use cloudpickle first.
+                    # make_model is the same closure at every update.
+                    if make_model_pkl is None:
+                        make_model_pkl = cloudpickle.dumps(make_model)
+                    model = make_model_pkl, params
+                    policy = model, _save_stats(norm_venv)
+                    writer.save('{:05}'.format(update), mean_reward, policy)
+
+                    valid = math.isfinite(mean_reward)
+                    improvement = (best_mean_reward is None
+                                   or mean_reward > best_mean_reward)
+                    if valid and improvement:
+                        best_policy = policy
+                        blogger.log("Updating model, mean reward {} -> {}".format(
+                                    best_mean_reward, mean_reward))
+                        best_mean_reward = mean_reward
+
+                    if stop is not None and stop(update * nbatch, mean_reward):
+                        blogger.log("Mean reward plateaued at {}, stopping".format(
+                                    stop.best))
+                        break
+                learner.close()
+
+    timesteps = update * nbatch
+    blogger.log("Trained for {} of {} timesteps".format(
+                timesteps, int(num_timesteps)))
+    logger.info('Trained for %d of %d timesteps (%s)',
+                timesteps, num_timesteps, log_dir)
+
+    if best_policy is None:
+        raise ValueError('No episodes completed in {} timesteps'.format(
+                         timesteps))
+    return best_policy
+
+
+def policy_fn(policy):
+    '''Returns a function mapping a batch of normalized observations to the
+       mean and standard deviation of the (diagonal Gaussian) distribution
+       over actions, for a (non-recurrent) policy returned by
+       train_continuous. Used by pirl.inference to serve policies.'''
+    smodel, _snorm_env = policy
+    make_model_pkl, params = smodel
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.Session(config=make_config(tf.ConfigProto()))
+        with sess.as_default():
+            make_model = cloudpickle.loads(make_model_pkl)
+            model = make_model(None)  # batch size determined at run time
+            model.restore_params(params)
 
-                valid = math.isfinite(mean_reward)
-                improvement = (best_mean_reward is None
-                               or mean_reward > best_mean_reward)
-                if valid and improvement:
-                    best_checkpoint = checkpoint_fname
-                    blogger.log("Updating model, mean reward {} -> {}".format(
-                                best_mean_reward, mean_reward))
-                    best_mean_reward = mean_reward
+    pd = model.act_model.pd
+    def act(obs):
+        mean, std = sess.run([pd.mean, pd.std], {model.act_model.X: obs})
+        return mean, std
+    act.close = sess.close
+    return act
 
-    return joblib.load(best_checkpoint)
 
+def sample(envs, policy, num_episodes, seed, tf_config, const_norm=False,
+           discount=None, inference=None):
+    '''Samples exactly num_episodes episodes. Returns their trajectories,
+       or their discounted returns if discount is not None.
 
-def sample(envs, policy, num_episodes, seed, tf_config, const_norm=False):
+       If inference is not None, the policy is evaluated by the
+       InferenceServer listening there, if any. Actions are then sampled
+       from the distribution it returns using NumPy, seeded by seed: this is
+       reproducible, but samples differ from those drawn in-process.'''
     smodel, snorm_env = policy
-    envs_monitor = SampleVecMonitor(envs)
+    envs_monitor = VecEvaluator(envs, num_episodes, discount=discount)
+
+    client = None
+    if inference is not None:
+        try:
+            client = InferenceClient(inference)
+        except OSError as e:
+            # The setting is global, but servers run per node
+            logger.warning('No inference server at %s (%s): evaluating '
+                           'policy in-process', inference, e)
+
+    if client is not None:
+        norm_envs = _restore_stats(snorm_env, envs_monitor)
+        if const_norm:
+            norm_envs = _make_const(norm_envs)
+        rng = np.random.RandomState(seed)
+        with client:
+            act = client.load('ppo_policy', policy)
+            obs = norm_envs.reset()
+            while not envs_monitor.finished:
+                mean, std = act(obs)
+                actions = mean + std * rng.standard_normal(mean.shape)
+                obs, _r, _dones, _info = norm_envs.step(actions)
+        return envs_monitor.result()
 
     infer_graph = tf.Graph()
     with infer_graph.as_default():
@@ -416,10 +683,8 @@ def sample(envs, policy, num_episodes, seed, tf_config, const_norm=False):
             obs = norm_envs.reset()
             states = model.initial_state
             dones = np.zeros(envs.num_envs, dtype='bool')
-            completed = 0
-            while completed < num_episodes:
+            while not envs_monitor.finished:
                 a, v, states, neglogp = model.step(obs, states, dones)
                 obs, r, dones, info = norm_envs.step(a)
-                completed += np.sum(dones)
 
-    return envs_monitor.trajectories
\ No newline at end of file
+    return envs_monitor.result()
\ No newline at end of file
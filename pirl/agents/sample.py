@@ -2,22 +2,45 @@ from baselines.common.vec_env import VecEnvWrapper
 import gym
 import numpy as np
 
-def _summary_stats(trajectories, discount):
-    rewards = [r for (s, a, r) in trajectories]
-    horizon = max([len(s) for (s, a, r) in trajectories])
-    weights = np.cumprod([1] + [discount] * (horizon - 1))
-    total_reward = [np.dot(r, weights[:len(r)]) for r in rewards]
-
-    mean = np.mean(total_reward)
-    se = np.std(total_reward, ddof=1) / np.sqrt(len(trajectories))
+from pirl.trajectories import TrajectoryBatch
+
+def _summary_stats(returns):
+    '''Returns the mean and standard error of returns, one per episode.'''
+    mean = np.mean(returns)
+    se = np.std(returns, ddof=1) / np.sqrt(len(returns))
     return mean, se
 
 
-def value(sample, envs, policy, discount, seed, num_episodes=100):
+def value(sample, envs, policy, discount, seed, num_episodes=100,
+          target_se=None, min_episodes=20):
     '''Test policy saved in blog_dir on num_episodes in env.
-        Return average reward.'''
-    trajs = sample(envs, policy, num_episodes, seed)
-    return _summary_stats(trajs, discount)
+        Return (mean, se, episodes): the average reward, its standard error
+        and the number of episodes sampled.
+        sample must return discounted returns when given discount.
+
+        If target_se is not None, samples sequentially: first min_episodes,
+        then in further batches until the standard error is at most
+        target_se, or num_episodes have been sampled.'''
+    if target_se is None:
+        returns = sample(envs, policy, num_episodes, seed, discount=discount)
+        return (*_summary_stats(returns), len(returns))
+
+    returns = sample(envs, policy, min(min_episodes, num_episodes), seed,
+                     discount=discount)
+    batch = 1
+    while len(returns) < num_episodes:
+        _mean, se = _summary_stats(returns)
+        if se <= target_se:
+            break
+        # Episodes needed in total, if the estimated std. dev. is accurate
+        needed = int(np.ceil(len(returns) * (se / target_se) ** 2))
+        size = max(needed - len(returns), min_episodes)
+        size = min(size, num_episodes - len(returns))
+        # Each batch is sampled with a fresh graph, so needs a fresh seed
+        more = sample(envs, policy, size, seed + batch, discount=discount)
+        returns = np.concatenate([returns, more])
+        batch += 1
+    return (*_summary_stats(returns), len(returns))
 
 
 class SampleMonitor(gym.Wrapper):
@@ -51,16 +74,26 @@ class SampleMonitor(gym.Wrapper):
     def trajectories(self):
         return self._trajectories
 
+    @property
+    def batch(self):
+        '''Completed trajectories, as a TrajectoryBatch.'''
+        return TrajectoryBatch.from_episodes(self._trajectories)
+
 class SampleVecMonitor(VecEnvWrapper):
-    def __init__(self, venv, trajectories=None):
+    def __init__(self, venv, trajectories=None, deferred=False):
         '''Takes a vector environment venv and an empty collection trajectories;
            trajectories are then stored in the collection. For most use cases,
            the default of trajectories as an empty list is sufficient; in some
-           cases, other data structures e.g. a ring-buffer may be useful.'''
+           cases, other data structures e.g. a ring-buffer may be useful.
+
+           If deferred, rewards from venv are placeholders: trajectories are
+           only stored once their rewards are filled in by relabel.'''
         if trajectories is None:
             trajectories = []
         assert len(trajectories) == 0
         self._trajectories = trajectories
+        self.deferred = deferred
+        self._unlabeled = []  # (env index, trajectory) awaiting relabel
         self.observations = None
         self.actions = None
         self.rewards = None
@@ -77,8 +110,10 @@ class SampleVecMonitor(VecEnvWrapper):
             self.rewards[i].append(r)
             if d:
                 traj = (self.observations[i], self.actions[i], self.rewards[i])
-                traj = tuple(np.array(x) for x in traj)
-                self._trajectories.append(traj)
+                if self.deferred:
+                    self._unlabeled.append((i, traj))
+                else:
+                    self._trajectories.append(tuple(np.array(x) for x in traj))
                 self.observations[i] = [o]
                 self.actions[i] = []
                 self.rewards[i] = []
@@ -86,6 +121,24 @@ class SampleVecMonitor(VecEnvWrapper):
                 self.observations[i].append(o)
         return obs, rews, dones, infos
 
+    def relabel(self, rewards):
+        '''Replaces the rewards of the last len(rewards) steps by rewards, of
+           shape (steps, num_envs). Stores trajectories completed in them.'''
+        assert self.deferred
+        steps = len(rewards)
+        for i in range(self.num_envs):
+            # Reward lists covering env i's steps, oldest first
+            segments = [traj[2] for j, traj in self._unlabeled if j == i]
+            segments.append(self.rewards[i])
+            end = steps
+            for segment in reversed(segments):
+                k = min(len(segment), end)
+                segment[len(segment) - k:] = rewards[end - k:end, i]
+                end -= k
+        for _i, traj in self._unlabeled:
+            self._trajectories.append(tuple(np.array(x) for x in traj))
+        self._unlabeled = []
+
     def reset(self):
         obs = self.venv.reset()
         num_envs = len(obs)
@@ -98,4 +151,105 @@ class SampleVecMonitor(VecEnvWrapper):
 
     @property
     def trajectories(self):
-        return self._trajectories
\ No newline at end of file
+        return self._trajectories
+
+    @property
+    def batch(self):
+        '''Completed trajectories, as a TrajectoryBatch.'''
+        return TrajectoryBatch.from_episodes(self._trajectories)
+
+
+class VecEvaluator(VecEnvWrapper):
+    def __init__(self, venv, num_episodes, discount=None):
+        '''Samples exactly num_episodes episodes from venv. Episodes are split
+           between environments in fixed quotas. Each environment counts its
+           first episodes up to its quota, and is then masked: this avoids
+           over-representing short episodes, which complete first. Step venv
+           until finished.
+
+           If discount is None, trajectories are recorded (see batch).
+           Otherwise, only discounted returns are accumulated (see returns).'''
+        super(VecEvaluator, self).__init__(venv)
+        num_envs = venv.num_envs
+        self.quotas = np.full(num_envs, num_episodes // num_envs)
+        self.quotas[:num_episodes % num_envs] += 1
+        self.counts = np.zeros(num_envs, dtype=np.int64)
+        self.discount = discount
+        self._returns = []
+        self._running = np.zeros(num_envs)
+        self._weights = np.ones(num_envs)
+        self._trajectories = []
+        self.observations = None
+        self.actions = None
+        self.rewards = None
+
+    @property
+    def recording(self):
+        return self.discount is None
+
+    @property
+    def active(self):
+        '''Mask of environments yet to meet their quota.'''
+        return self.counts < self.quotas
+
+    @property
+    def finished(self):
+        return not np.any(self.active)
+
+    def step_async(self, actions):
+        if self.recording:
+            for i in np.flatnonzero(self.active):
+                self.actions[i].append(actions[i])
+        return self.venv.step_async(actions)
+
+    def step_wait(self):
+        obs, rews, dones, infos = self.venv.step_wait()
+        dones = np.asarray(dones, dtype=bool)
+        active = self.active
+        if not self.recording:
+            self._running += np.where(active, self._weights * rews, 0)
+            self._weights *= self.discount
+        for i in np.flatnonzero(active):
+            if self.recording:
+                self.rewards[i].append(rews[i])
+            if dones[i]:
+                self.counts[i] += 1
+                if self.recording:
+                    traj = (self.observations[i], self.actions[i],
+                            self.rewards[i])
+                    self._trajectories.append(tuple(np.array(x) for x in traj))
+                    self.observations[i] = [obs[i]]
+                    self.actions[i] = []
+                    self.rewards[i] = []
+                else:
+                    self._returns.append(self._running[i])
+            elif self.recording:
+                self.observations[i].append(obs[i])
+        self._running[dones] = 0
+        self._weights[dones] = 1
+        return obs, rews, dones, infos
+
+    def reset(self):
+        obs = self.venv.reset()
+        self._running[:] = 0
+        self._weights[:] = 1
+        self.observations = [[o] for o in obs]
+        self.actions = [[] for _o in obs]
+        self.rewards = [[] for _o in obs]
+        return obs
+
+    @property
+    def returns(self):
+        '''Discounted return of each completed episode.'''
+        assert not self.recording
+        return np.array(self._returns)
+
+    @property
+    def batch(self):
+        '''Completed trajectories, as a TrajectoryBatch.'''
+        assert self.recording
+        return TrajectoryBatch.from_episodes(self._trajectories)
+
+    def result(self):
+        '''Returns batch if recording, otherwise returns.'''
+        return self.batch if self.recording else self.returns
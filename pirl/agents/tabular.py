@@ -2,6 +2,7 @@ import gym
 from gym.utils import seeding
 import numpy as np
 
+from pirl.trajectories import TrajectoryBatch
 from pirl.utils import discrete_sample, getattr_unwrapped
 
 def q_iteration(transition, reward, horizon, discount,
@@ -118,7 +119,7 @@ def sample(env, policy, num_episodes, seed):
             rewards.append(reward)
         return np.array(states), np.array(actions), np.array(rewards)
 
-    return [helper() for i in range(num_episodes)]
+    return TrajectoryBatch.from_episodes([helper() for i in range(num_episodes)])
 
 
 class TabularRewardWrapper(gym.Wrapper):
@@ -0,0 +1,150 @@
+'''Content-addressed store for large cached values.
+
+Cached values such as PPO checkpoints or expert trajectories can be large.
+Rather than storing them whole in the cache backend (e.g. in Redis RAM),
+BlobStore.put writes them to disk, named by a digest of their content, and
+returns a small BlobRef that is cached in their place. Identical payloads
+are stored once.
+
+NumPy arrays are stored uncompressed in .npy format, so they can be read
+back with zero copies via mmap, including arrays inside tuples, lists and
+dicts. Other values are pickled and compressed.'''
+
+from collections import namedtuple, OrderedDict
+import hashlib
+import io
+import os
+import os.path as osp
+import pickle
+import zlib
+
+import numpy as np
+
+from pirl.utils import atomic_write
+
+BlobRef = namedtuple('BlobRef', ['digest', 'format', 'size'])
+BlobRef.__doc__ = '''\
+Pointer to a value in a BlobStore. format is 'npy' or 'pkl.z';
+size is the uncompressed size of the value in bytes.'''
+
+# Containers that put and get recurse into. Other types, including
+# subclasses such as namedtuples, are pickled whole.
+_CONTAINERS = (tuple, list, dict, OrderedDict)
+# Rough size of a pickled BlobRef
+_REF_SIZE = 100
+
+
+class BlobStore(object):
+    def __init__(self, path, threshold=2**20, compress_level=1):
+        '''Values that serialize to more than threshold bytes are stored
+           under directory path.'''
+        self.path = path
+        self.threshold = threshold
+        self.compress_level = compress_level
+
+    def blob_path(self, ref):
+        return osp.join(self.path, ref.digest[:2],
+                        '{}.{}'.format(ref.digest, ref.format))
+
+    def put(self, value):
+        '''Returns value if it is small, otherwise stores it and returns
+           a BlobRef to it. Large arrays in tuples, lists and dicts are
+           stored individually, and replaced by BlobRefs in a copy of their
+           container.'''
+        return self._put(value)[0]
+
+    def _put(self, value):
+        '''Returns (stored, size): value as put returns it, and an estimate
+           of the pickled size of stored.'''
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            if value.nbytes <= self.threshold:
+                return value, value.nbytes
+            buf = io.BytesIO()
+            np.lib.format.write_array(buf, value, allow_pickle=False)
+            data = buf.getvalue()
+            return self._store(data, data, 'npy'), _REF_SIZE
+
+        if type(value) in _CONTAINERS:
+            if isinstance(value, dict):
+                items = [(k, self._put(v)) for k, v in value.items()]
+                stored = type(value)((k, v) for k, (v, _size) in items)
+                parts = [v for _k, v in items]
+                originals = list(value.values())
+            else:
+                parts = [self._put(x) for x in value]
+                stored = type(value)(x for x, _size in parts)
+                originals = value
+            changed = any(x is not y for (x, _size), y in zip(parts, originals))
+            if not changed:
+                stored = value
+            size = sum(size for _x, size in parts) + 8 * len(parts)
+            # Containers holding BlobRefs are kept inline, so references
+            # finds the blobs they point to without loading any blobs.
+            if size <= self.threshold or references(stored):
+                return stored, size
+        elif isinstance(value, (bool, int, float, type(None))):
+            return value, 8
+
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) <= self.threshold:
+            return value, len(data)
+        return self._store(data, None, 'pkl.z'), _REF_SIZE
+
+    def _store(self, data, payload, fmt):
+        '''Stores data (as payload, if not None, otherwise compressed),
+           returning a BlobRef to it.'''
+        ref = BlobRef(hashlib.sha1(data).hexdigest(), fmt, len(data))
+        path = self.blob_path(ref)
+        if not osp.exists(path):  # identical payloads are stored once
+            if payload is None:
+                payload = zlib.compress(data, self.compress_level)
+            atomic_write(path, payload)
+        return ref
+
+    def get(self, value, mmap=True):
+        '''Inverse of put: loads value if it is a BlobRef, otherwise returns
+           it unchanged. If mmap, NumPy arrays are memory-mapped copy-on-write:
+           pages are read on demand, and writes do not modify the store.'''
+        if type(value) in _CONTAINERS:
+            if isinstance(value, dict):
+                return type(value)((k, self.get(v, mmap))
+                                   for k, v in value.items())
+            return type(value)(self.get(x, mmap) for x in value)
+        if not isinstance(value, BlobRef):
+            return value
+        path = self.blob_path(value)
+        if value.format == 'npy':
+            if not mmap:
+                return np.load(path)
+            # View as a plain ndarray (no copy): np.memmap does not
+            # survive serialization (e.g. by Ray) well.
+            return np.asarray(np.load(path, mmap_mode='c'))
+        with open(path, 'rb') as f:
+            return pickle.loads(zlib.decompress(f.read()))
+
+    def contains(self, ref):
+        return osp.exists(self.blob_path(ref))
+
+
+def references(value):
+    '''Returns the BlobRefs in value: value itself, or those in it if it is
+       a tuple, list or dict (e.g. the (result, log_dir) cached by
+       cache_and_log).'''
+    if isinstance(value, BlobRef):
+        return [value]
+    if type(value) in _CONTAINERS:
+        if isinstance(value, dict):
+            value = value.values()
+        return [ref for x in value for ref in references(x)]
+    return []
+
+
+def get_blob_store():
+    '''Returns the BlobStore under CACHE_DIR, creating it if needed.'''
+    if get_blob_store.store is None:
+        # Imported here to avoid a circular import
+        from pirl import config
+        path = os.environ.get('CACHE_DIR', config.CACHE_DIR)
+        get_blob_store.store = BlobStore(osp.join(path, 'cas'))
+    return get_blob_store.store
+get_blob_store.store = None
@@ -0,0 +1,293 @@
+'''Embedded on-disk backend for hermes.Hermes.
+
+A local stand-in for Redis: persistent caching on a single machine, with no
+extra service to run. An SQLite index (in WAL mode, so readers do not block
+writers) maps keys to values. Small values are stored inline in the index,
+large values in blob files under the cache directory, so they need not fit
+in RAM. Writes are atomic: blob files are written to a temporary file and
+renamed into place before the index is updated in a single transaction.
+
+Tags are handled by hermes.Hermes (they are stored as ordinary entries),
+so scripts/invalidate_cache.py works unchanged.
+
+The cache can be bounded by a byte budget, max_bytes. When it is exceeded,
+entries are evicted in least-recently-used or least-frequently-used order
+(policy 'lru' or 'lfu'). Sizes count only the bytes this backend stores:
+inline values and its own blob files, which eviction removes. Blobs in the
+BlobStore (see pirl.blobs) and log directories in OBJECT_DIR referenced by
+evicted entries stay on disk, since other entries may share them: run
+scripts/cache_gc.py after eviction to delete those no longer referenced.
+Tag entries are never evicted, since that would invalidate every entry
+carrying the tag.
+
+Note SQLite locking is unreliable on network filesystems (e.g. NFS/EFS):
+use the Redis backend for multi-machine clusters.'''
+
+import fcntl
+import hashlib
+import logging
+import os
+import os.path as osp
+import shutil
+import sqlite3
+import time
+import uuid
+
+from hermes.backend import AbstractBackend, AbstractLock
+
+from pirl.utils import atomic_write
+
+logger = logging.getLogger('pirl.cache_backend')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB,
+    path TEXT,
+    size INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0
+)'''
+# Columns added since the first version of SCHEMA
+MIGRATIONS = {
+    'accessed': 'ALTER TABLE entries ADD COLUMN '
+                'accessed REAL NOT NULL DEFAULT 0',
+    'hits': 'ALTER TABLE entries ADD COLUMN hits INTEGER NOT NULL DEFAULT 0',
+}
+EVICTION_ORDER = {
+    'lru': 'accessed',
+    'lfu': 'hits, accessed',
+}
+
+
+class FileLock(AbstractLock):
+    '''Inter-process lock, using flock on a file named after key.'''
+    def __init__(self, key, lock_dir):
+        super().__init__(key)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self._path = osp.join(lock_dir, digest)
+        self._file = None
+
+    def acquire(self, wait=True):
+        os.makedirs(osp.dirname(self._path), exist_ok=True)
+        self._file = open(self._path, 'a')
+        flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._file, flags)
+            return True
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class Backend(AbstractBackend):
+    '''hermes.Hermes backend storing entries under directory path.
+       Values larger than inline_limit bytes (after serialization) are
+       stored in separate blob files. If max_bytes is not None, entries are
+       evicted according to policy ('lru' or 'lfu') to stay within it.'''
+    def __init__(self, mangler, *, path, inline_limit=2**20,
+                 max_bytes=None, policy='lru'):
+        super().__init__(mangler)
+        if policy not in EVICTION_ORDER:
+            raise ValueError("Unknown eviction policy '{}'".format(policy))
+        self.path = path
+        self.inline_limit = inline_limit
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._tag_prefix = mangler.nameTag('')
+        self._index_path = osp.join(path, 'index.sqlite')
+        self._blob_dir = osp.join(path, 'blobs')
+        self._lock_dir = osp.join(path, 'locks')
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Connections cannot be pickled (or shared across processes),
+        # so reconnect on first use after unpickling.
+        state = dict(self.__dict__)
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(self.path, exist_ok=True)
+            conn = sqlite3.connect(self._index_path, timeout=600)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(entries)')]
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def lock(self, key):
+        return FileLock(key, self._lock_dir)
+
+    def _blob_path(self):
+        name = uuid.uuid4().hex
+        return osp.join(self._blob_dir, name[:2], name)
+
+    def _unlink_blobs(self, paths):
+        for path in paths:
+            if path is None:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def save(self, key=None, value=None, mapping=None, ttl=None):
+        if not mapping:
+            mapping = {key: value}
+        now = time.time()
+        expires = None if not ttl else now + ttl
+
+        rows = []
+        for k, v in mapping.items():
+            data = self.mangler.dumps(v)
+            size = len(data)
+            if len(data) > self.inline_limit:
+                path = self._blob_path()
+                atomic_write(path, data)
+                rows.append((k, None, path, size, expires, now))
+            else:
+                rows.append((k, data, None, size, expires, now))
+
+        old_paths = []
+        with self.conn as conn:
+            for row in rows:
+                cur = conn.execute('SELECT path FROM entries WHERE key = ?',
+                                   (row[0], ))
+                old_paths += [path for (path, ) in cur]
+                conn.execute('INSERT OR REPLACE INTO entries '
+                             '(key, value, path, size, expires, accessed) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', row)
+        self._unlink_blobs(old_paths)
+
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def _load_row(self, key, value, path, expires):
+        if expires is not None and expires < time.time():
+            return None
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    value = f.read()
+            except FileNotFoundError:
+                # Entry overwritten or removed since we queried the index
+                logger.debug('Blob %s for %s vanished, treating as miss',
+                             path, key)
+                return None
+        return self.mangler.loads(value)
+
+    def load(self, keys):
+        single = isinstance(keys, str)
+        if single:
+            keys = [keys]
+        keys = list(keys)
+
+        res = {}
+        # Stay within SQLite's default limit on the number of parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join(['?'] * len(chunk))
+            cur = self.conn.execute('SELECT key, value, path, expires '
+                                    'FROM entries WHERE key IN ({})'.format(
+                                    placeholders), chunk)
+            hits = []
+            for key, value, path, expires in cur.fetchall():
+                value = self._load_row(key, value, path, expires)
+                if value is not None:
+                    res[key] = value
+                    hits.append(key)
+            if hits:
+                with self.conn as conn:
+                    placeholders = ','.join(['?'] * len(hits))
+                    conn.execute('UPDATE entries SET accessed = ?, '
+                                 'hits = hits + 1 WHERE key IN ({})'.format(
+                                 placeholders), [time.time()] + hits)
+
+        if single:
+            return res.get(keys[0])
+        return res
+
+    def exists(self, keys):
+        '''Returns a list of booleans: whether each of keys is present.'''
+        keys = list(keys)
+        present = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join(['?'] * len(chunk))
+            cur = self.conn.execute('SELECT key FROM entries WHERE key IN ({}) '
+                                    'AND (expires IS NULL OR expires >= ?)'
+                                    .format(placeholders),
+                                    chunk + [time.time()])
+            present.update(key for (key, ) in cur)
+        return [k in present for k in keys]
+
+    def remove(self, keys):
+        if isinstance(keys, str):
+            keys = [keys]
+        paths = []
+        with self.conn as conn:
+            for key in keys:
+                cur = conn.execute('SELECT path FROM entries WHERE key = ?',
+                                   (key, ))
+                paths += [path for (path, ) in cur]
+                conn.execute('DELETE FROM entries WHERE key = ?', (key, ))
+        self._unlink_blobs(paths)
+
+    def _evictable(self):
+        '''SQL condition excluding tag entries.'''
+        return "key NOT LIKE '{}%'".format(self._tag_prefix.replace("'", "''"))
+
+    def sizes(self):
+        '''Returns a dict mapping each key (excluding tags) to its size.'''
+        cur = self.conn.execute('SELECT key, size FROM entries WHERE '
+                                + self._evictable())
+        return dict(cur.fetchall())
+
+    def evict(self, max_bytes, low_water=0.9):
+        '''If entries total more than max_bytes, evicts entries (according to
+           self.policy) until they total at most low_water * max_bytes.
+           Returns the keys evicted.'''
+        where = self._evictable()
+        (total, ) = self.conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                      'FROM entries WHERE ' + where).fetchone()
+        if total <= max_bytes:
+            return []
+
+        target = total - low_water * max_bytes
+        order = EVICTION_ORDER[self.policy]
+        cur = self.conn.execute('SELECT key, size FROM entries WHERE {} '
+                                'ORDER BY {}'.format(where, order))
+        keys = []
+        freed = 0
+        for key, size in cur.fetchall():
+            if freed >= target:
+                break
+            keys.append(key)
+            freed += size
+        logger.info('Evicting %d entries (%d bytes) to stay within %d bytes',
+                    len(keys), freed, max_bytes)
+        self.remove(keys)
+        return keys
+
+    def clean(self):
+        with self.conn as conn:
+            conn.execute('DELETE FROM entries')
+        shutil.rmtree(self._blob_dir, ignore_errors=True)
@@ -1,16 +1,20 @@
 import logging.config
 import numpy as np
 
-from pirl.config import types
+from pirl.config import registry, types
 from pirl.config.config import RL_ALGORITHMS, SINGLE_IRL_ALGORITHMS, \
-        POPULATION_IRL_ALGORITHMS, EXPERIMENTS, LOG_CFG, TENSORFLOW, \
-        RAY_SERVER, PROJECT_DIR, EXPERIMENTS_DIR, OBJECT_DIR, CACHE_DIR
+        POPULATION_IRL_ALGORITHMS, EXPERIMENTS, LOG_CFG, make_tf_config, \
+        RAY_SERVER, PROJECT_DIR, EXPERIMENTS_DIR, OBJECT_DIR, CACHE_DIR, \
+        INFERENCE_SOCKET
 
 types.validate_config(RL_ALGORITHMS,
                       SINGLE_IRL_ALGORITHMS,
                       POPULATION_IRL_ALGORITHMS)
-EXPERIMENTS = {k: types.parse_config(k, v,
-                                     RL_ALGORITHMS,
-                                     SINGLE_IRL_ALGORITHMS,
-                                     POPULATION_IRL_ALGORITHMS)
-               for k, v in EXPERIMENTS.items()}
\ No newline at end of file
+# Experiments are parsed (and validated) when first looked up
+_EXPERIMENTS = EXPERIMENTS
+EXPERIMENTS = registry.Registry()
+for k, v in _EXPERIMENTS.items():
+    EXPERIMENTS.register(k, types.parse_config, k, v,
+                         RL_ALGORITHMS,
+                         SINGLE_IRL_ALGORITHMS,
+                         POPULATION_IRL_ALGORITHMS)
@@ -1,17 +1,20 @@
 import functools
-import itertools
 import os.path as osp
 
-import tensorflow as tf
-from airl import envs  # used for side-effects (register Gym environments)
-
-from pirl import agents, irl
+from pirl.config import registry
 from pirl.config.types import RLAlgorithm, IRLAlgorithm, MetaIRLAlgorithm
+from pirl.trajectories import concatenate
 
 # Overrideable defaults
 PROJECT_DIR = osp.dirname(osp.dirname(osp.dirname(osp.realpath(__file__))))
 DATA_DIR = osp.join(PROJECT_DIR, 'data')
 RAY_SERVER = None # Scheduler IP
+# If not None, sampled values are estimated sequentially, stopping once the
+# standard error is below this (see pirl.agents.sample.value)
+VALUE_TARGET_SE = None
+# If not None, Unix socket of a shared InferenceServer (see pirl.inference),
+# used to evaluate PPO policies
+INFERENCE_SOCKET = None
 
 try:
     from pirl.config.config_local import *
@@ -27,10 +30,12 @@ CACHE_DIR = osp.join(DATA_DIR, 'cache')
 # ML Framework Config
 
 def make_tf_config():
+    # Imported here so that processes using only tabular algorithms
+    # never import TensorFlow.
+    import tensorflow as tf
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     return config
-TENSORFLOW = make_tf_config()
 
 # Logging
 LOG_CFG = {
@@ -57,95 +62,113 @@ LOG_CFG = {
         }
     }
 
+# Algorithms are registered lazily: the factories below import their
+# dependencies, and are only called when an algorithm is first looked up.
+# Classes and functions in the registered arguments are given by import path
+# (see registry.load), and are resolved by the factories.
+
+def _load_cfg(cfg, key):
+    '''Returns a copy of cfg with cfg[key] resolved by registry.load.'''
+    if cfg is None or key not in cfg:
+        return cfg
+    cfg = dict(cfg)
+    cfg[key] = registry.load(cfg[key])
+    return cfg
+
+def _load_airl_kwargs(kwargs):
+    kwargs = dict(kwargs)
+    for k, cls_key in [('model_cfg', 'model'), ('policy_cfg', 'policy')]:
+        if k in kwargs:
+            kwargs[k] = _load_cfg(kwargs[k], cls_key)
+    return kwargs
+
 # RL Algorithms
 
-RL_ALGORITHMS = {
-    'value_iteration': RLAlgorithm(
-        train=agents.tabular.policy_env_wrapper(agents.tabular.q_iteration_policy),
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
-        vectorized=False,
-        uses_gpu=False,
-    ),
-    'max_ent': RLAlgorithm(
-        train=agents.tabular.policy_env_wrapper(irl.tabular_maxent.max_ent_policy),
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
+def tabular_rl(planner):
+    from pirl.agents import tabular
+    return RLAlgorithm(
+        train=tabular.policy_env_wrapper(registry.load(planner)),
+        sample=tabular.sample,
+        value=tabular.value_in_mdp,
         vectorized=False,
         uses_gpu=False,
-    ),
-    'max_causal_ent': RLAlgorithm(
-        train=agents.tabular.policy_env_wrapper(irl.tabular_maxent.max_causal_ent_policy),
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
-        vectorized=False,
-        uses_gpu=False,
-    ),
-}
+    )
 
-def ppo_cts_pol(num_timesteps):
-    train = functools.partial(agents.ppo.train_continuous,
-                              tf_config=TENSORFLOW,
-                              num_timesteps=num_timesteps)
-    sample = functools.partial(agents.ppo.sample, tf_config=TENSORFLOW)
-    value = functools.partial(agents.sample.value, sample)
+RL_ALGORITHMS = registry.Registry(RLAlgorithm)
+RL_ALGORITHMS.register('value_iteration', tabular_rl,
+                       'pirl.agents.tabular:q_iteration_policy')
+RL_ALGORITHMS.register('max_ent', tabular_rl,
+                       'pirl.irl.tabular_maxent:max_ent_policy')
+RL_ALGORITHMS.register('max_causal_ent', tabular_rl,
+                       'pirl.irl.tabular_maxent:max_causal_ent_policy')
+
+def ppo_cts_pol(num_timesteps, patience=None, min_improvement=0.01):
+    from pirl import agents
+    from pirl.agents import ppo
+    tf_config = make_tf_config()
+    train = functools.partial(ppo.train_continuous,
+                              tf_config=tf_config,
+                              num_timesteps=num_timesteps,
+                              patience=patience,
+                              min_improvement=min_improvement)
+    sample = functools.partial(ppo.sample, tf_config=tf_config,
+                               inference=INFERENCE_SOCKET)
+    value = functools.partial(agents.sample.value, sample,
+                              target_se=VALUE_TARGET_SE)
     return RLAlgorithm(train=train,
                        sample=sample,
                        value=value,
                        vectorized=True,
                        uses_gpu=True)
-RL_ALGORITHMS['ppo_cts'] = ppo_cts_pol(1e6)
-RL_ALGORITHMS['ppo_cts_500k'] = ppo_cts_pol(5e5)
-RL_ALGORITHMS['ppo_cts_200k'] = ppo_cts_pol(2e5)
-RL_ALGORITHMS['ppo_cts_short'] = ppo_cts_pol(1e5)
-RL_ALGORITHMS['ppo_cts_shortest'] = ppo_cts_pol(1e4)
+RL_ALGORITHMS.register('ppo_cts', ppo_cts_pol, 1e6)
+RL_ALGORITHMS.register('ppo_cts_500k', ppo_cts_pol, 5e5)
+RL_ALGORITHMS.register('ppo_cts_200k', ppo_cts_pol, 2e5)
+RL_ALGORITHMS.register('ppo_cts_short', ppo_cts_pol, 1e5)
+RL_ALGORITHMS.register('ppo_cts_shortest', ppo_cts_pol, 1e4)
+# Budget is an upper bound: stop once mean reward plateaus for patience steps
+RL_ALGORITHMS.register('ppo_cts_adaptive', ppo_cts_pol, 1e6, patience=2e5)
+RL_ALGORITHMS.register('ppo_cts_adaptive_short', ppo_cts_pol, 1e5,
+                       patience=2e4)
 
 # IRL Algorithms
 
 ## Single environment IRL algorithms (not population)
 
-SINGLE_IRL_ALGORITHMS = {
-    # Maximum Causal Entropy (Ziebart 2010)
-    'mce': IRLAlgorithm(
-        train=irl.tabular_maxent.irl,
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
-        vectorized=False,
-        uses_gpu=False,
-    ),
-    'mce_shortest': IRLAlgorithm(
-        train=functools.partial(irl.tabular_maxent.irl, num_iter=500),
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
+def tabular_irl(**kwargs):
+    from pirl.agents import tabular
+    from pirl.irl import tabular_maxent
+    if 'planner' in kwargs:
+        kwargs['planner'] = registry.load(kwargs['planner'])
+    return IRLAlgorithm(
+        train=functools.partial(tabular_maxent.irl, **kwargs),
+        reward_wrapper=tabular.TabularRewardWrapper,
+        sample=tabular.sample,
+        value=tabular.value_in_mdp,
         vectorized=False,
         uses_gpu=False,
-    ),
-    # Maximum Entropy (Ziebart 2008)
-    'me': IRLAlgorithm(
-        train=functools.partial(irl.tabular_maxent.irl,
-                                planner=irl.tabular_maxent.max_ent_policy),
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
-        vectorized=False,
-        uses_gpu=False,
-    ),
-}
+    )
+
+SINGLE_IRL_ALGORITHMS = registry.Registry(IRLAlgorithm)
+# Maximum Causal Entropy (Ziebart 2010)
+SINGLE_IRL_ALGORITHMS.register('mce', tabular_irl)
+SINGLE_IRL_ALGORITHMS.register('mce_shortest', tabular_irl, num_iter=500)
+# Maximum Entropy (Ziebart 2008)
+SINGLE_IRL_ALGORITHMS.register('me', tabular_irl,
+                               planner='pirl.irl.tabular_maxent:max_ent_policy')
 
-from airl.models.imitation_learning import AIRLStateAction
 AIRL_ALGORITHMS = {
     'so': dict(),
     'so_ent': dict(training_cfg={'entropy_weight': 1.0}),
-    'sa': dict(model_cfg={'model': irl.airl.AIRLStateAction, 'max_itrs': 10}),
-    'sa_ent': dict(model_cfg={'model': irl.airl.AIRLStateAction, 'max_itrs': 10},
+    'sa': dict(model_cfg={'model': 'pirl.irl.airl:AIRLStateAction',
+                          'max_itrs': 10}),
+    'sa_ent': dict(model_cfg={'model': 'pirl.irl.airl:AIRLStateAction',
+                              'max_itrs': 10},
                    training_cfg={'entropy_weight': 1.0}),
-    'random': dict(policy_cfg={'policy': irl.airl.GaussianPolicy}),
+    'random': dict(policy_cfg={'policy': 'pirl.irl.airl:GaussianPolicy'}),
     # parameters to match scripts/pendulum_irl.py from adversarial-irl
     'orig_pendulum': {
         'model_cfg': {
-            'model': irl.airl.AIRLStateAction,
+            'model': 'pirl.irl.airl:AIRLStateAction',
             'max_itrs': 100,
         },
         'training_cfg': {
@@ -161,9 +184,33 @@ AIRL_ITERATIONS = {None: 1000,
                    'shorter': 50,
                    'shortest': 25,
                    'dummy': 2}
-airl_reward = functools.partial(irl.airl.airl_reward_wrapper, tf_cfg=TENSORFLOW)
-airl_sample = functools.partial(irl.airl.sample, tf_cfg=TENSORFLOW)
-airl_value = functools.partial(agents.sample.value, airl_sample)
+
+def _airl_common(tf_config):
+    from pirl import agents
+    from pirl.irl import airl
+    # PPO, the only vectorized RL algorithm, relabels rewards in batches
+    airl_reward = functools.partial(airl.airl_reward_wrapper, tf_cfg=tf_config,
+                                    deferred=True)
+    airl_sample = functools.partial(airl.sample, tf_cfg=tf_config)
+    airl_value = functools.partial(agents.sample.value, airl_sample,
+                                   target_se=VALUE_TARGET_SE)
+    return airl_reward, airl_sample, airl_value
+
+def airl_irl(**kwargs):
+    from pirl.irl import airl
+    tf_config = make_tf_config()
+    airl_reward, airl_sample, airl_value = _airl_common(tf_config)
+    train = functools.partial(airl.irl, tf_cfg=tf_config,
+                              **_load_airl_kwargs(kwargs))
+    return IRLAlgorithm(
+        train=train,
+        reward_wrapper=airl_reward,
+        sample=airl_sample,
+        value=airl_value,
+        vectorized=True,
+        uses_gpu=True,
+    )
+
 for k, kwargs in AIRL_ALGORITHMS.items():
     for k2, v2 in AIRL_ITERATIONS.items():
         name = 'airl_{}'.format(k)
@@ -176,49 +223,50 @@ for k, kwargs in AIRL_ALGORITHMS.items():
             training_cfg['n_itr'] = v2
             kwds['training_cfg'] = training_cfg
 
-        train = functools.partial(irl.airl.irl, tf_cfg=TENSORFLOW, **kwds)
-        SINGLE_IRL_ALGORITHMS[name] = IRLAlgorithm(
-            train=train,
-            reward_wrapper=airl_reward,
-            sample=airl_sample,
-            value=airl_value,
-            vectorized=True,
-            uses_gpu=True,
-        )
-
-gail_train = functools.partial(irl.gail.irl, tf_cfg=TENSORFLOW)
-gail_sample = functools.partial(irl.gail.sample, tf_cfg=TENSORFLOW)
-#TODO: gail default is 5e6, so check 1e6 doesn't hurt performance
-for k, max_it in {'': 5e6, '_short': 1e6, '_shortest': 1e4}.items():
-    train = functools.partial(gail_train, train_cfg={'max_timesteps': max_it})
-    SINGLE_IRL_ALGORITHMS['gail' + k] = IRLAlgorithm(
+        SINGLE_IRL_ALGORITHMS.register(name, airl_irl, **kwds)
+
+def gail_irl(max_timesteps):
+    from pirl import agents
+    from pirl.irl import gail
+    tf_config = make_tf_config()
+    gail_sample = functools.partial(gail.sample, tf_cfg=tf_config)
+    train = functools.partial(gail.irl, tf_cfg=tf_config,
+                              train_cfg={'max_timesteps': max_timesteps})
+    return IRLAlgorithm(
         train=train,
         reward_wrapper=None,
         sample=gail_sample,
-        value=functools.partial(agents.sample.value, gail_sample),
+        value=functools.partial(agents.sample.value, gail_sample,
+                                target_se=VALUE_TARGET_SE),
         vectorized=False,
         uses_gpu=True,
     )
 
+#TODO: gail default is 5e6, so check 1e6 doesn't hurt performance
+for k, max_it in {'': 5e6, '_short': 1e6, '_shortest': 1e4}.items():
+    SINGLE_IRL_ALGORITHMS.register('gail' + k, gail_irl, max_it)
+
 ## Population IRL algorithms
 
-POPULATION_IRL_ALGORITHMS = dict()
+POPULATION_IRL_ALGORITHMS = registry.Registry(MetaIRLAlgorithm)
 def pop_maxent(**kwargs):
+    from pirl.agents import tabular
+    from pirl.irl import tabular_maxent
     return MetaIRLAlgorithm(
-        metalearn=functools.partial(irl.tabular_maxent.metalearn, **kwargs),
-        finetune=functools.partial(irl.tabular_maxent.finetune, **kwargs),
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
-        sample=agents.tabular.sample,
-        value=agents.tabular.value_in_mdp,
+        metalearn=functools.partial(tabular_maxent.metalearn, **kwargs),
+        finetune=functools.partial(tabular_maxent.finetune, **kwargs),
+        reward_wrapper=tabular.TabularRewardWrapper,
+        sample=tabular.sample,
+        value=tabular.value_in_mdp,
         vectorized=False,
         uses_gpu=False,
     )
 for reg in range(-4,3):
-    algo = pop_maxent(regularize=10**reg)
-    POPULATION_IRL_ALGORITHMS['mcep_reg1e{}'.format(reg)] = algo
-POPULATION_IRL_ALGORITHMS['mcep_reg0'] = pop_maxent(regularize=0)
-POPULATION_IRL_ALGORITHMS['mcep_shortest_reg0'] = pop_maxent(regularize=0,
-                                                             num_iter=500)
+    POPULATION_IRL_ALGORITHMS.register('mcep_reg1e{}'.format(reg),
+                                       pop_maxent, regularize=10**reg)
+POPULATION_IRL_ALGORITHMS.register('mcep_reg0', pop_maxent, regularize=0)
+POPULATION_IRL_ALGORITHMS.register('mcep_shortest_reg0', pop_maxent,
+                                   regularize=0, num_iter=500)
 
 AIRLP_ALGORITHMS = {
     # 3-tuple with elements:
@@ -226,7 +274,8 @@ AIRLP_ALGORITHMS = {
     # - metalearn only
     # - finetune only
     'random': (dict(),
-               dict(policy_per_task=False, policy_cfg={'policy': irl.airl.GaussianPolicy}),
+               dict(policy_per_task=False,
+                    policy_cfg={'policy': 'pirl.irl.airl:GaussianPolicy'}),
                dict()),
     'so_joint': (dict(), dict(policy_per_task=False), dict()),
     'so_separate': (dict(), dict(policy_per_task=True), dict()),
@@ -234,8 +283,28 @@ AIRLP_ALGORITHMS = {
                                dict(training_cfg={'n_itr': 50},
                                     policy_per_task=True),
                                dict()),
+    # Inner loops on 4 tasks in parallel per outer iteration (needs >= 4 tasks)
+    'so_separate_batch4': (dict(),
+                           dict(policy_per_task=True, meta_batch=4),
+                           dict()),
 }
 
+def airlp(meta, fine):
+    from pirl.irl import airl
+    tf_config = make_tf_config()
+    airl_reward, airl_sample, airl_value = _airl_common(tf_config)
+    metalearn_fn = functools.partial(airl.metalearn, tf_cfg=tf_config,
+                                     **_load_airl_kwargs(meta))
+    finetune_fn = functools.partial(airl.finetune, tf_cfg=tf_config,
+                                    **_load_airl_kwargs(fine))
+    return MetaIRLAlgorithm(metalearn=metalearn_fn,
+                            finetune=finetune_fn,
+                            reward_wrapper=airl_reward,
+                            sample=airl_sample,
+                            value=airl_value,
+                            vectorized=True,
+                            uses_gpu=True)
+
 for k, (common, meta, fine) in AIRLP_ALGORITHMS.items():
     for k2, it in AIRL_ITERATIONS.items():
         for lr in [None] + list(range(1,4)):
@@ -253,30 +322,22 @@ for k, (common, meta, fine) in AIRLP_ALGORITHMS.items():
             fine['pol_itr'] = it // 4
             fine['irl_itr'] = it // 4
 
-            metalearn_fn = functools.partial(irl.airl.metalearn,
-                                             tf_cfg=TENSORFLOW, **meta)
-            finetune_fn = functools.partial(irl.airl.finetune,
-                                            tf_cfg=TENSORFLOW, **fine)
-            entry = MetaIRLAlgorithm(metalearn=metalearn_fn,
-                                     finetune=finetune_fn,
-                                     reward_wrapper=airl_reward,
-                                     sample=airl_sample,
-                                     value=airl_value,
-                                     vectorized=True,
-                                     uses_gpu=True)
             algo_name = 'airlp_{}'.format(k)
             if k2 is not None:
                 algo_name += '_' + k2
             if lr is not None:
                 algo_name += '_lr1e-{}'.format(lr)
-            POPULATION_IRL_ALGORITHMS[algo_name] = entry
+            POPULATION_IRL_ALGORITHMS.register(algo_name, airlp,
+                                               dict(meta), dict(fine))
 
-def traditional_to_concat(singleirl):
+def traditional_to_concat(single_irl):
+    singleirl = SINGLE_IRL_ALGORITHMS[single_irl]
     def metalearner(envs, trajectories, discount, seed, log_dir):
-        return list(itertools.chain(*trajectories.values()))
+        return concatenate(trajectories.values())
     @functools.wraps(singleirl.train)
     def finetune(train_trajectories, envs, test_trajectories, discount, seed, **kwargs):
-        concat_trajectories = train_trajectories + test_trajectories
+        concat_trajectories = concatenate([train_trajectories,
+                                           test_trajectories])
         return singleirl.train(envs, concat_trajectories, discount, seed, **kwargs)
     return MetaIRLAlgorithm(metalearn=metalearner,
                             finetune=finetune,
@@ -286,8 +347,8 @@ def traditional_to_concat(singleirl):
                             vectorized=singleirl.vectorized,
                             uses_gpu=singleirl.uses_gpu)
 
-for name, algo in SINGLE_IRL_ALGORITHMS.items():
-    POPULATION_IRL_ALGORITHMS[name + 'c'] = traditional_to_concat(algo)
+for name in SINGLE_IRL_ALGORITHMS:
+    POPULATION_IRL_ALGORITHMS.register(name + 'c', traditional_to_concat, name)
 
 # Experiments
 
@@ -399,6 +460,8 @@ for shape in ['9x9', '4x4']:
             ],
             'train_trajectories': [1000],
             'test_trajectories': [0, 1, 2, 5, 10, 20, 50, 100],
+            # tasks are tiny, bundle them to amortize scheduling overhead
+            'task_batch_size': 32,
         }
 EXPERIMENTS['few-jungle-quick-tmp'] = {
     'train_environments': ['pirl/GridWorld-Jungle-9x9-{}-v0'.format(k)
@@ -412,6 +475,7 @@ EXPERIMENTS['few-jungle-quick-tmp'] = {
     ],
     'train_trajectories': [1000],
     'test_trajectories': [0, 1, 2, 5, 10, 20, 50, 100],
+    'task_batch_size': 32,
 }
 
 # Baselines for continuous control
@@ -0,0 +1,59 @@
+import collections
+import collections.abc
+import importlib
+
+
+def load(path):
+    '''Returns the object at path, of the form 'module.name:attr.subattr'.
+       Objects that are not strings are returned unchanged.'''
+    if not isinstance(path, str):
+        return path
+    module_name, _sep, attr_path = path.partition(':')
+    obj = importlib.import_module(module_name)
+    if attr_path:
+        for attr in attr_path.split('.'):
+            obj = getattr(obj, attr)
+    return obj
+
+
+class Registry(collections.abc.Mapping):
+    '''A mapping from names to lazily constructed values.
+
+       Entries are registered as a factory, given by import path (see load)
+       or as a callable, and the arguments to call it with. The factory is
+       only imported and called when the entry is first looked up. This
+       avoids paying for e.g. TensorFlow imports in processes that only ever
+       use tabular algorithms.
+
+       Iteration, len() and membership tests never construct entries.'''
+    def __init__(self, kind=None):
+        '''kind: optional type; constructed entries are checked against it.'''
+        self._kind = kind
+        self._specs = collections.OrderedDict()
+        self._values = {}
+
+    def register(self, name, factory, *args, **kwargs):
+        if name in self._specs:
+            raise KeyError("'{}' is already registered".format(name))
+        self._specs[name] = (factory, args, kwargs)
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        factory, args, kwargs = self._specs[name]
+        value = load(factory)(*args, **kwargs)
+        if self._kind is not None:
+            assert isinstance(value, self._kind), name
+        self._values[name] = value
+        return value
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
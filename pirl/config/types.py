@@ -3,6 +3,8 @@ import sys
 
 import gym
 
+from pirl import envs
+
 # Algorithms
 RES_FLDS = ['sample', 'vectorized', 'uses_gpu']
 RES_FLDS_DOC = '''\n
@@ -24,7 +26,8 @@ They return a policy (algorithm-specific object).
 
 value has signature (env, policy, discount, seed).
 It returns (mean, se) where mean is the estimated reward and se is the
-standard error (0 for exact methods).''' + RES_FLDS_DOC
+standard error (0 for exact methods). Sampling-based methods return
+(mean, se, episodes), where episodes is the number of episodes sampled.''' + RES_FLDS_DOC
 IRLAlgorithm = namedtuple('IRLAlgorithm',
                           ['train', 'reward_wrapper', 'value'] + RES_FLDS)
 IRLAlgorithm.__doc__ = '''\
@@ -47,8 +50,7 @@ value has signature (env, policy, discount, seed) where:
 - policy is as returned by the IRL algorithm.
 - discount is a float in [0,1].
 - seed is an integer.
-It returns (mean, se) where mean is the estimated reward and se is the
-standard error (0 for exact methods).''' + RES_FLDS_DOC
+It returns (mean, se) or (mean, se, episodes), as for RLAlgorithm.''' + RES_FLDS_DOC
 MetaIRLAlgorithm = namedtuple('MetaIRLAlgorithm',
                               ['metalearn', 'finetune',
                                'reward_wrapper', 'value'] + RES_FLDS)
@@ -68,21 +70,16 @@ the return value are as in the single-IRL case.
 reward_wrapper and compute_value are the same as for IRLAlgorithm.'''
 
 def validate_config(rl_algos, single_irl_algos, population_irl_algos):
-    '''Checks the defined algorithms are of the appropriate type,
-       and there is no ambiguity based on their keys (for single v.s.
-       population IRL algorithms.)'''
+    '''Checks there is no ambiguity based on the keys of the defined
+       algorithms (for single v.s. population IRL algorithms.)
+       The algorithms are registry.Registry's, which check the type of each
+       algorithm when it is constructed. So we do not check types here,
+       as that would force all algorithms to be constructed.'''
     # Check algorithms
     pop_keys = set(population_irl_algos.keys())
     intersection = pop_keys.intersection(single_irl_algos.keys())
     assert len(intersection) == 0
 
-    for rl, algo in rl_algos.items():
-        assert isinstance(algo, RLAlgorithm), rl
-    for irl, algo in single_irl_algos.items():
-        assert isinstance(algo, IRLAlgorithm), irl
-    for irl, algo in population_irl_algos.items():
-        assert isinstance(algo, MetaIRLAlgorithm), irl
-
 # Per-experiment configuration
 
 def _list_of(converter):
@@ -107,6 +104,7 @@ FIELD_TYPES = {
     # Number of seeds to use
     'seeds': int,
     'parallel_rollouts': int,
+    'task_batch_size': int,
 }
 
 MANDATORY_FIELDS = ['expert', 'irl', 'eval', 'test_trajectories']
@@ -117,6 +115,8 @@ OPTIONAL_FIELDS = {
     'train_trajectories': None,
     # note parallel_rollouts is ignored for non-vectorized (I)RL algorithms
     'parallel_rollouts': 4,
+    # number of CPU-only tasks (e.g. tabular IRL) to bundle per Ray task
+    'task_batch_size': 1,
 }
 
 def parse_config(experiment, cfg,
@@ -149,12 +149,14 @@ def parse_config(experiment, cfg,
         # Check environments are registered
         for fld in ['train_environments', 'test_environments']:
             for env in res[fld]:
+                envs.import_env_module(env)
                 gym.envs.registry.spec(env)
 
-        # Check RL & IRL algorithms are registered
-        rl_algos[res['expert']]
-        for rl in res['eval']:
-            rl_algos[rl]
+        # Check RL & IRL algorithms are registered.
+        # (Membership tests do not construct the algorithms.)
+        for rl in [res['expert']] + res['eval']:
+            if rl not in rl_algos:
+                raise KeyError("Unknown RL algorithm '{}'".format(rl))
         for irl in res['irl']:
             assert (irl in population_irl_algos or irl in single_irl_algos)
 
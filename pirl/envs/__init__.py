@@ -1,6 +1,21 @@
+import importlib
+
 import numpy as np
 from gym.envs.registration import register
 from pirl.envs import gridworld
+from pirl.envs.registration import register_family
+
+# Environments registered by other packages, as a side-effect of importing
+# the module. These are imported on demand, since they can be slow to import.
+EXTERNAL_ENV_MODULES = {
+    'airl/': 'airl.envs',
+}
+
+def import_env_module(env_name):
+    '''Imports the module registering env_name, if it is external.'''
+    for prefix, module in EXTERNAL_ENV_MODULES.items():
+        if env_name.startswith(prefix):
+            importlib.import_module(module)
 
 ### Gridworlds
 
@@ -59,121 +74,101 @@ jungle_topology = {
 jungle_default_reward = -1
 jungle_topology = {k: np.array([list(x) for x in v])
                    for k, v in jungle_topology.items()}
-cfg = {'Soda': ['S'], 'Water': ['W'], 'Liquid': ['S', 'W']}
-for kind, cells in cfg.items():
+jungle_cells = {'Soda': ['S'], 'Water': ['W'], 'Liquid': ['S', 'W']}
+def _jungle_spec(scale, kind):
+    topology = jungle_topology[scale]
     reward_map = {'R': 0, 'L': -10}
-    for k in cells:
+    for k in jungle_cells[kind]:
         reward_map[k] = 1
-    fn = np.vectorize(lambda x: reward_map.get(x, jungle_default_reward))
-    for scale, topology in jungle_topology.items():
-        reward = fn(topology)
-        register(
-            id='pirl/GridWorld-Jungle-{}-{}-v0'.format(scale, kind),
-            entry_point='pirl.envs.gridworld:GridWorldMdpEnv',
-            max_episode_steps=100,
-            kwargs={
-                'walls': topology == 'X',
-                'reward': reward,
-                'initial_state': gridworld.create_initial_state(topology),
-                'terminal': np.zeros_like(topology, dtype=bool),
-                'noise': 0.2,
-            }
-        )
+    reward = np.vectorize(lambda x: reward_map.get(x, jungle_default_reward))
+    return {
+        'entry_point': 'pirl.envs.gridworld:GridWorldMdpEnv',
+        'max_episode_steps': 100,
+        'kwargs': {
+            'walls': topology == 'X',
+            'reward': reward(topology),
+            'initial_state': gridworld.create_initial_state(topology),
+            'terminal': np.zeros_like(topology, dtype=bool),
+            'noise': 0.2,
+        }
+    }
+register_family('pirl/GridWorld-Jungle-{scale}-{kind}-v0',
+                {'scale': list(jungle_topology.keys()),
+                 'kind': list(jungle_cells.keys())},
+                _jungle_spec)
 
 ## MountainCar
-for num_peaks in [2, 3, 4]:
-    for vel_penalty in [0, 0.1, 0.5, 1]:
-        for initial_noise in [0.05, 0.1, 0.25]:
-            GOAL_POS = {'left': [0.01], 'right': [num_peaks - 1.01], 'random': None}
-            for side, pos in GOAL_POS.items():
-                register(
-                    id='pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
-                        num_peaks, side, vel_penalty, initial_noise),
-                    entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
-                    max_episode_steps=999,
-                    reward_threshold=90.0,
-                    kwargs={
-                        'num_peaks': num_peaks,
-                        'goal_reward': [100],
-                        'goal_position': pos,
-                        'vel_penalty': vel_penalty,
-                        'initial_noise': initial_noise
-                    },
-                )
-
-            TWO_FIXED_POS = {
-                'left-target': [100, -100],
-                'right-target': [-100, 100]
-            }
-            for side, reward in TWO_FIXED_POS.items():
-                register(
-                    id='pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
-                        num_peaks, side, vel_penalty, initial_noise),
-                    entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
-                    max_episode_steps=999,
-                    reward_threshold=90.0,
-                    kwargs={
-                        'num_peaks': num_peaks,
-                        'goal_reward': reward,
-                        'goal_position': [0.01, num_peaks - 1.01],
-                        'vel_penalty': vel_penalty,
-                        'initial_noise': initial_noise
-                    },
-                )
-
-            TWO_VARIABLE_POS = {'red': [100, -100], 'blue': [-100, 100]}
-            for good_goal, reward in TWO_VARIABLE_POS.items():
-                register(
-                    id='pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
-                        num_peaks, good_goal, vel_penalty, initial_noise),
-                    entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
-                    max_episode_steps=999,
-                    reward_threshold=90.0,
-                    kwargs={
-                        'num_peaks': num_peaks,
-                        'goal_reward': reward,
-                        'vel_penalty': vel_penalty,
-                        'initial_noise': initial_noise
-                    },
-                )
+MOUNTAIN_CAR_GOALS = {
+    # side: (goal_reward, goal_position)
+    'left': ([100], lambda num_peaks: [0.01]),
+    'right': ([100], lambda num_peaks: [num_peaks - 1.01]),
+    'random': ([100], lambda num_peaks: None),
+    # two fixed goals
+    'left-target': ([100, -100], lambda num_peaks: [0.01, num_peaks - 1.01]),
+    'right-target': ([-100, 100], lambda num_peaks: [0.01, num_peaks - 1.01]),
+    # two goals, variable position
+    'red': ([100, -100], None),
+    'blue': ([-100, 100], None),
+}
+def _mountain_car_spec(num_peaks, side, vel_penalty, initial_noise):
+    goal_reward, goal_position = MOUNTAIN_CAR_GOALS[side]
+    kwargs = {
+        'num_peaks': num_peaks,
+        'goal_reward': goal_reward,
+        'vel_penalty': vel_penalty,
+        'initial_noise': initial_noise
+    }
+    if goal_position is not None:
+        kwargs['goal_position'] = goal_position(num_peaks)
+    return {
+        'entry_point': 'pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
+        'max_episode_steps': 999,
+        'reward_threshold': 90.0,
+        'kwargs': kwargs,
+    }
+register_family('pirl/MountainCarContinuous-{num_peaks}-{side}-'
+                '{vel_penalty}-{initial_noise}-v0',
+                {'num_peaks': [2, 3, 4],
+                 'side': list(MOUNTAIN_CAR_GOALS.keys()),
+                 'vel_penalty': [0, 0.1, 0.5, 1],
+                 'initial_noise': [0.05, 0.1, 0.25]},
+                _mountain_car_spec)
 
 ## Reacher
-for start_variance in [0.1, 0.5, 1.0]:
-    for seed in range(10):
-        register(
-            id='pirl/ReacherGoal-seed{}-{}-v0'.format(seed, start_variance),
-            entry_point='pirl.envs.reacher_goal:ReacherGoalEnv',
-            max_episode_steps=50,
-            kwargs={
-                'seed': seed,
-                'start_variance': start_variance * np.pi,
-                'goal_state_pos': 'fixed',
-                'goal_state_access': False,
-            }
-        )
-
-        for steps in [50, 100]:
-            register(
-                id='pirl/ReacherWall-seed{}-{}-{}-v0'.format(seed, steps, start_variance),
-                entry_point='pirl.envs.reacher_wall:ReacherWallEnv',
-                max_episode_steps=steps,
-                kwargs={
-                    'wall_penalty': 0.4*steps,
-                    'wall_seed': seed,
-                    'start_variance': start_variance * np.pi,
-                }
-            )
+reacher_params = {'seed': list(range(10)),
+                  'start_variance': [0.1, 0.5, 1.0]}
+def _reacher_goal_spec(seed, start_variance):
+    return {
+        'entry_point': 'pirl.envs.reacher_goal:ReacherGoalEnv',
+        'max_episode_steps': 50,
+        'kwargs': {
+            'seed': seed,
+            'start_variance': start_variance * np.pi,
+            'goal_state_pos': 'fixed',
+            'goal_state_access': False,
+        }
+    }
+register_family('pirl/ReacherGoal-seed{seed}-{start_variance}-v0',
+                reacher_params, _reacher_goal_spec)
 
-    for steps in [50, 100]:
-        register(
-            id='pirl/ReacherWall-nowall-{}-{}-v0'.format(steps, start_variance),
-            entry_point='pirl.envs.reacher_wall:ReacherWallEnv',
-            max_episode_steps=steps,
-            kwargs={
-                'wall_seed': None,
-                'start_variance': start_variance * np.pi,
-            }
-        )
+def _reacher_wall_spec(steps, start_variance, seed=None):
+    kwargs = {
+        'wall_seed': seed,
+        'start_variance': start_variance * np.pi,
+    }
+    if seed is not None:
+        kwargs['wall_penalty'] = 0.4*steps
+    return {
+        'entry_point': 'pirl.envs.reacher_wall:ReacherWallEnv',
+        'max_episode_steps': steps,
+        'kwargs': kwargs,
+    }
+register_family('pirl/ReacherWall-seed{seed}-{steps}-{start_variance}-v0',
+                dict(reacher_params, steps=[50, 100]), _reacher_wall_spec)
+register_family('pirl/ReacherWall-nowall-{steps}-{start_variance}-v0',
+                {'steps': [50, 100],
+                 'start_variance': reacher_params['start_variance']},
+                _reacher_wall_spec)
 
 ## Billiards
 billiard_params = [
@@ -182,18 +177,20 @@ billiard_params = [
     (5, 2),
     (-10, 1)
 ]
-for seed in range(10):
-    for num_balls in range(1, len(billiard_params) + 1):
-        register(
-            id='pirl/Billiards{}-seed{}-v0'.format(num_balls, seed),
-            entry_point='pirl.envs.billiards:BilliardsEnv',
-            max_episode_steps=200,
-            kwargs={
-                'params': billiard_params,
-                'num_balls': num_balls,
-                'seed': seed,
-            },
-        )
+def _billiards_spec(num_balls, seed):
+    return {
+        'entry_point': 'pirl.envs.billiards:BilliardsEnv',
+        'max_episode_steps': 200,
+        'kwargs': {
+            'params': billiard_params,
+            'num_balls': num_balls,
+            'seed': seed,
+        },
+    }
+register_family('pirl/Billiards{num_balls}-seed{seed}-v0',
+                {'num_balls': list(range(1, len(billiard_params) + 1)),
+                 'seed': list(range(10))},
+                _billiards_spec)
 
 ## Seaquest
 register(
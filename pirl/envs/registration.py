@@ -0,0 +1,62 @@
+'''Lazy registration of parametric families of Gym environments.
+
+Registering every combination of parameters up-front makes importing
+pirl.envs (which every Ray worker does) slow, and the Gym registry large.
+Instead, a family is described by an ID template and the values each
+parameter may take. IDs are parsed when first looked up (e.g. by gym.make),
+and the matching environment registered then.'''
+
+import re
+import string
+
+from gym.envs.registration import register, registry
+
+_families = []
+
+def _compile_template(id_template, params):
+    '''Returns a regex matching id_template, with each field in id_template
+       matching the string representation of the values in params.'''
+    pattern = ''
+    for literal, field, _fmt, _conv in string.Formatter().parse(id_template):
+        pattern += re.escape(literal)
+        if field is not None:
+            # Longest first, so e.g. 'left-target' is preferred to 'left'
+            alternatives = sorted([str(v) for v in params[field]],
+                                  key=len, reverse=True)
+            alternatives = '|'.join(re.escape(x) for x in alternatives)
+            pattern += '(?P<{}>{})'.format(field, alternatives)
+    return re.compile(pattern + '$')
+
+
+def register_family(id_template, params, make_spec):
+    '''Lazily registers the family of environments id_template.
+
+    Args:
+        - id_template(str): a format string, e.g. 'pirl/Foo-{size}-v0'.
+        - params(dict): maps each field in id_template to a list of values.
+        - make_spec(callable): called with a value for each field, returns
+            a dict of keyword arguments to gym.envs.registration.register
+            (excluding id).'''
+    regex = _compile_template(id_template, params)
+    lookup = {k: {str(v): v for v in vs} for k, vs in params.items()}
+    _families.append((regex, lookup, make_spec))
+
+
+def resolve(env_id):
+    '''Registers env_id if it is in a family and not yet registered.'''
+    if env_id in registry.env_specs:
+        return
+    for regex, lookup, make_spec in _families:
+        match = regex.match(env_id)
+        if match is not None:
+            values = {k: lookup[k][v] for k, v in match.groupdict().items()}
+            register(id=env_id, **make_spec(**values))
+            return
+
+
+_registry_spec = registry.spec
+def _spec(env_id):
+    resolve(env_id)
+    return _registry_spec(env_id)
+# gym.make and gym.spec both go via registry.spec
+registry.spec = _spec
@@ -6,6 +6,7 @@ import inspect
 import logging
 import os
 import os.path as osp
+import traceback
 
 from baselines import bench
 from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
@@ -13,7 +14,9 @@ import gym
 import joblib
 import ray
 
-from pirl import config, utils
+import pirl.envs
+from pirl import config, results, utils
+from pirl.trajectories import as_batch
 from pirl.utils import create_seed, sanitize_env_name, safeset
 
 logger = logging.getLogger('pirl.experiments.experiments')
@@ -24,6 +27,7 @@ cache = utils.cache_and_log(config.OBJECT_DIR)
 @contextmanager
 def make_envs(env_name, vectorized, parallel, base_seed, log_prefix,
               pre_wrapper=None, post_wrapper=None):
+    pirl.envs.import_env_module(env_name)
     def helper(i):
         env = gym.make(env_name)
         env = bench.Monitor(env, log_prefix + str(i), allow_early_resets=True)
@@ -73,24 +77,53 @@ def ray_remote_variable_resources(**kwargs):
             ('num_cpus', [1]),
             ('num_gpus', [0,1]),
         ])
+
+        def batch_func(keys, *values):
+            '''Calls func once for each element of keys, a list of keyword
+               argument names. The argument values are flattened into values,
+               so that Ray resolves any object IDs amongst them. A call that
+               raises an exception returns a utils.CallError in its place, so
+               the rest of the batch still runs (and is cached).'''
+            values = iter(values)
+            res = []
+            for call_keys in keys:
+                kwargs = {k: next(values) for k in call_keys}
+                try:
+                    res.append(func(**kwargs))
+                except Exception:
+                    logger.exception('Error in batched call to %s', func.__name__)
+                    res.append(utils.CallError(traceback.format_exc()))
+            return res
+
         cache = {}
+        batch_cache = {}
         for vs in itertools.product(*parameter_set.values()):
             # Name mangling to make function ID unique
             parameters = [(k, v) for k, v in zip(parameter_set.keys(), vs)]
             suffix = ','.join(['{}={}'.format(k, v) for k, v in parameters])
             name = func.__name__
             func.__name__ = '{}:{}'.format(name, suffix)
-            # Specify max_calls=1 to force GPU memory to be released.
-            # This shouldn't be necessary, but the overhead of using a fresh
-            # worker each time is minimal as our tasks are long-lived.
-            # Without this I've found TensorFlow initialization hangs
-            # indefinitely sometimes...
-            cache[tuple(vs)] = ray.remote(max_calls=1,
+            # For GPU variants, specify max_calls=1 to force GPU memory to be
+            # released. This shouldn't be necessary, but the overhead of
+            # using a fresh worker each time is minimal as these tasks are
+            # long-lived. Without this I've found TensorFlow initialization
+            # hangs indefinitely sometimes...
+            # CPU-only algorithms (e.g. tabular) do not use TensorFlow, and
+            # their tasks are short, so paying for a fresh worker (and
+            # re-importing everything) each time would dominate. Let them run
+            # on long-lived workers instead (max_calls=0 is unlimited).
+            max_calls = 1 if dict(parameters)['num_gpus'] > 0 else 0
+            cache[tuple(vs)] = ray.remote(max_calls=max_calls,
                                           **dict(parameters),
                                           **kwargs)(func)
             func.__name__ = name
+            # kwargs (e.g. num_return_vals) apply to a single call of func,
+            # so are not passed on: batch_func returns a list of results.
+            batch_func.__name__ = '{}:batch:{}'.format(name, suffix)
+            batch_cache[tuple(vs)] = ray.remote(max_calls=max_calls,
+                                                **dict(parameters))(batch_func)
 
-        def func_call(*args, **kwargs):
+        def resources(*args, **kwargs):
             signature = inspect.signature(func)
             bound = signature.bind(*args, **kwargs)
             arguments = bound.arguments
@@ -111,18 +144,94 @@ def ray_remote_variable_resources(**kwargs):
             # NOTE: If we switch from DummyVecEnv to SubprocVecEnv,
             # should make num_cpus depend on parallel (with some fudge factor)
             num_cpus = 1
-            try:
-                fn = cache[(num_cpus, num_gpus)]
-            except KeyError:
+            if (num_cpus, num_gpus) not in cache:
                 raise KeyError('Did not expect CPU/GPU combination {}/{}. '
                                'If valid, then update parameter_set.'.format(
                                 num_cpus, num_gpus))
+            return num_cpus, num_gpus
+
+        def func_call(*args, **kwargs):
+            fn = cache[resources(*args, **kwargs)]
             return fn.remote(*args, **kwargs)
 
+        def func_submit(calls, batch_size=1):
+            '''Submits func with each of calls, a list of keyword argument
+               dicts, without waiting for them. Returns a list of pairs
+               (object ID, index): the result of call i is element index of
+               the list the object ID resolves to. For calls already in the
+               cache, the object ID is None and index is the result.
+
+               CPU-only calls are bundled into remote tasks of up to
+               batch_size calls, which share a worker (and its imports, cache
+               connection, etc). This cuts overhead for micro-tasks, e.g.
+               tabular IRL. Each call is still cached and logged
+               individually. Only calls depending on the same object IDs are
+               bundled, so no call waits on another's inputs.
+
+               Calls already in the cache are looked up in one batch, and
+               are not submitted to Ray at all. (Calls with object ID
+               arguments cannot be looked up until these are resolved.)'''
+            refs = [None] * len(calls)
+            lookup_many = getattr(func, 'lookup_many', None)
+            if lookup_many is not None:
+                resolved = [i for i, kwds in enumerate(calls)
+                            if not any(isinstance(v, ray.ObjectID)
+                                       for v in kwds.values())]
+                hits = lookup_many([calls[i] for i in resolved])
+                for i, res in zip(resolved, hits):
+                    if res is not utils.MISSING:
+                        refs[i] = (None, res)
+
+            # Group remaining calls by resource requirements and object ID
+            # arguments, preserving order
+            groups = collections.OrderedDict()
+            for i, kwds in enumerate(calls):
+                if refs[i] is None:
+                    deps = frozenset(v for v in kwds.values()
+                                     if isinstance(v, ray.ObjectID))
+                    key = (resources(**kwds), deps)
+                    groups.setdefault(key, []).append(i)
+
+            for (variant, _deps), idxs in groups.items():
+                _num_cpus, num_gpus = variant
+                # GPU tasks are long-running: batching gains nothing.
+                size = 1 if num_gpus > 0 else max(1, batch_size)
+                for start in range(0, len(idxs), size):
+                    chunk = idxs[start:start + size]
+                    keys = [list(calls[i].keys()) for i in chunk]
+                    values = [v for i in chunk for v in calls[i].values()]
+                    future = batch_cache[variant].remote(keys, *values)
+                    for j, i in enumerate(chunk):
+                        refs[i] = (future, j)
+            return refs
+
+        def func_map(calls, batch_size=1):
+            '''Calls func with each of calls, as func_submit, returning a
+               list of results. Blocks until all calls have completed. If
+               any call failed, raises an error for it once the others have
+               completed.'''
+            refs = func_submit(calls, batch_size)
+            results = [index if future is None else utils.MISSING
+                       for future, index in refs]
+            positions = collections.OrderedDict()
+            for i, (future, index) in enumerate(refs):
+                if future is not None:
+                    positions.setdefault(future, []).append((i, index))
+            futures = list(positions.keys())
+            for j, batch in utils.ray_iter_completed(futures):
+                for i, index in positions[futures[j]]:
+                    results[i] = batch[index]
+            for res in results:
+                if isinstance(res, utils.CallError):
+                    res.reraise()
+            return results
+
         @functools.wraps(func)
         def func_invoker(*args, **kwargs):
             raise Exception("Remote functions cannot be called directly.")
         func_invoker.remote = func_call
+        func_invoker.submit = func_submit
+        func_invoker.map = func_map
 
         return func_invoker
     return decorator
@@ -174,7 +283,7 @@ def synthetic_data(rl, discount, parallel, seed, env_name, num_trajectories,
     with make_envs(env_name, rl_algo.vectorized, parallel, data_seed,
                    log_prefix=osp.join(mon_dir, 'synthetic')) as envs:
         samples = rl_algo.sample(envs, policy, num_trajectories, data_seed)
-    return [(obs, acts) for (obs, acts, rews) in samples]
+    return as_batch(samples).without_rewards()
 
 @ray_remote_variable_resources()
 @cache(tags=('expert', ))
@@ -332,7 +441,8 @@ def _run_population_irl_finetune(irl, parallel, discount, seed,
 def _run_population_irl_train(irl, parallel, discount, seed,
                               train_trajs, test_trajs, n, ms, log_dir):
     '''Performs metalearning with irl_name on n training trajectories,
-       returning a tuple of rewards and values with shape [env][m].'''
+       returning a list of pairs ((env, m), kwargs) where kwargs are the
+       arguments to _run_population_irl_finetune.'''
     # Metalearn
     meta_log_dir = osp.join(log_dir, 'irl', irl, 'meta:{}'.format(n))
     meta_subset = {k: v[:n] for k, v in train_trajs.items()}
@@ -340,56 +450,66 @@ def _run_population_irl_train(irl, parallel, discount, seed,
                                                seed, meta_subset, meta_log_dir)
 
     # Finetune
-    rewards = collections.OrderedDict()
-    values = collections.OrderedDict()
+    calls = []
     for env, trajs in test_trajs.items():
         for m in ms:
             subset = trajs[:m]
             finetune_log_dir = osp.join(meta_log_dir, 'finetune:{}'.format(m),
                                         sanitize_env_name(env))
-            r, v = _run_population_irl_finetune.remote(irl, parallel, discount,
-                                                       seed, env, subset,
-                                                       metainit,
-                                                       finetune_log_dir)
-            safeset(rewards, [env, m], r)
-            safeset(values, [env, m], v)
+            kwargs = {
+                'irl': irl,
+                'parallel': parallel,
+                'discount': discount,
+                'seed': seed,
+                'env': env,
+                'trajs': subset,
+                'metainit': metainit,
+                'log_dir': finetune_log_dir,
+            }
+            calls.append(((env, m), kwargs))
 
-    return rewards, values
+    return calls
 
 
 @ray.remote(num_return_vals=2)
 def _run_population_irl_helper(irl, parallel, discount, seed,
-                               train_envs, test_envs, num_traj,
+                               train_envs, test_envs, num_traj, batch_size,
                                log_dir, envs, *trajectories):
     # Reconstruct trajectories
     trajectories = {k: v for k, v in zip(envs, trajectories)}
     train_trajs = {k: trajectories[k] for k in train_envs}
     test_trajs = {k: trajectories[k] for k in test_envs}
 
-    rewards = collections.OrderedDict()
-    values = collections.OrderedDict()
-
+    keys = []
+    calls = []
     for n, ms in num_traj.items():
-        r, v = _run_population_irl_train(irl, parallel, discount, seed,
-                                         train_trajs, test_trajs, n, ms,
-                                         log_dir)
-        for env in test_trajs.keys():
-            safeset(rewards, [env, n], r[env])
-            safeset(values, [env, n], v[env])
+        finetune_calls = _run_population_irl_train(irl, parallel, discount,
+                                                   seed, train_trajs,
+                                                   test_trajs, n, ms, log_dir)
+        for (env, m), kwargs in finetune_calls:
+            keys.append([env, n, m])
+            calls.append(kwargs)
+    results = _run_population_irl_finetune.map(calls, batch_size)
+
     # {rewards,value} [env][n][m] -> {reward,value}
-    rewards = utils.ray_get_nested_dict(rewards, level=3)
-    values = utils.ray_get_nested_dict(values, level=3)
+    rewards = collections.OrderedDict()
+    values = collections.OrderedDict()
+    for k, (r, v) in zip(keys, results):
+        safeset(rewards, k, r)
+        safeset(values, k, v)
     return rewards, values
 
 
 def _run_population_irl(irl, parallel, discount, seed, train_envs,
-                        test_envs, num_traj, trajectories, out_dir):
+                        test_envs, num_traj, batch_size, trajectories,
+                        out_dir):
     # Flatten trajectories (env -> object ID) to appease ray
     envs = sorted(list(set(train_envs).union(test_envs)))
     trajectories = [trajectories[k] for k in envs]
     return _run_population_irl_helper.remote(irl, parallel, discount, seed,
                                              train_envs, test_envs, num_traj,
-                                             out_dir, envs, *trajectories)
+                                             batch_size, out_dir, envs,
+                                             *trajectories)
 
 ## Single-task IRL
 
@@ -425,46 +545,51 @@ def _run_single_irl_train(irl, parallel, discount, seed,
 
 
 @ray.remote(num_return_vals=2)
-def _run_single_irl_helper(irl, parallel, discount, seed,
-                           num_traj, test_envs, log_dir, *trajectories):
+def _run_single_irl_helper(irl, parallel, discount, seed, num_traj,
+                           batch_size, test_envs, log_dir, *trajectories):
     trajectories = {k: v for k, v in zip(test_envs, trajectories)}
-    reward_res = collections.OrderedDict()
-    value_res = collections.OrderedDict()
 
     ms = sorted(set(itertools.chain(*num_traj.values())))
-    for env, m in itertools.product(test_envs, ms):
-        subset = trajectories[env][:m]
+    keys = list(itertools.product(test_envs, ms))
+    calls = []
+    for env, m in keys:
         sub_log_dir = osp.join(log_dir, 'irl', irl,
                                sanitize_env_name(env), '{}'.format(m))
+        calls.append({
+            'irl': irl,
+            'parallel': parallel,
+            'discount': discount,
+            'seed': seed,
+            'env_name': env,
+            'log_dir': sub_log_dir,
+            'trajectories': trajectories[env][:m],
+        })
+    results = _run_single_irl_train.map(calls, batch_size)
 
-        reward, value = _run_single_irl_train.remote(irl, parallel, discount,
-                                                     seed, env, sub_log_dir,
-                                                     subset)
-
+    reward_res = collections.OrderedDict()
+    value_res = collections.OrderedDict()
+    for (env, m), (reward, value) in zip(keys, results):
         for n, ms in num_traj.items():
             if m in ms:
-                #SOMEDAY: although this won't duplicate the work,
-                #callers might not know the values are identical, and so
-                #some work might get duplicated later in the pipeline
-                #(e.g. when reoptimizing in value()).
+                # The same reward is stored under several n. value()
+                # deduplicates by reward content, so this does not cause
+                # reoptimization to be repeated.
                 safeset(reward_res, [env, n, m], reward)
                 safeset(value_res, [env, n, m], value)
 
     # Returns two dictionaries of the form [env][n][m]
-    reward_res = utils.ray_get_nested_dict(reward_res, level=3)
-    value_res = utils.ray_get_nested_dict(value_res, level=3)
     return reward_res, value_res
 
-def _run_single_irl(irl, num_traj, train_envs, test_envs, parallel,
-                    discount, seed, out_dir, trajectories):
+def _run_single_irl(irl, num_traj, batch_size, train_envs, test_envs,
+                    parallel, discount, seed, out_dir, trajectories):
     trajectories = [trajectories[k] for k in test_envs]
     return _run_single_irl_helper.remote(irl, parallel, discount, seed,
-                                         num_traj, test_envs, out_dir,
-                                         *trajectories)
+                                         num_traj, batch_size, test_envs,
+                                         out_dir, *trajectories)
 
 ## General IRL
 
-def run_irl(cfg, out_dir, trajectories, seed):
+def run_irl(cfg, out_dir, trajectories, seed, done=None):
     '''Run experiment in parallel. Returns tuple (reward, value) where each are
        nested OrderedDicts, with key in the format:
         - IRL algo
@@ -473,7 +598,11 @@ def run_irl(cfg, out_dir, trajectories, seed):
         - Environment
        Note that for this experiment type, the second and third arguments are
        always the same.
+
+       IRL algorithms with results in done (in the format of
+       ResultsStore.nested) are not rerun.
     '''
+    done = done or {}
 
     num_traj = collections.OrderedDict()
     if 'train_trajectories' in cfg:  # meta-learning experiment
@@ -491,6 +620,7 @@ def run_irl(cfg, out_dir, trajectories, seed):
         'discount': cfg['discount'],
         'seed': seed,
         'num_traj': num_traj,
+        'batch_size': cfg.get('task_batch_size', 1),
         'train_envs': train_envs,
         'test_envs': test_envs,
         'trajectories': trajectories,
@@ -499,7 +629,14 @@ def run_irl(cfg, out_dir, trajectories, seed):
     # Futures shape: irl -> Future([env][n][m])
     reward_futures = collections.OrderedDict()
     value_futures = collections.OrderedDict()
+    done_rewards = done.get('rewards', {})
+    done_values = done.get('values', {}).get('irl', {})
     for irl in cfg['irl']:
+        if irl in done_rewards and irl in done_values:
+            # value() expects rewards to be object IDs
+            safeset(reward_futures, [irl], ray.put(done_rewards[irl]))
+            safeset(value_futures, [irl], done_values[irl])
+            continue
         kwds = dict(kwargs)
         kwds.update({'irl': irl})
         if irl in config.SINGLE_IRL_ALGORITHMS:
@@ -515,13 +652,45 @@ def run_irl(cfg, out_dir, trajectories, seed):
 
 ## Evaluation
 
+def _reward_wrapper(irl):
+    if irl in config.SINGLE_IRL_ALGORITHMS:
+        return config.SINGLE_IRL_ALGORITHMS[irl].reward_wrapper
+    else:
+        return config.POPULATION_IRL_ALGORITHMS[irl].reward_wrapper
+
+# Types of partial keywords included in _qualified_name. Other arguments,
+# e.g. tf_cfg, configure how the wrapper runs rather than what it computes.
+_NAMED_TYPES = (bool, int, float, str, type(None))
+
+def _qualified_name(fn):
+    '''Returns 'module:qualname' of fn, or None if fn is None. If fn is a
+       partial, names the function it applies, followed by any keywords
+       of a type in _NAMED_TYPES.'''
+    keywords = {}
+    while isinstance(fn, functools.partial):
+        for k, v in fn.keywords.items():
+            if isinstance(v, _NAMED_TYPES):
+                keywords.setdefault(k, v)
+        fn = fn.func
+    if fn is None:
+        return None
+    name = '{}:{}'.format(fn.__module__, fn.__qualname__)
+    if keywords:
+        name += '({})'.format(', '.join('{}={!r}'.format(k, keywords[k])
+                                        for k in sorted(keywords)))
+    return name
+
 #TODO: this actually requires twice as many GPU resources as other tasks
 #(for reward wrapper and for the RL policy network).
 #No good way to express this in current framework.
 @ray_remote_variable_resources()
-@cache(tags=('eval', ))
-def _value_helper(irl, n, m, rl, parallel, discount, seed, env_name, 
-                  reward, log_dir):
+@cache(tags=('eval', ), ignore=['irl'])
+def _value_helper(irl, rl, parallel, discount, seed, env_name,
+                  wrapper_name, reward, log_dir):
+    '''Reoptimizes reward in env_name using rl, returning the value of the
+       resulting policy. irl selects the reward wrapper, but is excluded from
+       the cache key in favour of wrapper_name, the wrapper's qualified name:
+       the result depends only on the wrapper and the content of reward.'''
     if reward is None:
         # reward will be None if the algorithm is a non-IRL imitation learner.
         # In this case, do not attempt to reoptimize.
@@ -529,19 +698,17 @@ def _value_helper(irl, n, m, rl, parallel, discount, seed, env_name,
 
     # Setup
     utils.set_cuda_visible_devices()
-    logger.debug('[EVAL] %s [meta=%d, finetune=%d] ' 
-                 'by %s [discount=%f, seed=%s, parallel=%d] '
+    logger.debug('[EVAL] %s by %s [discount=%f, seed=%s, parallel=%d] '
                  'on %s (writing to %s)',
-                 irl, n, m,
-                 rl, discount, seed, parallel,
-                 env_name, log_dir)
+                 irl, rl, discount, seed, parallel, env_name, log_dir)
     mon_dir = osp.join(log_dir, 'mon')
     os.makedirs(mon_dir)
 
-    if irl in config.SINGLE_IRL_ALGORITHMS:
-        reward_wrapper = config.SINGLE_IRL_ALGORITHMS[irl].reward_wrapper
-    else:
-        reward_wrapper = config.POPULATION_IRL_ALGORITHMS[irl].reward_wrapper
+    reward_wrapper = _reward_wrapper(irl)
+    if _qualified_name(reward_wrapper) != wrapper_name:
+        raise ValueError("Reward wrapper of '{}' is {}, but cached under {}"
+                         .format(irl, _qualified_name(reward_wrapper),
+                                 wrapper_name))
     rw = functools.partial(reward_wrapper, new_reward=reward)
     rl_algo = config.RL_ALGORITHMS[rl]
 
@@ -561,30 +728,71 @@ def _value_helper(irl, n, m, rl, parallel, discount, seed, env_name,
 
     return v
 
+def _link_log_dir(src, dst):
+    '''Makes dst a symlink to src, which need not exist yet.'''
+    try:
+        os.makedirs(osp.dirname(dst), exist_ok=True)
+        os.symlink(src, dst, target_is_directory=True)
+    except FileExistsError:
+        logger.warning('Destination %s already exists (attempt to '
+                       'link to %s).', dst, src)
+
 @ray.remote
-def _value(irl, rl, parallel, out_dir, reward, discount, seed):
+def _value(irl, rl, parallel, out_dir, discount, seed, batch_size, done,
+           reward):
+    '''Submits reoptimization of each reward in reward, a dict [env][n][m]
+       of rewards inferred by irl, using rl. Rewards present in done, a
+       dict of the same form, are skipped. The same reward is often stored
+       under several n: these share a single training run. Identical rewards
+       from other IRL algorithms (with the same reward wrapper) share a
+       _value_helper cache entry, which is keyed by content.
+
+       Does not wait for reoptimization to complete. Returns a dict of the
+       form [env][n][m] -> (object ID, index), as in _value_helper.submit:
+       each value is stored as soon as its own task completes.'''
+    wrapper_name = _qualified_name(_reward_wrapper(irl))
+    # digest -> index into calls
+    tasks = {}
+    calls = []
+    # [env][n][m] -> index into calls
+    idxs = collections.OrderedDict()
     def mapper(rew, keys):
+        if _contains(done, keys):
+            return
         env_name, n, m = keys
         log_dir = osp.join(out_dir, 'eval', sanitize_env_name(env_name),
                            '{}:{}:{}'.format(irl, m, n), rl)
-        kwargs = {
+        digest = utils.content_digest(rew, env_name)
+        if digest in tasks:
+            idx = tasks[digest]
+            primary_log_dir = calls[idx]['log_dir']
+            logger.debug('[EVAL] %s [meta=%d, finetune=%d] on %s: duplicate '
+                         'reward, reusing %s', irl, n, m, env_name,
+                         primary_log_dir)
+            _link_log_dir(osp.abspath(primary_log_dir), log_dir)
+            safeset(idxs, keys, idx)
+            return
+        tasks[digest] = len(calls)
+        calls.append({
             'irl': irl,
-            'n': n,
-            'm': m,
             'rl': rl,
             'parallel': parallel,
             'discount': discount,
             'seed': seed,
             'env_name': env_name,
+            'wrapper_name': wrapper_name,
             'log_dir': log_dir,
             'reward': rew,
-        }
-        return _value_helper.remote(**kwargs)
-    #SOMEDAY: ray.get inside ray.remote is legal but feels yucky
-    value_futures = utils.map_nested_dict(reward, mapper, level=3)
-    return utils.ray_get_nested_dict(value_futures, level=3)
-
-def value(cfg, out_dir, rewards, seed):
+        })
+        safeset(idxs, keys, tasks[digest])
+    utils.map_nested_dict(reward, mapper, level=3)
+    logger.debug('[EVAL] %s by %s: %d unique reoptimization tasks',
+                 irl, rl, len(calls))
+    refs = _value_helper.submit(calls, batch_size)
+    return utils.map_nested_dict(idxs, lambda idx, _keys: refs[idx],
+                                 level=3)
+
+def value(cfg, out_dir, rewards, seed, done=None):
     '''
     Compute the expected value of (a) policies optimized on inferred reward,
     and (b) optimal policies for the ground truth reward. Policies will be
@@ -595,34 +803,31 @@ def value(cfg, out_dir, rewards, seed):
         - out_dir: for logging
         - rewards
         - seed
+        - done: results already computed, in the format of
+            ResultsStore.nested; these are not recomputed.
     Returns:
         tuple, (value, ground_truth) where each is a nested dictionary of the
         same shape as rewards, with the leaf being a dictionary mapping from
         an RL algorithm in cfg['eval'] to a scalar value.
     '''
+    done = done or {}
     discount = cfg['discount']
     parallel = cfg.get('parallel_rollouts', 1)
-
-    def reward_map(rew, keys, rl):
-        irl = keys[0]
-        kwargs = {
-            'irl': irl,
-            'rl': rl,
-            'parallel': parallel,
-            'out_dir': out_dir,
-            'reward': rew,
-            'discount': discount,
-            'seed': seed
-        }
-        return _value.remote(**kwargs)
+    batch_size = cfg.get('task_batch_size', 1)
 
     # rewards -> value_futures
     # rewards: [irl_name] -> Future[[env][n][m] -> reward map]
-    # value_futures: [rl][irl_name] -> Future[[env][n][m] -> (mean, se)]
+    # value_futures: [rl][irl_name] -> Future[[env][n][m] -> reference],
+    # where each reference is a pair (object ID, index) (see _value).
+    # Each task depends only on the rewards of its IRL algorithm, so
+    # reoptimization starts as soon as these are available.
     value_futures = collections.OrderedDict()
     for rl in cfg['eval']:
-        value_futures[rl] = utils.map_nested_dict(rewards,
-                                            functools.partial(reward_map, rl=rl))
+        done_values = done.get('values', {}).get(rl, {})
+        for irl, reward in rewards.items():
+            val = _value.remote(irl, rl, parallel, out_dir, discount, seed,
+                                batch_size, done_values.get(irl, {}), reward)
+            safeset(value_futures, [rl, irl], val)
 
     # ground_truth_futures: [rl][env] -> (mean, se)
     #TODO: This is often duplicating the work of expert_trajs.
@@ -630,6 +835,10 @@ def value(cfg, out_dir, rewards, seed):
     ground_truth_futures = collections.OrderedDict()
     for rl in cfg['eval']:
         for env_name in cfg.get('test_environments', cfg.get('environments')):
+            if env_name in done.get('ground_truth', {}).get(rl, {}):
+                val = done['ground_truth'][rl][env_name]
+                safeset(ground_truth_futures, [rl, env_name], val)
+                continue
             log_dir = osp.join(out_dir, 'eval', sanitize_env_name(env_name),
                                'gt', rl)
             kwargs = {
@@ -650,7 +859,8 @@ def value(cfg, out_dir, rewards, seed):
 
 ## General
 
-def _run_experiment(cfg, out_dir, seed):
+def _run_experiment(cfg, out_dir, seed, done=None):
+    done = done or {}
     # Generate synthetic data
     # trajs: dict, env -> Future[list of np arrays]
     # expert_vals: dict, env -> Future[(mean, s.e.)]
@@ -658,11 +868,11 @@ def _run_experiment(cfg, out_dir, seed):
     # Run IRL
     # rewards: dict, irl -> Future[env -> n -> m -> reward]
     # irl_values: dict, irl -> Future[env -> n -> m -> (mean, s.e.)]
-    rewards, irl_values = run_irl(cfg, out_dir, trajs, seed)
+    rewards, irl_values = run_irl(cfg, out_dir, trajs, seed, done)
     # Run RL with the reward predicted by IRL ("reoptimize")
-    # values: dict, rl -> irl -> Future[env -> n -> m -> (mean, se)]
+    # values: dict, rl -> irl -> Future[env -> n -> m -> reference]
     # ground_truth: dict, rl -> env -> Future[(mean, se)]
-    values, ground_truth = value(cfg, out_dir, rewards, seed)
+    values, ground_truth = value(cfg, out_dir, rewards, seed, done)
 
     # Add in the values obtained by the expert & IRL policies
     ground_truth['expert'] = expert_vals
@@ -677,9 +887,31 @@ def _run_experiment(cfg, out_dir, seed):
     return res
 
 
+def _pending(ob, path):
+    '''Yields (path, object ID) for each object ID in nested dict ob.'''
+    if isinstance(ob, ray.ObjectID):
+        yield path, ob
+    elif isinstance(ob, collections.Mapping):
+        for k, v in ob.items():
+            yield from _pending(v, path + [k])
+
+
+def _contains(d, path):
+    for k in path:
+        if k not in d:
+            return False
+        d = d[k]
+    return True
+
+
 def run_experiment(cfg, out_dir, base_seed):
     '''Run experiment defined in config.EXPERIMENTS.
 
+    Results are appended to a ResultsStore in out_dir as soon as they are
+    available. If out_dir already contains results (e.g. from a run that was
+    interrupted), tasks whose results are present are not resubmitted.
+    Reoptimization values are stored, and resumed, per (irl, env, n, m).
+
     Args:
         - experiment(str): experiment name.
         - out_dir(str): path to write logs and results to.
@@ -700,12 +932,74 @@ def run_experiment(cfg, out_dir, base_seed):
         - ground_truth: value obtained from RL policy.
         - info: info dict from IRL algorithms.
         '''
-    res = collections.defaultdict(collections.OrderedDict)
+    store = results.ResultsStore(osp.join(out_dir, 'results.log'))
+    if len(store) > 0:
+        logger.info('Resuming from %d results in %s', len(store), out_dir)
+
+    # object ID -> list of (seed, path, index). If index is None, the
+    # object is the result at path; otherwise, the result is element index
+    # of the list the object resolves to (see _value).
+    pending = collections.OrderedDict()
+    def add(object_id, i, path, index=None):
+        pending.setdefault(object_id, []).append((i, path, index))
+
+    trajectories = collections.OrderedDict()
     for i in range(cfg['seeds']):
         log_dir = osp.join(out_dir, str(i))
         seed = base_seed + str(i)
-        d = _run_experiment(cfg, log_dir, seed)
-        for k, v in d.items():
-            res[k][i] = v
-
-    return utils.ray_leaf_get_nested_dict(res)
+        done = store.nested(seed=i)
+        d = _run_experiment(cfg, log_dir, seed, done)
+        trajectories[i] = d.pop('trajectories')
+        for path, object_id in _pending(d, []):
+            if not _contains(done, path):
+                add(object_id, i, path)
+
+    errors = []
+    def collect(i, path, res, index):
+        '''Returns records for res, adding any references it contains
+           to pending.'''
+        if index is not None:
+            res = res[index]
+            if isinstance(res, utils.CallError):
+                logger.error('Failed to compute %s for seed %d', path, i)
+                errors.append(res)
+                return []
+        if path[0] == 'values' and path[1] != 'irl' and len(path) == 3:
+            # Reoptimization: res maps each cell to a reference, so that
+            # each value is stored as soon as it is available.
+            records = []
+            def mapper(ref, keys):
+                object_id, index = ref
+                if object_id is None:  # cache hit
+                    records.extend(collect(i, path + keys, [index], 0))
+                else:
+                    add(object_id, i, path + keys, index)
+            utils.map_nested_dict(res, mapper, level=3)
+            return records
+        return results.flatten(i, path, res)
+
+    # Store results in the order they complete
+    while pending:
+        ready, remaining = ray.wait(list(pending.keys()), num_returns=1)
+        if remaining:  # anything else that is ready
+            more, _ = ray.wait(remaining, num_returns=len(remaining),
+                               timeout=0)
+            ready += more
+        records = []
+        for object_id, res in zip(ready, ray.get(ready)):
+            for i, path, index in pending.pop(object_id):
+                records += collect(i, path, res, index)
+        store.append(records)
+        logger.info('%d results stored, waiting on %d tasks',
+                    len(store), len(pending))
+
+    results.write_values(osp.join(out_dir, 'values.npz'), store)
+    for err in errors:
+        err.reraise()
+
+    res = collections.OrderedDict()
+    res['trajectories'] = utils.ray_leaf_get_nested_dict(trajectories)
+    nested = store.nested()
+    for k in ['rewards', 'values', 'ground_truth']:
+        res[k] = nested.get(k, collections.OrderedDict())
+    return res
@@ -0,0 +1,283 @@
+'''Shared inference server for policy networks.
+
+Many small tasks on one node (e.g. evaluating reoptimized policies) each
+evaluate networks in their own TensorFlow session, holding their own copy of
+the graph and GPU context. Instead, an InferenceServer on the node can load
+each model once, and worker processes evaluate it through an InferenceClient
+over a Unix socket. (AIRL rewards need no session: they are evaluated
+in-process, see pirl.irl.airl_numpy.)
+
+Models are deterministic functions: any sampling is left to the client, so
+that it can be seeded.
+
+Concurrent requests for the same model are batched dynamically: a batch is
+run once max_batch rows are queued, or max_delay seconds after its first
+request arrived. Models are loaded by kind (see LOADERS) from a spec, and
+identified by a digest of both, so identical models are loaded once however
+many clients request them. Models are reference counted by the connections
+that loaded them, and unloaded once the last of these closes.
+
+Messages are pickled, so the socket is only accessible to its owner.
+Start a server with scripts/inference_server.py.'''
+
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+from pirl.config import registry
+
+logger = logging.getLogger('pirl.inference')
+
+# Loaders by kind. Given a spec, they return a function mapping a batch of
+# inputs (arrays with equal first dimension) to an array or tuple of arrays.
+# If the function has a close attribute, it is called on unloading the model.
+LOADERS = {
+    'ppo_policy': 'pirl.agents.ppo:policy_fn',
+}
+
+# Frame header: payload length
+_HEADER = struct.Struct('<Q')
+
+
+def _send(sock, obj):
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise EOFError('Connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv(sock):
+    (length, ) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, length))
+
+
+class _Request(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.size = len(inputs[0])
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _BatchedModel(object):
+    '''Evaluates fn on batches of queued requests, in a dedicated thread.'''
+    def __init__(self, fn, max_batch, max_delay):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, inputs):
+        request = _Request(inputs)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        '''Stops the batching thread, and releases the resources of fn.
+           There must be no outstanding requests.'''
+        self._queue.put(None)
+        self._thread.join()
+        close = getattr(self.fn, 'close', None)
+        if close is not None:
+            close()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            size = request.size
+            deadline = time.monotonic() + self.max_delay
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Closing: evaluate the batch so far, then stop
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+                size += request.size
+            self._evaluate(batch)
+
+    def _evaluate(self, batch):
+        try:
+            inputs = [np.concatenate(xs) for xs in
+                      zip(*[request.inputs for request in batch])]
+            outputs = self.fn(*inputs)
+            single = not isinstance(outputs, tuple)
+            if single:
+                outputs = (outputs, )
+            splits = np.cumsum([request.size for request in batch])[:-1]
+            parts = [np.split(np.asarray(output), splits) for output in outputs]
+            for i, request in enumerate(batch):
+                result = tuple(part[i] for part in parts)
+                request.result = result[0] if single else result
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Number of references to each model held by this connection
+        loaded = collections.Counter()
+        try:
+            self._serve(loaded)
+        finally:
+            for key, count in loaded.items():
+                if count > 0:
+                    self.server.release(key, count)
+
+    def _serve(self, loaded):
+        while True:
+            try:
+                op, *args = _recv(self.request)
+            except (EOFError, ConnectionResetError):
+                return
+            try:
+                if op == 'load':
+                    result = self.server.load(*args)
+                    loaded[result] += 1
+                elif op == 'unload':
+                    (key, ) = args
+                    if loaded[key] == 0:
+                        raise KeyError('Model {} not loaded'.format(key))
+                    loaded[key] -= 1
+                    self.server.release(key)
+                    result = None
+                elif op == 'call':
+                    key, inputs = args
+                    # The reference held by this connection keeps the model
+                    # loaded until the call completes.
+                    if loaded[key] == 0:
+                        raise KeyError('Model {} not loaded'.format(key))
+                    result = self.server.models[key](inputs)
+                else:
+                    raise ValueError("Unknown operation '{}'".format(op))
+            except Exception as e:
+                logger.exception('Error handling %s request', op)
+                _send(self.request, ('error', repr(e)))
+            else:
+                _send(self.request, ('ok', result))
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, max_batch=4096, max_delay=0.002):
+        '''Listens on a Unix socket at path, replacing any stale socket.'''
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.models = {}
+        self._refs = collections.Counter()
+        self._lock = threading.Lock()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        # Create the socket accessible only to its owner
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+    def load(self, kind, spec):
+        '''Loads the model (if not already loaded), returning its key.
+           Each call takes a reference to the model, dropped by release.'''
+        payload = pickle.dumps((kind, spec), protocol=pickle.HIGHEST_PROTOCOL)
+        key = hashlib.sha1(payload).hexdigest()
+        with self._lock:
+            if key not in self.models:
+                fn = registry.load(LOADERS[kind])(spec)
+                self.models[key] = _BatchedModel(fn, self.max_batch,
+                                                 self.max_delay)
+                logger.info('Loaded %s model %s', kind, key)
+            self._refs[key] += 1
+        return key
+
+    def release(self, key, count=1):
+        '''Drops count references to model key, unloading it if none remain.'''
+        with self._lock:
+            self._refs[key] -= count
+            if self._refs[key] > 0:
+                return
+            del self._refs[key]
+            model = self.models.pop(key)
+        model.close()
+        logger.info('Unloaded model %s', key)
+
+
+class InferenceClient(object):
+    '''Connection to an InferenceServer. Not thread-safe: use one client per
+       thread.'''
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, *msg):
+        _send(self.sock, msg)
+        status, result = _recv(self.sock)
+        if status != 'ok':
+            raise RuntimeError('Inference server error: {}'.format(result))
+        return result
+
+    def load(self, kind, spec):
+        '''Returns a function evaluating the model on the server. The model
+           stays loaded until unload(fn) is called, or the client is closed.'''
+        key = self._request('load', kind, spec)
+        def fn(*inputs):
+            return self._request('call', key,
+                                 tuple(np.asarray(x) for x in inputs))
+        fn.key = key
+        return fn
+
+    def unload(self, fn):
+        '''Releases the model evaluated by fn, as returned by load.'''
+        self._request('unload', fn.key)
+
+    def close(self):
+        self.sock.close()
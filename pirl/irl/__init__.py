@@ -1 +1,3 @@
-from pirl.irl import airl, gail, tabular_maxent
\ No newline at end of file
+# airl and gail are not imported here, since they depend on TensorFlow.
+# Import them explicitly: from pirl.irl import airl
+from pirl.irl import tabular_maxent
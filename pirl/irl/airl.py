@@ -1,11 +1,16 @@
+import contextlib
 import functools
+import logging
+import os
 import pickle
 import random
+import time
 
 from baselines.common.vec_env import VecEnvWrapper
 import gym
 import numpy as np
 import os.path as osp
+import ray
 import tensorflow as tf
 
 from rllab.envs.base import Env, EnvSpec
@@ -25,8 +30,11 @@ from airl.models.airl_state import AIRL as AIRLStateOnly
 from airl.models.imitation_learning import AIRLStateAction
 from airl.utils.log_utils import rllab_logdir
 
-from pirl.agents.sample import SampleVecMonitor
-from pirl.utils import sanitize_env_name
+from pirl.agents.sample import VecEvaluator
+from pirl.irl import airl_numpy
+from pirl.utils import sanitize_env_name, set_cuda_visible_devices
+
+logger = logging.getLogger('pirl.irl.airl')
 
 class VecInfo(VecEnvWrapper):
     def reset(self):
@@ -132,12 +140,13 @@ def _convert_trajectories(trajs):
     '''Convert trajectories from format used in PIRL to that expected in AIRL.
 
     Args:
-        - trajs: trajectories in AIRL format. That is, a list of 2-tuples (obs, actions),
-          where obs and actions are equal-length lists containing observations and actions.
+        - trajs: trajectories in PIRL format. That is, a TrajectoryBatch or a
+          list of 2-tuples (obs, actions), where obs and actions are
+          equal-length lists containing observations and actions.
     Returns: trajectories in AIRL format.
         A list of dictionaries, containing keys 'observations' and 'actions', with values that are equal-length
-        numpy arrays.'''
-    return [{'observations': np.array(obs), 'actions': np.array(actions)}
+        numpy arrays. For a TrajectoryBatch, these are views (no copy).'''
+    return [{'observations': np.asarray(obs), 'actions': np.asarray(actions)}
             for obs, actions in trajs]
 
 
@@ -205,86 +214,272 @@ def irl(venv, trajectories, discount, seed, log_dir, *, tf_cfg, model_cfg=None,
     return reward, policy_pkl
 
 
-def metalearn(venvs, trajectories, discount, seed, log_dir, *, tf_cfg, outer_itr=1000,
-              lr=1e-2, model_cfg=None, policy_cfg=None, training_cfg={},
-              policy_per_task=False):
-    envs = {k: TfEnv(VecGymEnv(v)) for k, v in venvs.items()}
-    env_spec = list(envs.values())[0].spec
-    num_envs = list(venvs.values())[0].num_envs
-    tasks = list(envs.keys())
+def _train_inner(algo, tabular):
+    '''Runs iterations algo.start_itr to algo.n_itr of algo, but without
+       initializing variables or starting the sampler: these must be done
+       beforehand, and persist across calls. tabular is recorded in each row
+       of the progress log, in addition to the usual columns.'''
+    # Mirrors the loop of IRLBatchPolopt.train (airl/algos/irl_batch_polopt.py)
+    # in AdamGleave/inverse_rl@master, as installed by environment.yml.
+    # Keep the two in sync if that dependency is updated.
+    start_time = time.time()
+    for itr in range(algo.start_itr, algo.n_itr):
+        itr_start_time = time.time()
+        with rl_logger.prefix('itr #{} | '.format(itr)):
+            rl_logger.log('Obtaining samples...')
+            paths = algo.obtain_samples(itr)
+            rl_logger.log('Processing samples...')
+            paths = algo.compute_irl(paths, itr=itr)
+            algo.log_avg_returns(paths)
+            samples_data = algo.process_samples(itr, paths)
+            rl_logger.log('Logging diagnostics...')
+            algo.log_diagnostics(paths)
+            rl_logger.log('Optimizing policy...')
+            algo.optimize_policy(itr, samples_data)
+            rl_logger.log('Saving snapshot...')
+            params = algo.get_itr_snapshot(itr, samples_data)
+            if algo.store_paths:
+                params['paths'] = samples_data['paths']
+            rl_logger.save_itr_params(itr, params)
+            rl_logger.log('Saved')
+            for k, v in tabular.items():
+                rl_logger.record_tabular(k, v)
+            rl_logger.record_tabular('Itr', itr)
+            rl_logger.record_tabular('Time', time.time() - start_time)
+            rl_logger.record_tabular('ItrTime', time.time() - itr_start_time)
+            rl_logger.dump_tabular(with_prefix=False)
+
+
+class _InnerLoop(object):
+    '''Training graph for metalearn: a reward model, a policy and an IRLTRPO
+       algorithm per task, sharing one graph and session. The graph,
+       optimizer state and samplers persist across calls to train: variables
+       are initialized once, and parameters and demonstrations swapped in
+       (irl_model and policy use cached assign ops).
+
+       make_venv(task) returns a vector environment for task. It is called,
+       and the algorithm and its sampler created, on first training on task.'''
+    def __init__(self, make_venv, task, trajectories, discount, seed, tf_cfg,
+                 model_cfg, policy_cfg, training_cfg):
+        self.make_venv = make_venv
+        self.discount = discount
+        self.experts = {k: _convert_trajectories(v)
+                        for k, v in trajectories.items()}
+        self.algos = {}
+        venv = make_venv(task)
+        env = TfEnv(VecGymEnv(venv))
+        self.env_spec = env.spec
+        self.num_envs = venv.num_envs
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(seed)
+
+            model_kwargs = dict(model_cfg)
+            model_cls = model_kwargs.pop('model')
+            self.irl_model = model_cls(env_spec=self.env_spec, **model_kwargs)
+
+            policy_kwargs = dict(policy_cfg)
+            policy_fn = policy_kwargs.pop('policy')
+            self.policy = policy_fn(name='policy', env_spec=self.env_spec,
+                                    **policy_kwargs)
+
+            self.training_kwargs = {
+                'n_itr': 10,
+                'batch_size': 10000,
+                'max_path_length': 500,
+                'irl_model_wt': 1.0,
+                'entropy_weight': 0.1,
+                # paths substantially increase storage requirements
+                'store_paths': False,
+            }
+            self.training_kwargs.update(training_cfg)
+
+            self.sess = tf.Session(config=tf_cfg)
+            with self.sess.as_default():
+                self._add_algo(task, env)
+                self.init_reward_params = self.irl_model.get_params()
+                self.init_pol_params = self.policy.get_param_values()
+
+    def _add_algo(self, task, env):
+        '''Creates and starts the algorithm for task. The graph and session
+           must be the default.'''
+        algo = IRLTRPO(env=env,
+                       policy=self.policy,
+                       irl_model=self.irl_model,
+                       discount=self.discount,
+                       sampler_args=dict(n_envs=self.num_envs),
+                       zero_environment_reward=True,
+                       baseline=LinearFeatureBaseline(env_spec=self.env_spec),
+                       **self.training_kwargs)
+        # Only initialize variables created since the last call (all of them
+        # on the first call): the others hold parameters being trained.
+        uninitialized = set(self.sess.run(tf.report_uninitialized_variables()))
+        self.sess.run(tf.variables_initializer(
+            [v for v in tf.global_variables()
+             if v.op.name.encode('utf-8') in uninitialized]))
+        algo.start_worker()
+        self.algos[task] = algo
+        return algo
+
+    def train(self, task, reward_params, pol_params, tabular):
+        '''Runs the inner loop on task, starting from reward_params and
+           pol_params (or the current policy, if pol_params is None).
+           Returns the trained reward and policy parameters.'''
+        with self.graph.as_default(), self.sess.as_default():
+            algo = self.algos.get(task)
+            if algo is None:
+                env = TfEnv(VecGymEnv(self.make_venv(task)))
+                algo = self._add_algo(task, env)
+            self.irl_model.set_demos(self.experts[task])
+            self.irl_model.set_params(reward_params)
+            if pol_params is not None:
+                self.policy.set_param_values(pol_params)
+            _train_inner(algo, tabular)
+            return self.irl_model.get_params(), self.policy.get_param_values()
 
-    experts = {k: _convert_trajectories(v) for k, v in trajectories.items()}
+    def close(self):
+        with self.graph.as_default(), self.sess.as_default():
+            for algo in self.algos.values():
+                algo.shutdown_worker()
+        self.sess.close()
 
-    train_graph = tf.Graph()
-    with train_graph.as_default():
-        tf.set_random_seed(seed)
 
-        if model_cfg is None:
-            model_cfg = {'model': AIRLStateOnly,
-                         'state_only': True,
-                         'max_itrs': 10}
-        model_kwargs = dict(model_cfg)
-        model_cls = model_kwargs.pop('model')
-        irl_model = model_cls(env_spec=env_spec, **model_kwargs)
+class _InnerLoopWorker(object):
+    '''An _InnerLoop in a Ray actor, with its own environments and log
+       directory, so metalearn can train on several tasks concurrently.
+       Environments for each of tasks are created on first use.'''
+    def __init__(self, tasks, num_envs, seed, log_dir, loop_kwargs):
+        set_cuda_visible_devices()
+        self.num_envs = num_envs
+        self.seed = seed
+        self.mon_dir = osp.join(log_dir, 'mon')
+        os.makedirs(self.mon_dir, exist_ok=True)
+        self._envs = contextlib.ExitStack()
+        self.loop = _InnerLoop(self._make_venv, tasks[0], seed=seed,
+                               **loop_kwargs)
+        rl_logger.set_snapshot_mode('last')
+        self._logdir = rllab_logdir(algo=self.loop.algos[tasks[0]],
+                                    dirname=log_dir)
+        self._logdir.__enter__()
+
+    def _make_venv(self, task):
+        # Avoid circular import: pirl.experiments depends on pirl.config
+        from pirl.experiments import make_envs
+        log_prefix = osp.join(self.mon_dir, sanitize_env_name(task) + '-')
+        return self._envs.enter_context(make_envs(task, True, self.num_envs,
+                                                  self.seed,
+                                                  log_prefix=log_prefix))
+
+    def train(self, task, reward_params, pol_params, tabular):
+        return self.loop.train(task, reward_params, pol_params, tabular)
 
-        if policy_cfg is None:
-            policy_cfg = {'policy': GaussianMLPPolicy, 'hidden_sizes': (32, 32)}
-        else:
-            policy_cfg = dict(policy_cfg)
-        policy_fn = policy_cfg.pop('policy')
-        policy = policy_fn(name='policy', env_spec=env_spec, **policy_cfg)
-        pol_params = {}
+    def close(self):
+        self._logdir.__exit__(None, None, None)
+        self.loop.close()
+        self._envs.close()
 
-        training_kwargs = {
-            'n_itr': 10,
-            'batch_size': 10000,
-            'max_path_length': 500,
-            'irl_model_wt': 1.0,
-            'entropy_weight': 0.1,
-            # paths substantially increase storage requirements
-            'store_paths': False,
-        }
-        training_kwargs.update(training_cfg)
-        algos = {k: IRLTRPO(env=env,
-                            policy=policy,
-                            irl_model=irl_model,
-                            discount=discount,
-                            sampler_args=dict(n_envs=num_envs),
-                            zero_environment_reward=True,
-                            baseline=LinearFeatureBaseline(env_spec=env_spec),
-                            **training_kwargs)
-                for k, env in envs.items()}
-
-        with tf.Session(config=tf_cfg) as sess:
-            sess.run(tf.global_variables_initializer())
-            meta_reward_params = irl_model.get_params()
+
+def metalearn(venvs, trajectories, discount, seed, log_dir, *, tf_cfg, outer_itr=1000,
+              lr=1e-2, model_cfg=None, policy_cfg=None, training_cfg={},
+              policy_per_task=False, meta_batch=1, worker_gpus=0):
+    '''Reptile metalearning of an AIRL reward. Each of outer_itr iterations
+       trains on meta_batch distinct tasks, starting from the meta reward,
+       then moves the meta reward a fraction lr towards the mean of the
+       trained rewards. If policy_per_task is False, the policies trained
+       in an iteration are averaged. Otherwise, each task resumes its own
+       policy; a task not yet trained on starts from the policy its replica
+       last trained.
+
+       Tasks are partitioned between meta_batch replicas, each training on
+       one of its own tasks per iteration, chosen uniformly; so each replica
+       only creates environments for its own tasks. The first replica runs
+       in this process, the others concurrently in Ray actors each requiring
+       worker_gpus GPUs, logging to subdirectories worker<b> of log_dir.'''
+    tasks = list(venvs.keys())
+    if not 1 <= meta_batch <= len(tasks):
+        raise ValueError('meta_batch must be between 1 and the number of '
+                         'tasks ({}), not {}'.format(len(tasks), meta_batch))
+    replica_tasks = [tasks[b::meta_batch] for b in range(meta_batch)]
+    num_envs = list(venvs.values())[0].num_envs
+
+    if model_cfg is None:
+        model_cfg = {'model': AIRLStateOnly,
+                     'state_only': True,
+                     'max_itrs': 10}
+    model_kwargs = dict(model_cfg)
+    del model_kwargs['model']
+    if policy_cfg is None:
+        policy_cfg = {'policy': GaussianMLPPolicy, 'hidden_sizes': (32, 32)}
+    loop_kwargs = dict(trajectories=trajectories, discount=discount,
+                       tf_cfg=tf_cfg, model_cfg=model_cfg,
+                       policy_cfg=policy_cfg, training_cfg=training_cfg)
+
+    loop = _InnerLoop(venvs.__getitem__, tasks[0], seed=seed, **loop_kwargs)
+    # All replicas start from the parameters initialized in this process
+    meta_reward_params = loop.init_reward_params
+    pol_params = {}
+    workers = []
+    snapshot_mode = rl_logger.get_snapshot_mode()
+    rl_logger.set_snapshot_mode('last')
+    try:
+        if meta_batch > 1:
+            worker_cls = ray.remote(num_cpus=1, num_gpus=worker_gpus)(_InnerLoopWorker)
+            for b in range(1, meta_batch):
+                worker_seed = seed + b * num_envs
+                worker_dir = osp.join(log_dir, 'worker{}'.format(b))
+                workers.append(worker_cls.remote(replica_tasks[b], num_envs,
+                                                 worker_seed, worker_dir,
+                                                 loop_kwargs))
+
+        # All iterations log to a single progress.csv in log_dir
+        with rllab_logdir(algo=loop.algos[tasks[0]], dirname=log_dir):
             for i in range(outer_itr):
-                task = random.choice(tasks)
-                pol_task = task if policy_per_task else None
-                itr_logdir = osp.join(log_dir,
-                                      '{}_{}'.format(i, sanitize_env_name(task)))
-                with rllab_logdir(algo=algos[task], dirname=itr_logdir):
-                    with rl_logger.prefix('outer itr {} | task {}'.format(i, task)):
-                        irl_model.set_demos(experts[task])
-                        # TODO: rather than specifying these as initializers,
-                        # might be more efficient to have AIRL not overwrite
-                        # these variables each call to train()?
-                        algos[task].init_irl_params = meta_reward_params
-                        algos[task].init_pol_params = pol_params.get(pol_task)
-                        algos[task].train()
-
-                        # Meta-update reward
-                        # {meta,task}_reward_params are lists of NumPy arrays
-                        task_reward_params = irl_model.get_params()
-                        assert len(task_reward_params) == len(meta_reward_params)
-                        for i in range(len(task_reward_params)):
-                            meta, task = meta_reward_params[i], task_reward_params[i]
-                            # Reptile update: meta <- meta + lr * (task - meta)
-                            #TODO: use Adam optimizer?
-                            meta_reward_params[i] = (1 - lr) * meta + lr * task
-
-                        # Store policy update (joint if not policy_per_task)
-                        pol_params[pol_task] = policy.get_param_values()
+                batch = [random.choice(ts) for ts in replica_tasks]
+                if policy_per_task:
+                    starts = [pol_params.get(task) for task in batch]
+                else:
+                    starts = [pol_params.get(None, loop.init_pol_params)
+                              ] * meta_batch
+                futures = [w.train.remote(task, meta_reward_params, start,
+                                          {'OuterItr': i, 'Task': task})
+                           for w, task, start in zip(workers, batch[1:],
+                                                     starts[1:])]
+                with rl_logger.prefix('outer itr {} | task {} | '
+                                      .format(i, batch[0])):
+                    results = [loop.train(batch[0], meta_reward_params,
+                                          starts[0],
+                                          {'OuterItr': i, 'Task': batch[0]})]
+                results += ray.get(futures)
+                task_reward_params, task_pol_params = zip(*results)
+
+                # Reptile update: meta <- meta + lr * mean(new - meta)
+                # {meta,task}_reward_params are lists of NumPy arrays
+                #TODO: use Adam optimizer?
+                assert all(len(p) == len(meta_reward_params)
+                           for p in task_reward_params)
+                meta_reward_params = [(1 - lr) * meta + lr * np.mean(new, axis=0)
+                                      for meta, new in zip(meta_reward_params,
+                                                           zip(*task_reward_params))]
+
+                # Store policy update (joint if not policy_per_task)
+                if policy_per_task:
+                    pol_params.update(zip(batch, task_pol_params))
+                else:
+                    pol_params[None] = np.mean(task_pol_params, axis=0)
+    finally:
+        # Failing to close must not mask an error raised in training
+        closing = [w.close.remote() for w in workers]
+        try:
+            loop.close()
+        except Exception:
+            logger.exception('Error closing metalearn inner loop')
+        for b, future in enumerate(closing, 1):
+            try:
+                ray.get(future)
+            except Exception:
+                logger.exception('Error closing metalearn worker %d', b)
+        rl_logger.set_snapshot_mode(snapshot_mode)
 
     reward = model_kwargs, meta_reward_params
 
@@ -370,8 +565,10 @@ def finetune(metainit, venv, trajectories, discount, seed, log_dir, *,
     return reward, policy_pkl
 
 
-def sample(venv, policy_pkl, num_episodes, seed, tf_cfg):
-    venv = SampleVecMonitor(venv)
+def sample(venv, policy_pkl, num_episodes, seed, tf_cfg, discount=None):
+    '''Samples exactly num_episodes episodes. Returns their trajectories,
+       or their discounted returns if discount is not None.'''
+    venv = VecEvaluator(venv, num_episodes, discount=discount)
 
     infer_graph = tf.Graph()
     with infer_graph.as_default():
@@ -379,14 +576,12 @@ def sample(venv, policy_pkl, num_episodes, seed, tf_cfg):
         with tf.Session(config=tf_cfg):
             policy = pickle.loads(policy_pkl)
 
-            completed = 0
             obs = venv.reset()
-            while completed < num_episodes:
+            while not venv.finished:
                 a, _info = policy.get_actions(obs)
-                obs, _r, dones, _info = venv.step(a)
-                completed += np.sum(dones)
+                obs, _r, _dones, _info = venv.step(a)
 
-            return venv.trajectories
+            return venv.result()
 
 
 def _setup_model(env, new_reward, tf_cfg):
@@ -411,31 +606,54 @@ def _setup_model(env, new_reward, tf_cfg):
     return sess, irl_model, reward_var
 
 
+def _reward_fn(env, new_reward, tf_cfg):
+    '''Returns (reward_fn, sess). reward_fn maps batches of observations and
+       actions to a flat array of rewards. It is evaluated in NumPy where
+       supported (see airl_numpy), in which case sess is None.'''
+    try:
+        return airl_numpy.export(new_reward), None
+    except ValueError:
+        pass
+    sess, irl_model, reward_var = _setup_model(env, new_reward, tf_cfg)
+    def reward_fn(obs, actions):
+        feed_dict = {irl_model.act_t: np.asarray(actions),
+                     irl_model.obs_t: np.asarray(obs)}
+        return sess.run(reward_var, feed_dict=feed_dict).flatten()
+    return reward_fn, sess
+
+
 class AIRLRewardWrapper(gym.Wrapper):
     """Wrapper for a Env, using a reward network."""
     def __init__(self, env, new_reward, tf_cfg):
-        self.sess, self.irl_model, self.reward_var = _setup_model(env, new_reward, tf_cfg)
+        self.reward_fn, self.sess = _reward_fn(env, new_reward, tf_cfg)
         super().__init__(env)
 
     def step(self, action):
         obs, old_reward, done, info = self.env.step(action)
-        feed_dict = {self.irl_model.act_t: np.array([action]),
-                     self.irl_model.obs_t: np.array([obs])}
-        new_reward = self.sess.run(self.reward_var, feed_dict=feed_dict)
-        return obs, new_reward[0][0], done, info
+        new_reward = self.reward_fn(np.array([obs]), np.array([action]))
+        return obs, new_reward[0], done, info
 
     def reset(self, **kwargs):
         return self.env.reset(**kwargs)
 
     def close(self):
-        self.sess.close()
+        if self.sess is not None:
+            self.sess.close()
         self.env.close()
 
 
 class AIRLVecRewardWrapper(VecEnvWrapper):
-    """Wrapper for a VecEnv, using a reward network."""
-    def __init__(self, venv, new_reward, tf_cfg):
-        self.sess, self.irl_model, self.reward_var = _setup_model(venv, new_reward, tf_cfg)
+    """Wrapper for a VecEnv, using a reward network.
+
+    If deferred, step returns NaN rewards, and the observations and actions
+    are recorded instead: relabel then computes the rewards of all steps
+    since the last call in a single batch. The consumer must support this
+    (see ppo.RewardRelabeler)."""
+    def __init__(self, venv, new_reward, tf_cfg, deferred=False):
+        self.reward_fn, self.sess = _reward_fn(venv, new_reward, tf_cfg)
+        self.deferred = deferred
+        self._obs = []
+        self._actions = []
         super().__init__(venv)
 
     def step_async(self, actions):
@@ -444,19 +662,36 @@ class AIRLVecRewardWrapper(VecEnvWrapper):
 
     def step_wait(self):
         obs, _old_rewards, dones, info = self.venv.step_wait()
-        feed_dict = {self.irl_model.act_t: np.array(self.last_actions),
-                     self.irl_model.obs_t: np.array(obs)}
-        new_reward = self.sess.run(self.reward_var, feed_dict=feed_dict)
-        return obs, new_reward.flat, dones, info
+        if self.deferred:
+            self._obs.append(np.array(obs))
+            self._actions.append(np.array(self.last_actions))
+            return obs, np.full(len(obs), np.nan), dones, info
+        return obs, self.reward_fn(obs, self.last_actions), dones, info
+
+    def relabel(self):
+        '''Returns the rewards of the steps since the last call (or reset),
+           an array of shape (steps, num_envs).'''
+        assert self.deferred
+        steps = len(self._obs)
+        obs = np.concatenate(self._obs)
+        actions = np.concatenate(self._actions)
+        self._obs = []
+        self._actions = []
+        return self.reward_fn(obs, actions).reshape(steps, self.num_envs)
 
     def reset(self):
+        self._obs = []
+        self._actions = []
         return self.venv.reset()
 
     def close(self):
-        self.sess.close()
+        if self.sess is not None:
+            self.sess.close()
         self.venv.close()
 
 
-def airl_reward_wrapper(env, new_reward, tf_cfg):
-    cls = AIRLVecRewardWrapper if hasattr(env, 'num_envs') else AIRLRewardWrapper
-    return cls(env, new_reward, tf_cfg)
+def airl_reward_wrapper(env, new_reward, tf_cfg, deferred=False):
+    '''deferred only applies to vector environments.'''
+    if hasattr(env, 'num_envs'):
+        return AIRLVecRewardWrapper(env, new_reward, tf_cfg, deferred=deferred)
+    return AIRLRewardWrapper(env, new_reward, tf_cfg)
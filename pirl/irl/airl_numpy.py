@@ -0,0 +1,79 @@
+'''Session-free evaluation of learned AIRL rewards.
+
+AIRL rewards are small MLPs, but evaluating them with TensorFlow needs a
+graph and session per reward (see airl._setup_model). export converts a
+reward, as returned by airl.irl, into an MLPReward: a pure NumPy callable.
+This module does not import TensorFlow or rllab.'''
+
+import numpy as np
+
+# Supported models, by class name. AIRLStateOnly is airl.models.airl_state.AIRL.
+STATE_ONLY_MODELS = {'AIRL', 'AIRLStateOnly'}
+STATE_ACTION_MODELS = {'AIRLStateAction'}
+
+
+class MLPReward(object):
+    '''A ReLU MLP, as built by airl.models.architectures.relu_net, whose
+       input is observations, or observations and actions concatenated.'''
+    def __init__(self, weights, biases, state_only):
+        self.weights = [np.asarray(W, dtype=np.float32) for W in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.state_only = state_only
+
+    def __call__(self, obs, actions=None):
+        '''Returns the rewards of a batch of observations (and actions, unless
+           state_only), as a flat array.'''
+        obs = np.asarray(obs, dtype=np.float32)
+        x = obs.reshape(len(obs), -1)
+        if not self.state_only:
+            actions = np.asarray(actions, dtype=np.float32)
+            x = np.concatenate([x, actions.reshape(len(actions), -1)], axis=1)
+        for W, b in zip(self.weights[:-1], self.biases[:-1]):
+            x = np.maximum(x.dot(W) + b, 0)
+        return (x.dot(self.weights[-1]) + self.biases[-1])[:, 0]
+
+
+def _name(obj):
+    '''Name of a class or function, or of the registry path to it.'''
+    if isinstance(obj, str):
+        return obj.rpartition(':')[2].rpartition('.')[2]
+    return obj.__name__
+
+
+def export(reward):
+    '''Converts reward, a pair (model_cfg, reward_params) returned by airl.irl,
+       to an MLPReward computing the same output as the AIRL reward wrappers:
+       the reward of AIRLStateOnly, or the energy of AIRLStateAction.
+
+       Raises ValueError for unsupported models or architectures.'''
+    model_cfg, params = reward
+    kwargs = dict(model_cfg)
+    model = _name(kwargs.pop('model'))
+    if model in STATE_ONLY_MODELS:
+        arch = kwargs.get('reward_arch')
+        arch_args = kwargs.get('reward_arch_args') or {}
+        state_only = kwargs.get('state_only', False)
+    elif model in STATE_ACTION_MODELS:
+        arch = kwargs.get('discrim_arch')
+        arch_args = kwargs.get('discrim_arch_args') or {}
+        state_only = False
+    else:
+        raise ValueError("Unsupported model '{}'".format(model))
+    if arch is not None and _name(arch) != 'relu_net':
+        raise ValueError("Unsupported architecture '{}'".format(_name(arch)))
+
+    # The reward network is created first, so its variables lead the params:
+    # weights and biases of each hidden layer, then of the final layer.
+    num_layers = arch_args.get('layers', 2) + 1
+    params = [np.asarray(p) for p in params[:2 * num_layers]]
+    weights, biases = params[0::2], params[1::2]
+    if len(weights) != num_layers or len(biases) != num_layers:
+        raise ValueError('Expected {} layers of parameters'.format(num_layers))
+    for i, (W, b) in enumerate(zip(weights, biases)):
+        chained = i == 0 or W.shape[0] == weights[i - 1].shape[1]
+        if W.ndim != 2 or b.shape != W.shape[1:] or not chained:
+            raise ValueError('Unexpected parameter shapes {}, {} in layer {}'
+                             .format(W.shape, b.shape, i))
+    if weights[-1].shape[1] != 1:
+        raise ValueError('Reward network must have a single output')
+    return MLPReward(weights, biases, state_only)
@@ -11,7 +11,6 @@ sys.path = [osp.join(osp.dirname(__file__), 'dummy_mpi')] + old_path
 import mpi4py  # OK this is unused, imported only for side-effects
 sys.path = old_path
 
-import numpy as np
 import tensorflow as tf
 
 from baselines.common import tf_util
@@ -20,6 +19,7 @@ from baselines.gail.adversary import TransitionClassifier
 from baselines.gail.dataset.mujoco_dset import Dset
 
 from pirl.agents.sample import SampleMonitor
+from pirl.trajectories import as_batch
 
 ## IRL
 
@@ -28,9 +28,8 @@ def _make_dset(trajectories, randomize=True):
        from trajectories. GAIL does not care about episode bounds, so
        we concatenate together all trajectories, and optionally randomly
        sample state-action pairs.'''
-    obs = np.concatenate([x[0] for x in trajectories])
-    acs = np.concatenate([x[1] for x in trajectories])
-    return Dset(obs, acs, randomize)
+    trajectories = as_batch(trajectories)
+    return Dset(trajectories.observations, trajectories.actions, randomize)
 
 
 def _policy_factory(policy_cfg):
@@ -107,7 +106,10 @@ def irl(env, trajectories, discount, seed, log_dir, *,
     return None, policy_serialised
 
 
-def sample(env, policy_saved, num_episodes, seed, *, tf_cfg, policy_cfg=None):
+def sample(env, policy_saved, num_episodes, seed, *, tf_cfg, policy_cfg=None,
+           discount=None):
+    '''Samples num_episodes episodes. Returns their trajectories, or their
+       discounted returns if discount is not None.'''
     env = SampleMonitor(env)
 
     infer_graph = tf.Graph()
@@ -138,4 +140,7 @@ def sample(env, policy_saved, num_episodes, seed, *, tf_cfg, policy_cfg=None):
                     completed += 1
                     ob = env.reset()
 
-            return env.trajectories
\ No newline at end of file
+            batch = env.batch
+            if discount is not None:
+                return batch.discounted_returns(discount)
+            return batch
\ No newline at end of file
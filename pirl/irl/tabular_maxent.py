@@ -13,19 +13,18 @@ from scipy.special import logsumexp as sp_lse
 import torch
 from torch.autograd import Variable
 
+from pirl.trajectories import as_batch
 from pirl.utils import getattr_unwrapped, TrainingIterator
 
 #TODO: fully torchize?
 
 def empirical_counts(nS, trajectories, discount):
     """Compute empirical state-action feature counts from trajectories."""
-    counts = np.zeros((nS, ))
-    discounted_steps = 0
-    for states, actions in trajectories:
-        incr = np.cumprod([1] + [discount] * (len(states) - 1))
-        counts += np.bincount(states, weights=incr, minlength=nS)
-        discounted_steps += np.sum(incr)
-    return counts / discounted_steps
+    trajectories = as_batch(trajectories)
+    weights = trajectories.discount_weights(discount)
+    counts = np.bincount(trajectories.observations, weights=weights,
+                         minlength=nS)
+    return counts / np.sum(weights)
 
 def max_ent_policy(transition, reward, horizon, discount):
     """Backward pass of algorithm 1 of Ziebart (2008).
@@ -73,11 +72,9 @@ def expected_counts(policy, transition, initial_states, horizon, discount):
     return np.sum(counts, axis=1) / renorm
 
 def policy_loss(policy, trajectories):
-    loss = 0
+    trajectories = as_batch(trajectories)
     log_policy = np.log(policy)
-    for states, actions in trajectories:
-        loss += np.sum(log_policy[states, actions])
-    return loss
+    return np.sum(log_policy[trajectories.observations, trajectories.actions])
 
 default_optimizer = functools.partial(torch.optim.Adam, lr=1e-1)
 default_scheduler = {
@@ -0,0 +1,205 @@
+'''Append-only, crash-safe store of experiment results.
+
+Each leaf result is keyed by (seed, stage, algorithm, env, n, m), where:
+    - seed is the seed index, as in results.pkl;
+    - stage is one of 'rewards', 'values' or 'ground_truth';
+    - algorithm is the IRL algorithm for 'rewards', a pair (rl, irl) for
+      'values', and the RL algorithm for 'ground_truth'. As in results.pkl,
+      the value of IRL policies is stored under rl = 'irl', and the value
+      of expert policies under ground truth rl = 'expert';
+    - n and m are None for 'ground_truth'.
+
+Results are appended in batches as they become available. Each batch is a
+single checksummed frame, fsync'd before append returns: if a process dies
+mid-write, the partial frame is discarded when the store is next opened.
+results.pkl is a materialized view of the store (see nested).
+
+Values are also written to values.npz in a columnar format (see write_values),
+so they can be loaded without unpickling rewards or trajectories.'''
+
+import collections
+import io
+import logging
+import os
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+from pirl.utils import atomic_write, safeset
+
+logger = logging.getLogger('pirl.results')
+
+Key = collections.namedtuple('Key',
+                             ['seed', 'stage', 'algorithm', 'env', 'n', 'm'])
+
+# Frame header: payload length and CRC32 of payload
+_HEADER = struct.Struct('<QI')
+
+
+def _path(key):
+    '''Returns the path of key in the nested dictionary of results.'''
+    algorithm = key.algorithm
+    if not isinstance(algorithm, tuple):
+        algorithm = (algorithm, )
+    path = [key.stage, key.seed] + list(algorithm) + [key.env]
+    if key.stage != 'ground_truth':
+        path += [key.n, key.m]
+    return path
+
+
+class ResultsStore(object):
+    def __init__(self, path):
+        '''Opens the store at path, creating it if needed.'''
+        self.path = path
+        self._records = collections.OrderedDict()
+        self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            good = 0
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, crc = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                for key, value in pickle.loads(payload):
+                    self._records[Key(*key)] = value
+                good = f.tell()
+            size = f.seek(0, os.SEEK_END)
+        if good < size:
+            logger.warning('Discarding %d bytes of incomplete results at '
+                           'end of %s', size - good, self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+
+    def append(self, records):
+        '''Durably appends records, a list of (Key, value) pairs, as a single
+           batch: either all or none of them will be present on reload.'''
+        records = [(tuple(k), v) for k, v in records]
+        if not records:
+            return
+        payload = pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)
+        header = _HEADER.pack(len(payload), zlib.crc32(payload))
+        with open(self.path, 'ab') as f:
+            f.write(header + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        for k, v in records:
+            self._records[Key(*k)] = v
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def items(self):
+        return self._records.items()
+
+    def nested(self, seed=None):
+        '''Returns results in the format of run_experiment (excluding
+           trajectories): a dict mapping stage to nested dictionaries of
+           the form [seed][algorithm(s)][env][n][m]. If seed is specified,
+           returns only its results, omitting the seed level.'''
+        res = collections.OrderedDict()
+        for key, value in self._records.items():
+            if seed is not None:
+                if key.seed != seed:
+                    continue
+                path = _path(key)
+                path = path[:1] + path[2:]
+            else:
+                path = _path(key)
+            safeset(res, path, value)
+        return res
+
+
+# Length of path (see _path), excluding seed
+_DEPTH = {'rewards': 5, 'values': 6, 'ground_truth': 3}
+
+
+def _key(seed, path):
+    '''Inverse of _path, for a path without the seed.'''
+    stage, rest = path[0], path[1:]
+    if stage == 'ground_truth':
+        rl, env = rest
+        return Key(seed, stage, rl, env, None, None)
+    algorithm, (env, n, m) = rest[:-3], rest[-3:]
+    algorithm = tuple(algorithm) if len(algorithm) > 1 else algorithm[0]
+    return Key(seed, stage, algorithm, env, n, m)
+
+
+def flatten(seed, path, results):
+    '''Returns a list of (Key, value) pairs for results, the subtree of the
+       results of seed at path (excluding seed), e.g. ['rewards', irl].'''
+    if len(path) == _DEPTH[path[0]]:
+        return [(_key(seed, path), results)]
+    records = []
+    for k, v in results.items():
+        records += flatten(seed, path + [k], v)
+    return records
+
+
+# Columnar values file. The schema is:
+VALUE_COLUMNS = collections.OrderedDict([
+    ('seed', np.int32),
+    ('eval', str),  # RL algorithm (or 'irl'/'expert', as for Key.algorithm)
+    ('irl', str),  # IRL algorithm, or GROUND_TRUTH
+    ('env', str),
+    ('n', np.int32),
+    ('m', np.int32),
+    ('mean', np.float64),  # NaN if no value (e.g. imitation learners)
+    ('se', np.float64),
+    ('episodes', np.int64),  # -1 if unknown (e.g. exact values)
+])
+# Value of ground truth policies is stored with irl = GROUND_TRUTH, n = m = -1
+GROUND_TRUTH = 'gt'
+
+
+def _value_rows(store):
+    for key, value in store.items():
+        if key.stage == 'values':
+            rl, irl = key.algorithm
+            n, m = key.n, key.m
+        elif key.stage == 'ground_truth':
+            rl, irl = key.algorithm, GROUND_TRUTH
+            n, m = -1, -1
+        else:
+            continue
+        if value is None:
+            mean, se, episodes = np.nan, np.nan, -1
+        else:
+            mean, se = value[:2]
+            episodes = value[2] if len(value) > 2 else -1
+        yield key.seed, rl, irl, key.env, n, m, mean, se, episodes
+
+
+def write_values(path, store):
+    '''Writes the values in store to path in NumPy .npz format, with one
+       array per column in VALUE_COLUMNS. String columns are dictionary
+       encoded, as arrays <column>.codes and <column>.categories. Individual
+       columns can then be loaded without reading the rest of the file.'''
+    rows = list(_value_rows(store))
+    columns = list(zip(*rows)) if rows else [()] * len(VALUE_COLUMNS)
+    arrays = {}
+    for (name, dtype), column in zip(VALUE_COLUMNS.items(), columns):
+        if dtype is str:
+            categories = sorted(set(column))
+            lookup = {c: i for i, c in enumerate(categories)}
+            arrays[name + '.codes'] = np.array([lookup[x] for x in column],
+                                               dtype=np.int32)
+            arrays[name + '.categories'] = np.array(categories, dtype=str)
+        else:
+            arrays[name] = np.array(column, dtype=dtype)
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    atomic_write(path, buf.getvalue())
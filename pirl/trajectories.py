@@ -0,0 +1,142 @@
+'''Compact container for batches of trajectories.
+
+Trajectories were historically represented as lists of (observations,
+actions[, rewards]) tuples of NumPy arrays, one tuple per episode. Pickling
+thousands of small arrays (e.g. through Ray or the cache) is slow. A
+TrajectoryBatch stores each field as a single array, concatenated across
+episodes, plus the offsets of each episode. It behaves as a sequence of the
+same tuples, so existing consumers work unchanged.'''
+
+import collections.abc
+import operator
+
+import numpy as np
+
+
+class TrajectoryBatch(collections.abc.Sequence):
+    def __init__(self, offsets, observations, actions, rewards=None):
+        '''Episode i spans offsets[i]:offsets[i+1] of the arrays observations,
+           actions and (optionally) rewards. len(offsets) is one more than
+           the number of episodes; offsets[0] need not be zero.'''
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._arrays = (observations, actions)
+        if rewards is not None:
+            self._arrays += (rewards, )
+
+    @classmethod
+    def from_episodes(cls, episodes):
+        '''Builds a batch from a sequence of (obs, actions[, rewards]).'''
+        episodes = [tuple(np.asarray(x) for x in ep) for ep in episodes]
+        if not episodes:
+            return cls([0], np.zeros(0), np.zeros(0))
+        lengths = [len(ep[0]) for ep in episodes]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        arrays = [np.concatenate(field) for field in zip(*episodes)]
+        return cls(offsets, *arrays)
+
+    def _span(self):
+        return self.offsets[0], self.offsets[-1]
+
+    def _field(self, i):
+        lo, hi = self._span()
+        return self._arrays[i][lo:hi]
+
+    @property
+    def observations(self):
+        '''Observations of all episodes, concatenated (a view).'''
+        return self._field(0)
+
+    @property
+    def actions(self):
+        return self._field(1)
+
+    @property
+    def rewards(self):
+        return self._field(2) if self.has_rewards else None
+
+    @property
+    def has_rewards(self):
+        return len(self._arrays) == 3
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def without_rewards(self):
+        return TrajectoryBatch(self.offsets, *self._arrays[:2])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        '''Integers index an episode, returning a tuple of views.
+           Slices with unit step (e.g. [:m]) are O(1), returning a batch
+           sharing memory with this one.'''
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                return TrajectoryBatch(self.offsets[start:stop + 1],
+                                       *self._arrays)
+            return self.from_episodes([self[i]
+                                       for i in range(start, stop, step)])
+
+        idx = operator.index(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('episode index out of range')
+        lo, hi = self.offsets[idx], self.offsets[idx + 1]
+        return tuple(x[lo:hi] for x in self._arrays)
+
+    def __reduce__(self):
+        # Only serialize the span of the arrays this batch covers
+        lo, hi = self._span()
+        arrays = tuple(x[lo:hi] for x in self._arrays)
+        return (TrajectoryBatch, (self.offsets - lo, ) + arrays)
+
+    def __repr__(self):
+        return '<TrajectoryBatch: {} episodes, {} steps>'.format(
+            len(self), self._span()[1] - self._span()[0])
+
+    def episode_index(self):
+        '''Returns, for each step, the index of the episode containing it.'''
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def discount_weights(self, discount):
+        '''Returns discount ** t for each step, where t is the time step
+           within its episode.'''
+        lo, _hi = self._span()
+        start = np.repeat(self.offsets[:-1] - lo, self.lengths)
+        t = np.arange(len(start)) - start
+        return discount ** t
+
+    def discounted_returns(self, discount):
+        '''Returns the discounted return of each episode.'''
+        assert self.has_rewards
+        weighted = self.rewards * self.discount_weights(discount)
+        return np.bincount(self.episode_index(), weights=weighted,
+                           minlength=len(self))
+
+
+def concatenate(batches):
+    '''Returns a TrajectoryBatch containing the episodes of each of batches
+       in turn. Rewards are only kept if all batches have them.'''
+    batches = [as_batch(b) for b in batches]
+    batches = [b for b in batches if len(b) > 0]
+    if not batches:
+        return TrajectoryBatch.from_episodes([])
+    lengths = np.concatenate([b.lengths for b in batches])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    num_fields = 3 if all(b.has_rewards for b in batches) else 2
+    arrays = [np.concatenate([b._field(i) for b in batches])
+              for i in range(num_fields)]
+    return TrajectoryBatch(offsets, *arrays)
+
+
+def as_batch(trajectories):
+    '''Returns trajectories as a TrajectoryBatch. trajectories may be a
+       TrajectoryBatch already, or a sequence of tuples (in the older format).'''
+    if isinstance(trajectories, TrajectoryBatch):
+        return trajectories
+    return TrajectoryBatch.from_episodes(trajectories)
@@ -1,15 +1,21 @@
 import collections
-from distutils.dir_util import copy_tree
+from concurrent.futures import Future, ThreadPoolExecutor
+import errno
 import functools
+import hashlib
 import logging
 import inspect
 import os
+import pickle
 import random
 import socket
+import shutil
 import string
 import sys
+import tarfile
 import tempfile
 import time
+import weakref
 
 from gym.utils import seeding
 import hermes.backend.dict
@@ -18,6 +24,8 @@ import numpy as np
 import ray
 import ray.services
 
+from pirl.trajectories import TrajectoryBatch
+
 logger = logging.getLogger('pirl.utils')
 
 # Gym environment helpers
@@ -59,10 +67,79 @@ def id_generator(size=8):
     choices = random.choices(string.ascii_uppercase + string.digits, k=size)
     return ''.join(choices)
 
+# Filesystem helpers
+
+def atomic_write(path, data):
+    '''Writes data to path, such that readers see either no file,
+       or the complete contents.'''
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def fsync_dir(path):
+    '''Makes changes to the entries of directory path (e.g. renames) durable.'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _archive(src, dst, compress):
+    '''Writes the contents of directory src to an archive in directory dst.'''
+    mode, fname = ('w:gz', 'logs.tar.gz') if compress else ('w', 'logs.tar')
+    fd, tmp_path = tempfile.mkstemp(dir=dst, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            kwargs = {'compresslevel': 1} if compress else {}
+            with tarfile.open(fileobj=f, mode=mode, **kwargs) as tar:
+                tar.add(src, arcname='.')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(dst, fname))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    fsync_dir(dst)
+    return dst
+
+def promote_dir(src, dst, compress=True):
+    '''Moves the contents of directory src into the empty directory dst.
+       If they are on the same filesystem, src is renamed to dst. Otherwise,
+       src is archived into dst (compressed if compress) by a background
+       thread, and src must be left intact until this completes.
+
+       Returns a concurrent.futures.Future, done once dst is durable.'''
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    else:
+        os.chmod(dst, 0o755)
+        fsync_dir(os.path.dirname(dst))
+        future = Future()
+        future.set_result(dst)
+        return future
+
+    if promote_dir.executor is None:
+        promote_dir.executor = ThreadPoolExecutor(max_workers=1)
+    return promote_dir.executor.submit(_archive, src, dst, compress)
+promote_dir.executor = None
+
 # Caching
 def get_hermes():
     '''Creates a hermes.Hermes instance if one does not already exist;
-       otherwise, returns the existing instance.''' 
+       otherwise, returns the existing instance. The instance, and so its
+       connection pool, is shared by all cached functions in the process.'''
     if get_hermes.cache is None:
         cache_backend = os.environ.get('CACHE_BACKEND', 'redis')
         if cache_backend == 'redis':
@@ -73,10 +150,30 @@ def get_hermes():
             host = os.environ.get('RAY_HEAD_IP', socket.gethostname())
             port = 6380
             db = 0
+            kwargs = {}
+            ttl = os.environ.get('CACHE_TTL')
+            if ttl is not None:
+                # Opt-in eviction: entries expire, but tags (saved by hermes
+                # without a TTL) do not, so Redis' volatile-lfu policy never
+                # evicts tags (see config/redis/base.conf).
+                kwargs['ttl'] = int(ttl)
             get_hermes.cache = hermes.Hermes(hermes.backend.redis.Backend,
-                                             host=host, port=port, db=0)
-            logger.info('HermesCache: connected to %s:%d [db=%d]',
-                        host, port, db)
+                                             host=host, port=port, db=0,
+                                             **kwargs)
+            logger.info('HermesCache: connected to %s:%d [db=%d, ttl=%s]',
+                        host, port, db, ttl)
+        elif cache_backend == 'disk':
+            # Imported here to avoid a circular import
+            from pirl import cache_backend, config
+            path = os.environ.get('CACHE_DIR', config.CACHE_DIR)
+            max_bytes = os.environ.get('CACHE_MAX_BYTES')
+            if max_bytes is not None:
+                max_bytes = int(max_bytes)
+            policy = os.environ.get('CACHE_POLICY', 'lru')
+            get_hermes.cache = hermes.Hermes(cache_backend.Backend, path=path,
+                                             max_bytes=max_bytes, policy=policy)
+            logger.info('HermesCache: using disk backend at %s '
+                        '[max_bytes=%s, policy=%s]', path, max_bytes, policy)
         elif cache_backend == 'dict':
             get_hermes.cache = hermes.Hermes(hermes.backend.dict.Backend)
             logger.info('HermesCache: using dict backend (not persistent)')
@@ -85,23 +182,91 @@ def get_hermes():
     return get_hermes.cache
 get_hermes.cache = None
 
+# Arrays smaller than this are left to be pickled in cache keys
+KEY_INLINE_BYTES = 1024
+# Non-cryptographic hash of array buffers: xxhash if installed, as it is
+# several times faster than hashlib. Digests are prefixed by the hash used,
+# so nodes with and without xxhash never confuse their cache keys.
+try:
+    import xxhash
+    if hasattr(xxhash, 'xxh3_128'):  # xxhash >= 2.0
+        _ARRAY_HASH = ('xxh3_128', xxhash.xxh3_128)
+    else:
+        _ARRAY_HASH = ('xxh64', xxhash.xxh64)
+except ImportError:
+    _ARRAY_HASH = ('blake2b', functools.partial(hashlib.blake2b,
+                                                digest_size=16))
+# Tokens of TrajectoryBatch objects, which are hashed once however many
+# times they are passed (e.g. in a batch lookup, then the call itself).
+_batch_tokens = weakref.WeakKeyDictionary()
+
+def array_digest(x):
+    '''Returns a digest of the contents, dtype and shape of array x.
+       Hashes the buffer directly: much faster than pickling large arrays.'''
+    name, hash_fn = _ARRAY_HASH
+    h = hash_fn()
+    h.update('{}{}'.format(x.dtype.str, x.shape).encode('ascii'))
+    h.update(np.ascontiguousarray(x).reshape(-1).view(np.uint8))
+    return '{}:{}'.format(name, h.hexdigest())
+
+def key_token(x):
+    '''Returns a small picklable value standing in for x in cache keys.
+       Large NumPy arrays (including inside lists, tuples and dicts) are
+       replaced by their digest; everything else is left to be pickled.'''
+    if type(x) is np.ndarray:
+        if x.dtype.hasobject or x.nbytes < KEY_INLINE_BYTES:
+            return x
+        return ('ndarray', array_digest(x))
+    elif isinstance(x, TrajectoryBatch):
+        token = _batch_tokens.get(x)
+        if token is None:
+            # Tokens for the compact arrays serialized by pickle
+            _cls, args = x.__reduce__()
+            token = ('TrajectoryBatch', ) + tuple(key_token(y) for y in args)
+            _batch_tokens[x] = token
+        return token
+    elif type(x) in (list, tuple):
+        return type(x)(key_token(y) for y in x)
+    elif type(x) in (dict, collections.OrderedDict):
+        return type(x)((k, key_token(v)) for k, v in x.items())
+    return x
+
+def content_digest(*args):
+    '''Returns a hex digest of args, which must be picklable. Objects that are
+       equal in value (e.g. rewards inferred by different IRL algorithms that
+       happen to coincide) have the same digest.'''
+    h = hashlib.sha1()
+    for arg in args:
+        h.update(pickle.dumps(key_token(arg), protocol=pickle.HIGHEST_PROTOCOL))
+    return h.hexdigest()
+
 def cache_key_func(mangler, func_module, func_name, ignore=None):
+    signature = None
+
     @functools.wraps(mangler.nameEntry)
     def name_entry(fn, *args, **kwargs):
+        nonlocal signature
         #TODO: remove the func_name argument once cloudpickle issue #176 is fixed
         #cloudpickle plays havoc with names of decorated functions, but it
         #preserves objects that are in a closure correctly. So patch up the
         #function name (yuck)
         fn.__module__ = func_module
         fn.__name__ = func_name
-        signature = inspect.signature(fn)
+        if signature is None:
+            signature = inspect.signature(fn)
         bound = signature.bind_partial(*args, **kwargs)
         for fld in ignore:
             if fld in bound.arguments:
                 del bound.arguments[fld]
-        return mangler.nameEntry(fn, *bound.args, **bound.kwargs)
+        args = [key_token(x) for x in bound.args]
+        kwargs = {k: key_token(v) for k, v in bound.kwargs.items()}
+        return mangler.nameEntry(fn, *args, **kwargs)
     return name_entry
 
+# Maps 'module:function' to the tags of cached functions, so that entries can
+# be attributed to tags (see scripts/cache_gc.py).
+cache_tags = {}
+
 def cache(*oargs, **okwargs):
     '''Cache decorator taking the same arguments as the callable returned by
        hermes.Hermes. This is a hack to prevent cloudpickle choking on
@@ -116,6 +281,8 @@ def cache(*oargs, **okwargs):
             ignore = okwargs.pop('ignore')
 
         assert 'key' not in okwargs
+        name = '{}:{}'.format(func.__module__, func.__name__)
+        cache_tags[name] = tuple(okwargs.get('tags', ()))
         key_fn = cache_key_func(cache.mangler, func.__module__,
                                 func.__name__, ignore)
         okwargs['key'] = key_fn
@@ -123,6 +290,74 @@ def cache(*oargs, **okwargs):
         return cache(*oargs, **okwargs)(func)
     return decorator
 
+# Batch lookups. Each is a single round trip to the backend (an SQL query,
+# or a Redis MGET/pipeline), rather than one per call. calls is a list of
+# (args, kwargs) pairs for cached_fn, a function decorated by hermes.Hermes.
+
+MISSING = object()  # placeholder for cache misses
+
+class CallError(object):
+    '''Returned in place of the result of a call that raised an exception,
+       with its formatted traceback.'''
+    def __init__(self, traceback):
+        self.traceback = traceback
+
+    def reraise(self):
+        raise RuntimeError('Remote call failed:\n' + self.traceback)
+
+def _frontend(cached_fn):
+    '''Returns the hermes.Hermes instance cached_fn was decorated by.'''
+    return getattr(cached_fn, '_frontend', None) or get_hermes()
+
+def _entry_keys(cached_fn, calls):
+    '''Returns the keys cached_fn stores calls under, or None if they cannot
+       be present (their tags do not yet exist). Mirrors hermes.Cached: the
+       key is that returned by its key function (by default, the mangler's
+       nameEntry), suffixed by ':' and the hash of the tag values if tagged.
+       Uses hermes internals (Cached._keyFunc, _callable and _tags).'''
+    frontend = _frontend(cached_fn)
+    mangler = frontend.mangler
+    key_fn = getattr(cached_fn, '_keyFunc', None) or mangler.nameEntry
+    fn = getattr(cached_fn, '_callable', cached_fn)
+    keys = [key_fn(fn, *args, **kwargs) for args, kwargs in calls]
+    tags = getattr(cached_fn, '_tags', None)
+    if tags:
+        tag_keys = [mangler.nameTag(tag) for tag in tags]
+        tag_map = frontend.backend.load(tag_keys)
+        if len(tag_map) < len(tag_keys):
+            return None
+        suffix = ':' + mangler.hashTags(tag_map)
+        keys = [k + suffix for k in keys]
+    return keys
+
+def get_many(cached_fn, calls):
+    '''Returns a list of the cached results of calls, with MISSING for
+       those not in the cache. Does not call cached_fn on misses.'''
+    keys = _entry_keys(cached_fn, calls)
+    if keys is None:
+        return [MISSING] * len(calls)
+    values = _frontend(cached_fn).backend.load(keys)
+    values = [values.get(k) for k in keys]
+    return [MISSING if v is None else v for v in values]
+
+def exists_many(cached_fn, calls):
+    '''Returns a list of booleans: whether each of calls is in the cache.
+       Unlike get_many, values are not transferred.'''
+    keys = _entry_keys(cached_fn, calls)
+    if keys is None:
+        return [False] * len(calls)
+    backend = _frontend(cached_fn).backend
+    if hasattr(backend, 'exists'):  # pirl.cache_backend.Backend
+        return backend.exists(keys)
+    elif hasattr(backend, 'client'):  # Redis
+        pipe = backend.client.pipeline(transaction=False)
+        for k in keys:
+            pipe.exists(k)
+        return [bool(x) for x in pipe.execute()]
+    else:
+        values = backend.load(keys)
+        return [k in values for k in keys]
+
 # Logging
 
 class TrainingIterator(object):
@@ -186,19 +421,32 @@ def _temporary_error(exc):
                     ' killing worker to force a retry.', exc_info=exc)
     sys.exit(-1)
 
-log_dirs = set()
-def cache_and_log(out_dir):
+def _task_log_dirs():
+    '''Returns the set of log directories used by the current Ray task.
+       CPU workers are long-lived (max_calls=0), so this is reset when a new
+       task starts, rather than growing over the life of the worker.'''
+    task_id = getattr(ray.worker.global_worker, 'current_task_id', None)
+    if _task_log_dirs.task_id != task_id:
+        _task_log_dirs.task_id = task_id
+        _task_log_dirs.log_dirs = set()
+    return _task_log_dirs.log_dirs
+_task_log_dirs.task_id = None
+_task_log_dirs.log_dirs = set()
+
+def cache_and_log(out_dir, compress=True):
     '''Given an argument out_dir, returns a decorator that will log results to
        out_dir, logging to a temporary directory during execution. Handles
        node failures and caching.
 
        Specifically, the decorated function must take a parameter log_dir.
        The decorator intercepts the log_dir provided by the callee,
-       and creates a temporary directory on the local machine.
+       and creates a temporary (hidden) directory in out_dir.
 
-       If the task is successful, this temporary directory is copied to out_dir,
-       with a unique object id. A symlink to this directory is then made from
-       the callee-specified log_dir.
+       If the task is successful, this temporary directory is moved to out_dir,
+       with a unique object id: by renaming it, falling back to a
+       (compressed, if compress) archive, see promote_dir. A symlink to this
+       directory is then made from the callee-specified log_dir. Large return values are stored in
+       the blob store (see pirl.blobs), and only a pointer is cached.
 
        No entry is made when the task is unsuccessful.
 
@@ -209,27 +457,37 @@ def cache_and_log(out_dir):
        Note this should be applied to the function(s) closest to the point
        where logging output is actually produced. In particular, do not apply
        it to two functions that receive the same log_dir!'''
+    # Imported here to avoid a circular import
+    from pirl.blobs import get_blob_store
+
     def make_decorator(*oargs, **okwargs):
         def decorator(func):
             @functools.wraps(func)
             def pre_cache_wrapper(*args, **kwargs):
                 '''Creates a temporary directory tmp_dir for logging,
                    and calls func(*args, **kwargs, log_dir=tmp_dir).
-                   Upon completion of the function, it copies tmp_dir over to
+                   Upon completion of the function, it moves tmp_dir over to
                    a newly created directory in out_dir.
                    The main purpose of this is to isolate errors in the function
                    from errors in accessing out_dir.'''
-                with tempfile.TemporaryDirectory(prefix='pirl') as tmp_dir:
+                # Created in out_dir so promote_dir can simply rename it.
+                # Abandoned directories are removed by scripts/cache_gc.py.
+                try:
+                    os.makedirs(out_dir, exist_ok=True)
+                    tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=out_dir)
+                except OSError as e:
+                    _temporary_error(e)
+                try:
                     # Run the function
                     res = func(*args, **kwargs, log_dir=tmp_dir)
 
                     # Success! (If an exception happens, we never reach here)
-                    # Copy results to a new directory in out_dir
+                    # Move results to a new directory in out_dir
                     try:
-                        os.makedirs(out_dir, exist_ok=True)
                         permanent_dir = tempfile.mkdtemp(dir=out_dir)
                         os.chmod(permanent_dir, 0o755)
-                        copy_tree(tmp_dir, permanent_dir)
+                        promoted = promote_dir(tmp_dir, permanent_dir,
+                                               compress=compress)
                     except OSError as e:
                         # Copying could fail for two reasons.
                         # (1) Node failure -- either it is being preempted,
@@ -239,36 +497,44 @@ def cache_and_log(out_dir):
                         # loudly in the logs in case it's (2).
                         _temporary_error(e)
 
+                    # Large results are stored in the blob store, with only a
+                    # small pointer held by the cache backend. (This overlaps
+                    # with archiving logs, if promote_dir is doing so.)
+                    res = get_blob_store().put(res)
+
+                    # Only return (and so cache the result) once the logs
+                    # are durable.
+                    try:
+                        promoted.result()
+                    except OSError as e:
+                        _temporary_error(e)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+
                 # Append permanent_dir to return value, so caller knows where
                 # to look for results.
                 return res, permanent_dir
 
             cached_fn = cache(*oargs, **okwargs)(pre_cache_wrapper)
 
-            @functools.wraps(cached_fn)
-            def post_cache_wrapper(*args, **kwargs):
-                '''Calls cached_fn(*args, **kwargs_exc) where kwargs_exc has
-                   had log_dir removed from it. It adds a symlink at log_dir
-                   pointing to the log directory returned by cached_fn, and
-                   returns the result returned originally by func.'''
-                # Inspection & argument extraction
+            def bind(args, kwargs):
+                '''Returns (bound, sym_fname): the arguments to cached_fn,
+                   and the user-requested log directory.'''
                 signature = inspect.signature(func)
                 bound = signature.bind(*args, **kwargs)
-                arguments = bound.arguments
-
                 # sym_fname is the user-requested log directory.
                 # However, we log to a temporary directory, only making a
                 # symbolic link to the temporary directory once finished.
-                ultimate_log_dir = arguments.pop('log_dir')
+                ultimate_log_dir = bound.arguments.pop('log_dir')
                 sym_fname = os.path.abspath(ultimate_log_dir)
                 # Catch common misuse of this decorator
-                if sym_fname in log_dirs:
+                if sym_fname in _task_log_dirs():
                     msg = "Duplicate log directory '{}'".format(sym_fname)
                     raise AssertionError(msg)
-                log_dirs.add(sym_fname)
-
-                res, permanent_log_dir = cached_fn(*bound.args, **bound.kwargs)
+                return bound, sym_fname
 
+            def link(permanent_log_dir, sym_fname):
+                _task_log_dirs().add(sym_fname)
                 try:
                     os.makedirs(os.path.dirname(sym_fname), exist_ok=True)
                     os.symlink(permanent_log_dir, sym_fname,
@@ -280,8 +546,51 @@ def cache_and_log(out_dir):
                 except OSError as e:
                     _temporary_error(e)
 
+            @functools.wraps(cached_fn)
+            def post_cache_wrapper(*args, **kwargs):
+                '''Calls cached_fn(*args, **kwargs_exc) where kwargs_exc has
+                   had log_dir removed from it. It adds a symlink at log_dir
+                   pointing to the log directory returned by cached_fn, and
+                   returns the result returned originally by func.'''
+                bound, sym_fname = bind(args, kwargs)
+                _task_log_dirs().add(sym_fname)
+                res, permanent_log_dir = cached_fn(*bound.args, **bound.kwargs)
+                try:
+                    res = get_blob_store().get(res)
+                except FileNotFoundError:
+                    # Blob has been deleted (e.g. garbage collected).
+                    logger.warning('Blob for cached %s missing, recomputing',
+                                   func.__name__)
+                    cached_fn.invalidate(*bound.args, **bound.kwargs)
+                    res, permanent_log_dir = cached_fn(*bound.args,
+                                                       **bound.kwargs)
+                    res = get_blob_store().get(res)
+
+                link(permanent_log_dir, sym_fname)
                 return res
 
+            def lookup_many(calls):
+                '''Returns the results of calls, a list of keyword argument
+                   dicts, that are already cached, with MISSING for the rest.
+                   Hits are linked to their log_dir, as post_cache_wrapper
+                   would. Uses a single round trip to the cache backend.'''
+                bounds = [bind((), kwargs) for kwargs in calls]
+                values = get_many(cached_fn, [(bound.args, bound.kwargs)
+                                              for bound, _ in bounds])
+                results = []
+                for (_bound, sym_fname), value in zip(bounds, values):
+                    if value is not MISSING:
+                        res, permanent_log_dir = value
+                        try:
+                            value = get_blob_store().get(res)
+                            link(permanent_log_dir, sym_fname)
+                        except FileNotFoundError:
+                            # Leave it to post_cache_wrapper to recompute
+                            value = MISSING
+                    results.append(value)
+                return results
+            post_cache_wrapper.lookup_many = lookup_many
+
             return post_cache_wrapper
         return decorator
     return make_decorator
@@ -321,14 +630,55 @@ def leaf_map_nested_dict(ob, func, init=[]):
     else:
         return func(ob, init)
 
-def _get_nested_dict_helper(future, _keys):
-    return ray.get(future)
-
-def ray_get_nested_dict(ob, level=1):
-    return map_nested_dict(ob, _get_nested_dict_helper, level=level)
-
-def ray_leaf_get_nested_dict(ob):
-    return leaf_map_nested_dict(ob, _get_nested_dict_helper)
+def ray_iter_completed(objects, callback=None):
+    '''Yields (i, value) for each element objects[i], in the order they
+       complete. Elements that are not object IDs are yielded immediately.
+       Ready objects are fetched together, in one ray.get per batch.
+       If specified, callback(completed, total) is called after each batch.'''
+    total = len(objects)
+    completed = 0
+    positions = collections.OrderedDict()  # object ID -> indices into objects
+    for i, ob in enumerate(objects):
+        if isinstance(ob, ray.ObjectID):
+            positions.setdefault(ob, []).append(i)
+        else:
+            completed += 1
+            yield i, ob
+    if callback is not None and completed > 0:
+        callback(completed, total)
+
+    remaining = list(positions.keys())
+    while remaining:
+        ready, remaining = ray.wait(remaining, num_returns=1)
+        if remaining:  # anything else that is ready
+            more, remaining = ray.wait(remaining, num_returns=len(remaining),
+                                       timeout=0)
+            ready += more
+        for object_id, value in zip(ready, ray.get(ready)):
+            for i in positions[object_id]:
+                completed += 1
+                yield i, value
+        if callback is not None:
+            callback(completed, total)
+
+def _ray_get_leaves(ob, mapper, callback):
+    leaves = []
+    mapper(ob, lambda x, _keys: leaves.append(x))
+    values = [None] * len(leaves)
+    for i, value in ray_iter_completed(leaves, callback):
+        values[i] = value
+    values = iter(values)
+    return mapper(ob, lambda _x, _keys: next(values))
+
+def ray_get_nested_dict(ob, level=1, callback=None):
+    '''Returns ob with the object IDs at depth level replaced by their
+       values. Fetches in completion order; see ray_iter_completed.'''
+    mapper = functools.partial(map_nested_dict, level=level)
+    return _ray_get_leaves(ob, mapper, callback)
+
+def ray_leaf_get_nested_dict(ob, callback=None):
+    '''As ray_get_nested_dict, for the object IDs at the leaves of ob.'''
+    return _ray_get_leaves(ob, leaf_map_nested_dict, callback)
 
 # GPU Management
 
@@ -39,10 +39,16 @@ def parse_args():
     parser.add_argument('--num-gpu', metavar='N', default=None, type=int)
     parser.add_argument('--ray-server', metavar='HOST',
                         default=config.RAY_SERVER, type=str)
+    parser.add_argument('--resume', metavar='DIR', default=None, type=str,
+                        help='output directory of an interrupted run to '
+                             'resume (only valid with a single experiment)')
     parser.add_argument('experiments', metavar='experiment',
                         type=experiment_type, nargs='+')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.resume is not None and len(args.experiments) != 1:
+        parser.error('--resume requires exactly one experiment')
+    return args
 
 def git_hash():
     hash = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
@@ -58,6 +64,13 @@ ISO_TIMESTAMP = "%Y%m%d_%H%M%S"
 
 def node_setup(_cfg):
     logging.config.dictConfig(config.LOG_CFG)
+    # CPU-only tasks run on long-lived workers: import their dependencies
+    # up-front, so the first task on each worker does not pay for this.
+    # Algorithms are registered lazily, so import their modules explicitly.
+    # pylint:disable=unused-import
+    import pirl.experiments
+    import pirl.agents.tabular
+    import pirl.irl.tabular_maxent
 
 if __name__ == '__main__':
     # Argument parsing
@@ -83,16 +96,20 @@ if __name__ == '__main__':
     # Experiment loop
     for experiment in args.experiments:
         # reseed so does not matter which order experiments are run in
-        timestamp = datetime.now().strftime(ISO_TIMESTAMP)
-        version = git_hash()
-        out_dir = '{}-{}-{}'.format(experiment, timestamp, version)
-        path = os.path.join(config.EXPERIMENTS_DIR, out_dir)
-        os.makedirs(path)
+        if args.resume is None:
+            timestamp = datetime.now().strftime(ISO_TIMESTAMP)
+            version = git_hash()
+            out_dir = '{}-{}-{}'.format(experiment, timestamp, version)
+            path = os.path.join(config.EXPERIMENTS_DIR, out_dir)
+            os.makedirs(path)
+        else:
+            path = args.resume
 
         cfg = config.EXPERIMENTS[experiment]
         res = experiments.run_experiment(cfg, path, args.seed)
 
         logger.info('Experiment %s completed. Outcome:\n %s. Saving to %s.',
                     experiment, res['values'], path)
+        # Materialized view of results.log (see pirl.results), plus trajectories
         with open('{}/results.pkl'.format(path), 'wb') as f:
             pickle.dump(res, f)
@@ -0,0 +1,216 @@
+'''Reports cache usage by tag, and garbage collects the cache and OBJECT_DIR.
+
+Garbage collection:
+  - removes cache entries whose log directory in OBJECT_DIR, or whose blob
+    (see pirl.blobs), no longer exists;
+  - removes cache entries orphaned by scripts/invalidate_cache.py: those
+    stored under tag values that have since been invalidated;
+  - deletes directories in OBJECT_DIR, and blobs, that no entry references.
+Directories and blobs modified within --min-age hours are kept, since they
+may belong to tasks that are still running.
+
+With the disk backend, --max-bytes also evicts entries to fit in a budget
+before garbage collecting, which deletes the directories and blobs only the
+evicted entries referenced. With Redis, set maxmemory and maxmemory-policy
+instead (config/redis).'''
+
+import argparse
+import collections
+import os
+import os.path as osp
+import shutil
+import time
+
+from pirl import blobs, cache_backend, config, utils
+# Imported for side-effect of registering cached functions in utils.cache_tags
+import pirl.experiments  # noqa: F401
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stats', action='store_true',
+                        help='print sizes by tag, and exit')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would be removed, but do not')
+    parser.add_argument('--min-age', type=float, default=24,
+                        help='hours since modification before deleting '
+                             'unreferenced directories and blobs')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='evict entries beyond this size (disk backend)')
+    return parser.parse_args()
+
+
+def entry_sizes(cache):
+    '''Returns a dict mapping keys of entries (excluding tags) to their size
+       in the backend.'''
+    backend = cache.backend
+    if isinstance(backend, cache_backend.Backend):
+        return backend.sizes()
+    elif hasattr(backend, 'client'):  # Redis
+        prefix = cache.mangler.prefix
+        tag_prefix = cache.mangler.nameTag('')
+        keys = [k.decode('utf-8') for k in
+                backend.client.scan_iter(match=prefix + ':*')]
+        return {k: backend.client.strlen(k) for k in keys
+                if not k.startswith(tag_prefix)}
+    else:
+        raise ValueError('Backend {} is not persistent'.format(type(backend)))
+
+
+def load_entries(cache, keys, chunk_size=500):
+    '''Yields (key, value) for each of keys present in the cache.'''
+    keys = list(keys)
+    for start in range(0, len(keys), chunk_size):
+        res = cache.backend.load(keys[start:start + chunk_size])
+        yield from ((k, v) for k, v in res.items() if v is not None)
+
+
+def tags_of(key):
+    for name, tags in utils.cache_tags.items():
+        if ':{}:'.format(name) in key:
+            return tags or ('(untagged)', )
+    return ('(unknown)', )
+
+
+def tag_suffixes(cache):
+    '''Returns a dict mapping each tagged cached function to the suffix of
+       its current entry keys (see utils._entry_keys), or None if its tags
+       no longer exist.'''
+    mangler = cache.mangler
+    suffixes = {}
+    for name, tags in utils.cache_tags.items():
+        if not tags:
+            continue
+        tag_keys = [mangler.nameTag(tag) for tag in tags]
+        tag_map = cache.backend.load(tag_keys)
+        if len(tag_map) < len(tag_keys):
+            suffixes[name] = None
+        else:
+            suffixes[name] = ':' + mangler.hashTags(tag_map)
+    return suffixes
+
+
+def orphaned(key, suffixes):
+    '''Whether key is an entry stored under tag values that have since been
+       invalidated, so can no longer be looked up.'''
+    for name, suffix in suffixes.items():
+        if ':{}:'.format(name) in key:
+            return suffix is None or not key.endswith(suffix)
+    return False
+
+
+def stats(cache, sizes):
+    store = blobs.get_blob_store()
+    count = collections.Counter()
+    total = collections.Counter()
+    for key, value in load_entries(cache, sizes.keys()):
+        size = sizes[key]
+        for ref in blobs.references(value):
+            if store.contains(ref):
+                size += os.path.getsize(store.blob_path(ref))
+        for tag in tags_of(key):
+            count[tag] += 1
+            total[tag] += size
+
+    print('{:<20} {:>8} {:>12}'.format('tag', 'entries', 'MiB'))
+    for tag, nbytes in total.most_common():
+        print('{:<20} {:>8} {:>12.1f}'.format(tag, count[tag], nbytes / 2**20))
+    print('Entries may have multiple tags, and blobs may be shared: '
+          'totals can overlap.')
+
+
+def log_dir(value):
+    '''Returns the directory in OBJECT_DIR referenced by value, or None.'''
+    object_dir = osp.abspath(config.OBJECT_DIR)
+    if isinstance(value, tuple) and len(value) == 2:
+        path = value[1]
+        if isinstance(path, str) and osp.dirname(path) == object_dir:
+            return path
+    return None
+
+
+def old_enough(path, min_age):
+    try:
+        return time.time() - os.lstat(path).st_mtime > min_age * 3600
+    except FileNotFoundError:
+        return False
+
+
+def gc(cache, sizes, min_age, dry_run):
+    store = blobs.get_blob_store()
+    suffixes = tag_suffixes(cache)
+    invalidated = [key for key in sizes if orphaned(key, suffixes)]
+    print('Removing {} entries orphaned by invalidated tags'.format(
+          len(invalidated)))
+    if not dry_run and invalidated:
+        cache.backend.remove(invalidated)
+
+    stale = []
+    live_dirs = set()
+    live_blobs = set()
+    invalidated = set(invalidated)
+    current = [key for key in sizes if key not in invalidated]
+    for key, value in load_entries(cache, current):
+        path = log_dir(value)
+        refs = blobs.references(value)
+        missing_dir = path is not None and not osp.isdir(path)
+        missing_blob = not all(store.contains(ref) for ref in refs)
+        if missing_dir or missing_blob:
+            stale.append(key)
+        else:
+            if path is not None:
+                live_dirs.add(osp.basename(path))
+            live_blobs.update(osp.basename(store.blob_path(r)) for r in refs)
+
+    print('Removing {} entries with missing log directory or blob'.format(
+          len(stale)))
+    if not dry_run and stale:
+        cache.backend.remove(stale)
+
+    orphans = []
+    if osp.isdir(config.OBJECT_DIR):
+        for name in os.listdir(config.OBJECT_DIR):
+            path = osp.join(config.OBJECT_DIR, name)
+            if name not in live_dirs and old_enough(path, min_age):
+                orphans.append(path)
+    if osp.isdir(store.path):
+        for dirpath, _dirnames, filenames in os.walk(store.path):
+            for name in filenames:
+                path = osp.join(dirpath, name)
+                if name not in live_blobs and old_enough(path, min_age):
+                    orphans.append(path)
+
+    print('Deleting {} unreferenced directories and blobs'.format(
+          len(orphans)))
+    for path in orphans:
+        if dry_run:
+            print(path)
+        elif osp.isdir(path) and not osp.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.unlink(path)
+
+
+def run():
+    args = parse_args()
+    cache = utils.get_hermes()
+    sizes = entry_sizes(cache)
+    if args.stats:
+        stats(cache, sizes)
+        return
+
+    if args.max_bytes is not None:
+        if not isinstance(cache.backend, cache_backend.Backend):
+            raise ValueError('--max-bytes is only supported by disk backend')
+        if args.dry_run:
+            print('Skipping eviction in dry run')
+        else:
+            evicted = cache.backend.evict(args.max_bytes)
+            print('Evicted {} entries'.format(len(evicted)))
+            sizes = entry_sizes(cache)
+
+    gc(cache, sizes, args.min_age, args.dry_run)
+
+
+if __name__ == '__main__':
+    run()
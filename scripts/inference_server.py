@@ -0,0 +1,40 @@
+'''Runs a shared inference server for the worker processes on this node.
+
+Set INFERENCE_SOCKET in pirl/config/config_local.py to the same path for
+workers to use it (see pirl.inference).'''
+
+import argparse
+import logging.config
+
+from pirl import config
+from pirl.inference import InferenceServer
+
+logger = logging.getLogger('pirl.inference')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--socket', default=config.INFERENCE_SOCKET,
+                        required=config.INFERENCE_SOCKET is None,
+                        help='path of Unix socket to listen on')
+    parser.add_argument('--max-batch', type=int, default=4096,
+                        help='maximum rows per batch')
+    parser.add_argument('--max-delay', type=float, default=2.0,
+                        help='milliseconds to wait for a batch to fill')
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    logging.config.dictConfig(config.LOG_CFG)
+    server = InferenceServer(args.socket, max_batch=args.max_batch,
+                             max_delay=args.max_delay / 1000)
+    logger.info('Listening on %s', args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    run()
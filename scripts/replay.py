@@ -40,7 +40,8 @@ def airl_checkpoint(envs, fname, num_episodes, seed):
         checkpoint = joblib.load(fname)  # depickling needs a default session
         policy = checkpoint['policy']
         policy_pkl = pickle.dumps(policy)
-    airl.sample(envs, policy_pkl, num_episodes, seed, tf_cfg=config.TENSORFLOW)
+    airl.sample(envs, policy_pkl, num_episodes, seed,
+                tf_cfg=config.make_tf_config())
 
 
 def sample_decorator(f):
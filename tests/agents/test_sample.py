@@ -0,0 +1,88 @@
+import gym
+import numpy as np
+
+from baselines.common.vec_env import VecEnv
+
+from pirl.agents.sample import SampleVecMonitor, VecEvaluator, value
+
+
+class FixedLengthVecEnv(VecEnv):
+    '''Environment i has episodes of length i + 1, with reward 1 per step.'''
+    def __init__(self, num_envs):
+        space = gym.spaces.Box(low=0, high=np.inf, shape=(1, ))
+        super().__init__(num_envs, space, space)
+        self.lengths = np.arange(num_envs) + 1
+        self.t = np.zeros(num_envs, dtype=np.int64)
+
+    def reset(self):
+        self.t[:] = 0
+        return self.t[:, np.newaxis].astype(np.float32)
+
+    def step_async(self, actions):
+        pass
+
+    def step_wait(self):
+        self.t += 1
+        dones = self.t == self.lengths
+        self.t[dones] = 0
+        obs = self.t[:, np.newaxis].astype(np.float32)
+        return obs, np.ones(self.num_envs), dones, [{}] * self.num_envs
+
+    def close(self):
+        pass
+
+
+def _run(evaluator):
+    evaluator.reset()
+    actions = np.zeros((evaluator.num_envs, 1))
+    while not evaluator.finished:
+        evaluator.step(actions)
+    return evaluator.result()
+
+
+def test_exact_episodes():
+    batch = _run(VecEvaluator(FixedLengthVecEnv(3), 7))
+    assert len(batch) == 7
+    # Quotas are 3, 2, 2: short episodes are not over-represented
+    assert sorted(batch.lengths) == [1, 1, 1, 2, 2, 3, 3]
+    assert np.all(batch.rewards == 1)
+
+
+def test_returns():
+    returns = _run(VecEvaluator(FixedLengthVecEnv(2), 4, discount=0.5))
+    assert sorted(returns) == [1.0, 1.0, 1.5, 1.5]
+
+
+def test_deferred_relabel():
+    monitor = SampleVecMonitor(FixedLengthVecEnv(2), deferred=True)
+    monitor.reset()
+    actions = np.zeros((2, 1))
+    for _ in range(3):
+        monitor.step(actions)
+    assert len(monitor.trajectories) == 0
+    monitor.relabel(np.array([[0, 10], [1, 11], [2, 12]]))
+    rewards = [list(traj[2]) for traj in monitor.trajectories]
+    assert rewards == [[0], [1], [10, 11], [2]]
+    monitor.step(actions)
+    monitor.relabel(np.array([[3, 13]]))
+    rewards = [list(traj[2]) for traj in monitor.trajectories[4:]]
+    assert rewards == [[3], [12, 13]]
+
+
+def _normal_sample(envs, policy, num_episodes, seed, discount):
+    return np.random.RandomState(seed).normal(policy, 1, num_episodes)
+
+
+def test_sequential_value():
+    mean, se, episodes = value(_normal_sample, None, 0.0, 1.0, 0,
+                               num_episodes=1000, target_se=0.1)
+    assert se <= 0.1
+    assert 20 < episodes < 1000
+    # Stops after min_episodes if the target is already met
+    _mean, _se, episodes = value(_normal_sample, None, 0.0, 1.0, 0,
+                                 num_episodes=1000, target_se=10)
+    assert episodes == 20
+    # And never exceeds num_episodes
+    _mean, se, episodes = value(_normal_sample, None, 0.0, 1.0, 0,
+                                num_episodes=50, target_se=0.01)
+    assert episodes == 50
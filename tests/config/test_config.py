@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+import pytest
+
+from pirl import config
+
+@pytest.mark.parametrize("experiment", sorted(config.EXPERIMENTS.keys()))
+def test_parse_experiment(experiment):
+    """Experiments are parsed on first lookup: check they are all valid."""
+    cfg = config.EXPERIMENTS[experiment]
+    assert 'test_environments' in cfg
+
+
+def test_tabular_lazy():
+    """Looking up tabular algorithms should not import TensorFlow.
+       Runs in a fresh interpreter, as other tests may import TensorFlow."""
+    code = '\n'.join([
+        'import sys',
+        'from pirl import config',
+        "config.RL_ALGORITHMS['value_iteration']",
+        "config.SINGLE_IRL_ALGORITHMS['mce']",
+        "config.POPULATION_IRL_ALGORITHMS['mcep_reg0']",
+        "config.POPULATION_IRL_ALGORITHMS['mcec']",
+        "config.EXPERIMENTS['few-jungle-4x4-Soda']",
+        "assert 'tensorflow' not in sys.modules",
+    ])
+    subprocess.check_call([sys.executable, '-c', code])
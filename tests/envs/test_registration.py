@@ -0,0 +1,41 @@
+import gym
+import pytest
+
+import pirl.envs  # needed for side effect of registering environments
+
+@pytest.mark.parametrize("env_name", [
+    'pirl/GridWorld-Simple-v0',
+    'pirl/GridWorld-Jungle-4x4-Liquid-v0',
+    'pirl/MountainCarContinuous-2-left-target-0.1-0.05-v0',
+    'pirl/MountainCarContinuous-3-red-0-0.25-v0',
+    'pirl/ReacherGoal-seed7-0.5-v0',
+    'pirl/ReacherWall-seed1-50-1.0-v0',
+    'pirl/ReacherWall-nowall-100-0.1-v0',
+    'pirl/Billiards4-seed9-v0',
+])
+def test_registered(env_name):
+    """Environments in lazily registered families resolve on lookup."""
+    assert gym.spec(env_name).id == env_name
+
+
+@pytest.mark.parametrize("env_name", [
+    'pirl/GridWorld-Jungle-5x5-Soda-v0',
+    'pirl/MountainCarContinuous-5-left-0-0.05-v0',
+    'pirl/MountainCarContinuous-2-left-0.2-0.05-v0',
+    'pirl/Billiards5-seed0-v0',
+])
+def test_unregistered(env_name):
+    """IDs outside of the parameter grid are not registered."""
+    with pytest.raises(gym.error.Error):
+        gym.spec(env_name)
+
+
+def test_mountain_car_kwargs():
+    spec = gym.spec('pirl/MountainCarContinuous-4-left-target-1-0.1-v0')
+    assert spec._kwargs == {
+        'num_peaks': 4,
+        'goal_reward': [100, -100],
+        'goal_position': [0.01, 4 - 1.01],
+        'vel_penalty': 1,
+        'initial_noise': 0.1,
+    }
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from pirl.irl import airl_numpy
+
+
+def _params(rng, sizes):
+    params = []
+    for din, dout in zip(sizes[:-1], sizes[1:]):
+        params += [rng.randn(din, dout), rng.randn(dout)]
+    return params
+
+
+def test_state_only():
+    rng = np.random.RandomState(0)
+    # Trailing params (e.g. the value function) are ignored
+    params = _params(rng, [3, 32, 32, 1]) + _params(rng, [3, 32, 32, 1])
+    cfg = {'model': 'pirl.irl.airl:AIRLStateOnly', 'state_only': True}
+    reward = airl_numpy.export((cfg, params))
+
+    obs = rng.randn(5, 3)
+    x = obs
+    for W, b in zip(params[0:4:2], params[1:4:2]):
+        x = np.maximum(x.dot(W) + b, 0)
+    expected = (x.dot(params[4]) + params[5])[:, 0]
+    np.testing.assert_allclose(reward(obs), expected, rtol=1e-4)
+
+
+def test_state_action():
+    rng = np.random.RandomState(0)
+    params = _params(rng, [5, 8, 1])
+    cfg = {'model': 'AIRLStateAction', 'discrim_arch_args': {'layers': 1,
+                                                             'd_hidden': 8}}
+    reward = airl_numpy.export((cfg, params))
+    obs, actions = rng.randn(4, 3), rng.randn(4, 2)
+    x = np.maximum(np.concatenate([obs, actions], axis=1).dot(params[0])
+                   + params[1], 0)
+    expected = (x.dot(params[2]) + params[3])[:, 0]
+    np.testing.assert_allclose(reward(obs, actions), expected, rtol=1e-4)
+
+
+def test_unsupported():
+    rng = np.random.RandomState(0)
+    params = _params(rng, [5, 8, 1])
+    with pytest.raises(ValueError):  # wrong number of layers
+        airl_numpy.export(({'model': 'AIRLStateAction'}, params))
+    with pytest.raises(ValueError):
+        airl_numpy.export(({'model': 'GAIL'}, params))
@@ -0,0 +1,110 @@
+import hermes
+import numpy as np
+
+from pirl import blobs, cache_backend
+
+def make_cache(tmpdir, **kwargs):
+    return hermes.Hermes(cache_backend.Backend, path=str(tmpdir), **kwargs)
+
+
+def test_roundtrip(tmpdir):
+    """Small values are stored inline, large values as blobs: check both
+       are returned unchanged, and only computed once."""
+    cache = make_cache(tmpdir, inline_limit=1000)
+    calls = []
+
+    @cache(tags=('test', ))
+    def f(n):
+        calls.append(n)
+        return np.arange(n)
+
+    for n in [10, 10000]:
+        for _ in range(2):
+            np.testing.assert_array_equal(f(n), np.arange(n))
+    assert calls == [10, 10000]
+    assert len(tmpdir.join('blobs').listdir()) == 1
+
+
+def test_clean_tags(tmpdir):
+    cache = make_cache(tmpdir)
+    calls = []
+
+    @cache(tags=('foo', ))
+    def f(x):
+        calls.append(x)
+        return x
+
+    @cache(tags=('bar', ))
+    def g(x):
+        calls.append(x)
+        return x
+
+    f(1), g(2)
+    cache.clean(['foo'])
+    f(1), g(2)
+    assert calls == [1, 2, 1]
+
+
+def test_persistent(tmpdir):
+    """A new instance (e.g. in another process) sees existing entries."""
+    calls = []
+    def f(x):
+        calls.append(x)
+        return x
+
+    make_cache(tmpdir)(f)(1)
+    make_cache(tmpdir)(f)(1)
+    assert calls == [1]
+
+
+def test_blob_store(tmpdir):
+    store = blobs.BlobStore(str(tmpdir), threshold=1000)
+    small = np.arange(10)
+    assert store.put(small) is small
+
+    # Identical payloads are stored once
+    x = np.arange(10000)
+    refs = [store.put(x), store.put(x.copy())]
+    assert refs[0] == refs[1]
+    assert store.contains(refs[0])
+    y = store.get(refs[0])
+    assert not y.flags.owndata  # memory-mapped
+    np.testing.assert_array_equal(x, y)
+
+    # Large arrays in containers are stored individually
+    trajs = [(np.arange(1000), np.ones(1000))]
+    value = store.put(trajs)
+    assert len(blobs.references(value)) == 2
+    loaded = store.get(value)
+    assert not loaded[0][1].flags.owndata
+    np.testing.assert_array_equal(loaded[0][1], trajs[0][1])
+
+    # Containers of many small values are stored whole
+    episodes = {'a': [(np.arange(5), i) for i in range(100)]}
+    value = store.put(episodes)
+    assert isinstance(value['a'], blobs.BlobRef)
+    assert value['a'].format == 'pkl.z'
+    assert store.get(value)['a'][99][1] == 99
+
+
+def test_evict(tmpdir):
+    cache = make_cache(tmpdir, max_bytes=10000, policy='lru')
+    calls = []
+
+    @cache(tags=('test', ))
+    def f(x):
+        calls.append(x)
+        return np.zeros(500) + x  # ~4000 bytes serialized
+
+    f(0), f(1)
+    f(0)  # 1 is now least recently used
+    f(2)  # exceeds budget
+    f(0), f(1)
+    assert calls == [0, 1, 2, 1]
+    assert sum(cache.backend.sizes().values()) <= 10000
+
+
+def test_exists(tmpdir):
+    cache = make_cache(tmpdir)
+    cache.backend.save(mapping={'a': 1, 'b': 2})
+    assert cache.backend.exists(['a', 'c', 'b']) == [True, False, True]
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pirl import inference
+
+
+def _scale(factor):
+    return lambda x: x * factor
+
+
+@pytest.fixture
+def server(tmpdir, monkeypatch):
+    monkeypatch.setitem(inference.LOADERS, 'scale', _scale)
+    path = str(tmpdir.join('inference.sock'))
+    server = inference.InferenceServer(path, max_delay=0.01)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, path
+    server.shutdown()
+    server.server_close()
+
+
+def test_batched_calls(server):
+    server, path = server
+    results = {}
+
+    def worker(i):
+        with inference.InferenceClient(path) as client:
+            fn = client.load('scale', 2)
+            results[i] = fn(np.arange(i + 1))
+
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i in range(8):
+        np.testing.assert_array_equal(results[i], 2 * np.arange(i + 1))
+    assert len(server.models) == 1  # identical specs share a model
+
+
+def test_error(server):
+    _server, path = server
+    with inference.InferenceClient(path) as client:
+        with pytest.raises(RuntimeError):
+            client.load('unknown', None)
+        fn = client.load('scale', 'a')
+        with pytest.raises(RuntimeError):
+            fn(np.arange(3.0))  # cannot multiply floats by a string
+
+
+def test_unload(server, monkeypatch):
+    server, path = server
+    closed = []
+
+    def load(spec):
+        fn = _scale(spec)
+        fn.close = lambda: closed.append(spec)
+        return fn
+
+    monkeypatch.setitem(inference.LOADERS, 'closing', load)
+    with inference.InferenceClient(path) as client:
+        fn = client.load('closing', 2)
+        client.unload(fn)
+        assert closed == [2]
+        assert not server.models
+
+        with inference.InferenceClient(path) as other:
+            fn = client.load('closing', 3)
+            other.load('closing', 3)
+        # other's reference is dropped on disconnect; client's remains
+        np.testing.assert_array_equal(fn(np.arange(2)), [0, 3])
+    for _ in range(100):  # released once the server sees the disconnect
+        if closed == [2, 3]:
+            break
+        time.sleep(0.01)
+    assert closed == [2, 3]
+    assert not server.models
+
+
+def test_call_requires_load(server):
+    _server, path = server
+    with inference.InferenceClient(path) as client:
+        fn = client.load('scale', 2)
+        with inference.InferenceClient(path) as other:
+            with pytest.raises(RuntimeError):
+                other._request('call', fn.key, (np.arange(2), ))
+        client.unload(fn)
+        with pytest.raises(RuntimeError):
+            fn(np.arange(2))
@@ -0,0 +1,55 @@
+from pirl import results
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join('results.log'))
+    store = results.ResultsStore(path)
+    rewards = {'env': {0: {1: 'r1', 2: 'r2'}}}
+    values = {'irl1': {'env': {0: {1: (1.0, 0.1)}}}}
+    store.append(results.flatten(0, ['rewards', 'irl1'], rewards))
+    store.append(results.flatten(0, ['values', 'rl'], values))
+    store.append(results.flatten(1, ['ground_truth', 'rl', 'env'], (2.0, 0.2)))
+
+    key = results.Key(0, 'values', ('rl', 'irl1'), 'env', 0, 1)
+    assert key in store
+
+    expected = {
+        'rewards': {0: {'irl1': rewards}},
+        'values': {0: {'rl': values}},
+        'ground_truth': {1: {'rl': {'env': (2.0, 0.2)}}},
+    }
+    assert results.ResultsStore(path).nested() == expected
+    assert store.nested(seed=1) == {'ground_truth': {'rl': {'env': (2.0, 0.2)}}}
+
+
+def test_truncated(tmpdir):
+    """A partially written batch is discarded on reload."""
+    path = tmpdir.join('results.log')
+    store = results.ResultsStore(str(path))
+    store.append(results.flatten(0, ['ground_truth', 'rl', 'a'], 1))
+    store.append(results.flatten(0, ['ground_truth', 'rl', 'b'], 2))
+    data = path.read_binary()
+    path.write_binary(data[:-1])
+
+    store = results.ResultsStore(str(path))
+    assert store.nested(seed=0) == {'ground_truth': {'rl': {'a': 1}}}
+    store.append(results.flatten(0, ['ground_truth', 'rl', 'c'], 3))
+    assert len(results.ResultsStore(str(path))) == 2
+
+
+def test_write_values(tmpdir):
+    import numpy as np
+    store = results.ResultsStore(str(tmpdir.join('results.log')))
+    values = {'irl1': {'env': {0: {1: (1.0, 0.1)}}},
+              'gail': {'env': {0: {1: None}}}}
+    store.append(results.flatten(0, ['values', 'rl'], values))
+    store.append(results.flatten(0, ['ground_truth', 'rl', 'env'],
+                                 (2.0, 0.2, 40)))
+    path = str(tmpdir.join('values.npz'))
+    results.write_values(path, store)
+
+    with np.load(path) as data:
+        irls = data['irl.categories'][data['irl.codes']]
+        assert list(irls) == ['irl1', 'gail', results.GROUND_TRUTH]
+        np.testing.assert_array_equal(data['n'], [0, 0, -1])
+        np.testing.assert_array_equal(data['mean'], [1.0, np.nan, 2.0])
+        np.testing.assert_array_equal(data['episodes'], [-1, -1, 40])
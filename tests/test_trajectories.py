@@ -0,0 +1,46 @@
+import pickle
+
+import numpy as np
+
+from pirl.trajectories import as_batch
+
+def make_episodes():
+    return [(np.arange(n) + 10 * n, np.arange(n), np.ones(n))
+            for n in [3, 1, 4]]
+
+
+def test_episodes():
+    episodes = make_episodes()
+    batch = as_batch(episodes)
+    assert len(batch) == 3
+    for (obs, acts, rews), expected in zip(batch, episodes):
+        np.testing.assert_array_equal(obs, expected[0])
+        np.testing.assert_array_equal(rews, expected[2])
+    np.testing.assert_array_equal(batch[-1][0], episodes[-1][0])
+    assert np.shares_memory(batch[1][0], batch.observations)
+
+    obs, acts = batch.without_rewards()[0]
+    np.testing.assert_array_equal(acts, episodes[0][1])
+
+
+def test_slice():
+    batch = as_batch(make_episodes())
+    prefix = batch[1:]
+    assert len(prefix) == 2
+    np.testing.assert_array_equal(prefix[0][0], [10])
+    assert np.shares_memory(prefix.observations, batch.observations)
+    assert len(batch[:0]) == 0
+    assert len(batch[::2]) == 2
+
+    # Only the covered span is serialized
+    restored = pickle.loads(pickle.dumps(prefix))
+    assert len(restored.observations) == 5
+    np.testing.assert_array_equal(restored[1][0], prefix[1][0])
+
+
+def test_discounted_returns():
+    batch = as_batch(make_episodes())
+    returns = batch.discounted_returns(0.5)
+    np.testing.assert_allclose(returns, [1.75, 1, 1.875])
+    np.testing.assert_allclose(batch[1:].discount_weights(0.5),
+                               [1, 1, 0.5, 0.25, 0.125])
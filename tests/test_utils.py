@@ -0,0 +1,91 @@
+import numpy as np
+
+from pirl import utils
+from pirl.trajectories import TrajectoryBatch
+
+def test_key_token():
+    x = np.arange(1000, dtype='float64')
+    token = utils.key_token([(x, 1)])
+    assert token == [(('ndarray', utils.array_digest(x)), 1)]
+
+    # Depends on content, dtype and shape, not on memory layout
+    assert utils.array_digest(x) == utils.array_digest(x[::-1][::-1].copy())
+    assert utils.array_digest(x) != utils.array_digest(x.astype('float32'))
+    assert utils.array_digest(x) != utils.array_digest(x.reshape(10, 100))
+    y = x.reshape(10, 100)
+    assert utils.array_digest(y.T) == utils.array_digest(y.T.copy())
+
+    # Small arrays are left to be pickled
+    small = np.arange(10)
+    assert utils.key_token(small) is small
+
+
+def test_trajectory_batch_token():
+    obs = np.arange(2000, dtype='float64').reshape(1000, 2)
+    batch = TrajectoryBatch([0, 400, 1000], obs, np.zeros(1000))
+    token = utils.key_token(batch)
+    assert utils.key_token(batch) is token  # memoized
+    assert batch in utils._batch_tokens
+    same = TrajectoryBatch([0, 400, 1000], obs.copy(), np.zeros(1000))
+    assert utils.key_token(same) == token
+
+
+def test_promote_dir(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('progress.csv').write('a,b\n')
+    dst = tmpdir.mkdir('dst')
+    assert utils.promote_dir(str(src), str(dst)).result() == str(dst)
+    assert not src.exists()
+    assert dst.join('progress.csv').read() == 'a,b\n'
+
+
+def test_archive(tmpdir):
+    import tarfile
+    src = tmpdir.mkdir('src')
+    src.mkdir('mon').join('train.csv').write('r,l\n')
+    dst = tmpdir.mkdir('dst')
+    utils._archive(str(src), str(dst), compress=True)
+    assert dst.listdir() == [dst.join('logs.tar.gz')]
+    with tarfile.open(str(dst.join('logs.tar.gz'))) as tar:
+        f = tar.extractfile('./mon/train.csv')
+        assert f.read() == b'r,l\n'
+
+
+def test_batch_lookups(tmpdir, monkeypatch):
+    """get_many, exists_many and lookup_many find the entries hermes stores,
+       including under tags."""
+    import hermes
+    import hermes.backend.dict
+    from pirl import blobs
+    cache = hermes.Hermes(hermes.backend.dict.Backend)
+    monkeypatch.setattr(utils.get_hermes, 'cache', cache)
+    monkeypatch.setattr(blobs.get_blob_store, 'store',
+                        blobs.BlobStore(str(tmpdir.join('cas'))))
+    calls = []
+
+    @utils.cache(tags=('test', ))
+    def f(x):
+        calls.append(x)
+        return x * 2
+
+    # Tags do not exist before the first call
+    assert utils.get_many(f, [((1, ), {})]) == [utils.MISSING]
+    assert f(1) == 2
+    lookups = [((1, ), {}), ((3, ), {})]
+    for _ in range(2):
+        assert utils.get_many(f, lookups) == [2, utils.MISSING]
+        assert utils.exists_many(f, lookups) == [True, False]
+    assert calls == [1]
+
+    @utils.cache_and_log(str(tmpdir.join('objects')))(tags=('test', ))
+    def g(x, log_dir):
+        calls.append(x)
+        return x * 3
+
+    assert g(x=1, log_dir=str(tmpdir.join('logs', 'a'))) == 3
+    log_dir = tmpdir.join('logs', 'b')
+    hits = g.lookup_many([{'x': 1, 'log_dir': str(log_dir)},
+                          {'x': 2, 'log_dir': str(tmpdir.join('logs', 'c'))}])
+    assert hits == [3, utils.MISSING]
+    assert log_dir.check(link=1)
+    assert calls == [1, 1]